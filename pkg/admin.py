@@ -1,8 +1,16 @@
 from django.contrib import admin
-from nirvana.pkg.models import Package, Version, Category, Variant, ManagerPermission
+from nirvana.pkg.models import Package, Version, Category, Variant, ManagerPermission, ApiToken
+from nirvana.pkg.forms import VariantContentForm
+
+class VariantAdmin(admin.ModelAdmin):
+    form = VariantContentForm
+
+class ApiTokenAdmin(admin.ModelAdmin):
+    list_display = ('user', 'name', 'scopes', 'created', 'expires')
 
 admin.site.register(ManagerPermission)
+admin.site.register(ApiToken, ApiTokenAdmin)
 admin.site.register(Package)
 admin.site.register(Version)
 admin.site.register(Category)
-admin.site.register(Variant)
+admin.site.register(Variant, VariantAdmin)
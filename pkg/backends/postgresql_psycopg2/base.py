@@ -0,0 +1,92 @@
+"""
+    The PostgreSQL backend of Django, keeping connections open in a pool
+    per process instead of connecting for every request.
+
+    Use ``'ENGINE': 'nirvana.pkg.backends.postgresql_psycopg2'``. The
+    database settings may have two additional keys: ``POOL_MIN`` (default:
+    1) connections are opened at once, at most ``POOL_SIZE`` (default: 10)
+    are open at a time. ``POOL_SIZE`` has to be at least the number of
+    threads per process.
+"""
+import os
+import threading
+
+from psycopg2 import pool, extensions, Error
+
+from django.db.backends.signals import connection_created
+from django.db.backends.postgresql_psycopg2 import base
+from django.db.backends.postgresql_psycopg2.base import *
+
+class ConnectionPool(pool.ThreadedConnectionPool):
+    """
+        Sets the encoding and time zone of new connections once.
+    """
+    def __init__(self, minconn, maxconn, time_zone, **params):
+        self.time_zone = time_zone
+        pool.ThreadedConnectionPool.__init__(self, minconn, maxconn, **params)
+
+    def _connect(self, key=None):
+        conn = pool.ThreadedConnectionPool._connect(self, key)
+        conn.set_client_encoding('UTF8')
+        if self.time_zone:
+            cursor = conn.cursor()
+            cursor.execute('SET TIME ZONE %s', [self.time_zone])
+            cursor.close()
+            conn.commit()
+        return conn
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(alias, settings_dict):
+    # connections can't be shared with forked processes.
+    key = (alias, os.getpid())
+    _pools_lock.acquire()
+    try:
+        if key not in _pools:
+            params = {'database': settings_dict['NAME']}
+            params.update(settings_dict['OPTIONS'])
+            params.pop('autocommit', None)
+            for setting in ('USER', 'PASSWORD', 'HOST', 'PORT'):
+                if settings_dict[setting]:
+                    params[setting.lower()] = settings_dict[setting]
+            _pools[key] = ConnectionPool(settings_dict.get('POOL_MIN', 1), settings_dict.get('POOL_SIZE', 10),
+                    settings_dict.get('TIME_ZONE'), **params)
+        return _pools[key]
+    finally:
+        _pools_lock.release()
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def _cursor(self):
+        if self.connection is None:
+            if not self.settings_dict['NAME']:
+                from django.core.exceptions import ImproperlyConfigured
+                raise ImproperlyConfigured("You need to specify NAME in your Django settings file.")
+            self.connection = get_pool(self.alias, self.settings_dict).getconn()
+            self.connection.set_isolation_level(self.isolation_level)
+            connection_created.send(sender=self.__class__, connection=self)
+            if not hasattr(self, '_version'):
+                cursor = self.connection.cursor()
+                self.__class__._version = base.get_version(cursor)
+                cursor.close()
+            if self._version[0:2] < (8, 0):
+                self.features.uses_savepoints = False
+            if self.features.uses_autocommit and self._version[0:2] >= (8, 2):
+                self.features.can_return_id_from_insert = True
+        return super(DatabaseWrapper, self)._cursor()
+
+    def close(self):
+        """
+            Return the connection to the pool, discarding uncommitted
+            changes. Broken connections are closed.
+        """
+        if self.connection is None:
+            return
+        conn, self.connection = self.connection, None
+        broken = bool(conn.closed)
+        if not broken and conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except Error:
+                broken = True
+        get_pool(self.alias, self.settings_dict).putconn(conn, close=broken)
@@ -0,0 +1,413 @@
+"""
+    Latency benchmarks for the nirvana urls, see `manage.py benchmark`.
+"""
+import time
+import itertools
+import threading
+import urllib
+import urllib2
+from SocketServer import ThreadingMixIn
+
+from django.contrib.auth.models import User
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.servers.basehttp import WSGIServer, WSGIRequestHandler
+from django.core.urlresolvers import RegexURLResolver
+from django.db import connection, reset_queries
+from django.test.client import Client
+from django.utils import simplejson
+
+from nirvana.pkg.models import Category, Package, Version, Variant, ManagerPermission, Checksum
+from nirvana.pkg.tokens import create_token
+from nirvana.pkg.manifest import update_manifest, get_latest_manifest
+from nirvana.pkg.encoding import get_available_encoders, compress
+from nirvana.pkg.dispatch import flatten
+
+USEFILE = """Name: Package %(package)d
+Version: %(version)s
+Variant: %(variant)s
+Origin: git://example.org/package-%(package)d.git
+Build: ooc package-%(package)d.ooc
+"""
+
+PASSWORD = 'benchmark'
+
+# the submissions of every round need new variant slugs.
+_slugs = itertools.count()
+
+def seed_catalogue(categories=5, packages=50, versions=5, variants=3, permissions=2):
+    """
+        Fill the database with a synthetic catalogue: *categories* categories,
+        *packages* packages spread over them, *versions* versions per package
+        (the last one is the latest), *variants* variants per version and
+        *permissions* manager permissions per package. The author is
+        staff, so the staff-only urls can be measured too.
+    """
+    author = User.objects.create_user('bench', 'bench@example.org', PASSWORD)
+    author.is_staff = True
+    author.save()
+    managers = [User.objects.create_user('manager%d' % i, 'manager%d@example.org' % i, PASSWORD)
+                    for i in range(permissions)]
+    category_objects = []
+    for i in range(categories):
+        category = Category(slug='category-%d' % i, name='Category %d' % i)
+        category.save()
+        category_objects.append(category)
+    for i in range(packages):
+        package = Package(slug='package-%d' % i, name='Package %d' % i, author=author,
+                category=category_objects[i % categories], homepage='http://example.org/')
+        package.save()
+        new_variants = []
+        for j in range(versions):
+            version = Version(slug='%d.0' % j, name='Version %d' % j, package=package, latest=(j == versions - 1))
+            version.save()
+            for k in range(variants):
+                checksums = ''.join('%032x  file%d.ooc\n' % (i * j * k + n, n) for n in range(10))
+                new_variants.append(Variant(
+                    slug='variant-%d' % k,
+                    name='Variant %d' % k,
+                    version=version,
+                    usefile=USEFILE % {'package': i, 'version': version.slug, 'variant': 'variant-%d' % k},
+                    checksums=checksums,
+                    checksums_signature='-----BEGIN PGP SIGNATURE-----\nbenchmark\n-----END PGP SIGNATURE-----\n',
+                    ))
+        Variant.objects.insert_many(new_variants)
+        for j, manager in enumerate(managers):
+            ManagerPermission(package=package, user=manager, variant_slug='variant-%d' % (j % max(variants, 1))).save()
+    update_manifest(full=True)
+    return author
+
+def get_endpoints(author):
+    """
+        Return a list of (name, method, path, data, login) tuples covering
+        the urls of `nirvana.urls`, using the catalogue made by `seed_catalogue`.
+        *data* may be a callable returning new data for every request, e.g.
+        for submissions that need new variant slugs.
+    """
+    package = Package.objects.filter(author=author).order_by('slug')[0]
+    version = package.latest_version
+    variant = Variant.objects.filter(version=version)[0]
+    p, v, va = package.slug, version.slug, variant.slug
+    api_token, token = create_token(author, 'benchmark')
+    authorized = {
+        'user': author.username,
+        'token': token,
+        'package': p,
+        'version': v,
+        'variant': va,
+    }
+    def new_usefile():
+        slug = 'bench-%d' % _slugs.next()
+        return slug, USEFILE % {'package': 0, 'version': v, 'variant': slug}
+    def submit():
+        slug, usefile = new_usefile()
+        return {'user': author.username, 'token': token, 'slug': p, 'usefile': usefile,
+                'checksums': '%032x  %s.ooc\n' % (0, slug), 'name': slug}
+    def submit_batch():
+        return {'user': author.username, 'token': token, 'slug': p, 'variants': simplejson.dumps(
+            [{'usefile': usefile, 'name': slug} for slug, usefile in [new_usefile() for i in range(5)]])}
+    checksum = Checksum.objects.filter(variant=variant).values_list('hash', flat=True)[0]
+    manifest = get_latest_manifest()
+    endpoints = [
+        ('welcome', 'GET', '/', None, False),
+        ('categories', 'GET', '/categories/', None, False),
+        ('category', 'GET', '/category/%s/' % package.category_id, None, False),
+        ('category_my', 'GET', '/category/my/', None, True),
+        ('category_new', 'GET', '/category/new/', None, True),
+        ('token', 'GET', '/token/', None, True),
+        ('package', 'GET', '/packages/%s/' % p, None, False),
+        ('package_new', 'GET', '/package/new/', None, True),
+        ('package_edit', 'GET', '/package/%s/edit/' % p, None, True),
+        ('package_edit_managers', 'GET', '/package/%s/managers/' % p, None, True),
+        ('version', 'GET', '/packages/%s/%s/' % (p, v), None, True),
+        ('version_latest', 'GET', '/packages/%s/latest/' % p, None, False),
+        ('version_new', 'GET', '/package/%s/new/' % p, None, True),
+        ('version_edit', 'GET', '/package/%s/%s/edit/' % (p, v), None, True),
+        ('version_edit_latest', 'GET', '/package/%s/latest/edit/' % p, None, True),
+        ('variant', 'GET', '/packages/%s/%s/%s/' % (p, v, va), None, False),
+        ('variant_latest', 'GET', '/packages/%s/latest/%s/' % (p, va), None, False),
+        ('variant_new', 'GET', '/package/%s/%s/new/' % (p, v), None, True),
+        ('variant_new_latest', 'GET', '/package/%s/latest/new/' % p, None, True),
+        ('variant_edit', 'GET', '/package/%s/%s/%s/edit/' % (p, v, va), None, True),
+        ('variant_edit_latest', 'GET', '/package/%s/latest/%s/edit/' % (p, va), None, True),
+        ('usefile', 'GET', '/packages/%s/%s/%s/%s.use' % (p, v, va, p), None, False),
+        ('usefile_latest', 'GET', '/packages/%s/latest/%s/%s.use' % (p, va, p), None, False),
+        ('checksums', 'GET', '/packages/%s/%s/%s/%s.checksums' % (p, v, va, p), None, False),
+        ('checksums_latest', 'GET', '/packages/%s/latest/%s/%s.checksums' % (p, va, p), None, False),
+        ('checksums_signature', 'GET', '/packages/%s/%s/%s/%s.checksums.sig' % (p, v, va, p), None, False),
+        ('checksums_signature_latest', 'GET', '/packages/%s/latest/%s/%s.checksums.sig' % (p, va, p), None, False),
+        ('api_categories', 'GET', '/api/categories/', None, False),
+        ('api_categories_details', 'GET', '/api/categories/?type=details', None, False),
+        ('api_category', 'GET', '/api/category/%s/' % package.category_id, None, False),
+        ('api_package', 'GET', '/api/packages/%s/' % p, None, False),
+        ('api_package_details', 'GET', '/api/packages/%s/?type=details' % p, None, False),
+        ('api_package_resolve', 'GET', '/api/packages/%s/resolve/?constraint=*' % p, None, False),
+        ('api_version', 'GET', '/api/packages/%s/%s/?type=details' % (p, v), None, False),
+        ('api_version_latest', 'GET', '/api/packages/%s/latest/' % p, None, False),
+        ('api_variant', 'GET', '/api/packages/%s/%s/%s/' % (p, v, va), None, False),
+        ('api_variant_latest', 'GET', '/api/packages/%s/latest/%s/' % (p, va), None, False),
+        ('api_dependencies', 'GET', '/api/packages/%s/%s/%s/dependencies/' % (p, v, va), None, False),
+        ('api_dependencies_latest', 'GET', '/api/packages/%s/latest/%s/dependencies/' % (p, va), None, False),
+        ('api_search', 'GET', '/api/search/?pattern=package', None, False),
+        ('api_resolve', 'GET', '/api/resolve/?%s' % urllib.urlencode(
+            [('variant', '%s/latest/%s' % (q.slug, va)) for q in Package.objects.all()[:20]]), None, False),
+        ('api_snapshot', 'GET', '/api/snapshot/', None, False),
+        ('api_manifest', 'GET', '/api/manifest/', None, False),
+        ('api_manifest_signature', 'GET', '/api/manifest/%s.sig' % manifest.content_hash, None, False),
+        ('api_blob', 'GET', '/api/blobs/%s/' % variant.get_hash('usefile'), None, False),
+        ('api_checksum', 'GET', '/api/checksums/%s/' % checksum, None, False),
+        ('api_cache', 'GET', '/api/cache/', None, False),
+        ('api_stats', 'GET', '/api/stats/', None, True),
+        ('api_authorized', 'POST', '/api/authorized/', authorized, False),
+        ('api_submit', 'POST', '/api/submit/', submit, False),
+        ('api_submit_batch', 'POST', '/api/submit/batch/', submit_batch, False),
+    ]
+    return endpoints
+
+def percentile(values, percent):
+    """
+        Return the *percent* percentile of the sorted list *values* (nearest rank).
+    """
+    if not values:
+        return None
+    index = max(int(round(percent / 100.0 * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+def summarize(timings, wall_time=None):
+    """
+        Return latency percentiles (in milliseconds) and the throughput
+        (requests per second) of the list of request durations *timings*.
+    """
+    timings = sorted(timings)
+    if wall_time is None:
+        wall_time = sum(timings)
+    return {
+        'requests': len(timings),
+        'p50': percentile(timings, 50) * 1000,
+        'p95': percentile(timings, 95) * 1000,
+        'p99': percentile(timings, 99) * 1000,
+        'throughput': len(timings) / wall_time if wall_time else None,
+    }
+
+def _client_request(client, method, path, data, **extra):
+    if callable(data):
+        data = data()
+    if method == 'POST':
+        return client.post(path, data, **extra)
+    return client.get(path, **extra)
+
+def measure_client(client, method, path, data, requests):
+    """
+        Request *path* *requests* times with the django test client. The
+        number of queries is taken from the first (cold) request, the
+        response sizes with and without gzip from the last ones.
+    """
+    reset_queries()
+    response = _client_request(client, method, path, data)
+    queries = len(connection.queries)
+    timings = []
+    for i in range(requests):
+        start = time.time()
+        _client_request(client, method, path, data)
+        timings.append(time.time() - start)
+        reset_queries()
+    result = summarize(timings)
+    result.update({
+        'status': response.status_code,
+        'queries': queries,
+        'bytes': len(_client_request(client, method, path, data).content),
+        'gzip_bytes': len(_client_request(client, method, path, data, HTTP_ACCEPT_ENCODING='gzip').content),
+    })
+    reset_queries()
+    return result
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+class ThreadedWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+def start_server():
+    """
+        Serve nirvana on a free local port in a background thread and
+        return the server.
+    """
+    server = ThreadedWSGIServer(('127.0.0.1', 0), QuietRequestHandler)
+    server.set_app(WSGIHandler())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server
+
+def measure_http(base_url, method, path, data, requests, concurrency):
+    """
+        Request *path* *requests* times over HTTP, using *concurrency*
+        parallel clients.
+    """
+    url = base_url + path
+    timings = []
+    errors = []
+    lock = threading.Lock()
+    def work(count):
+        for i in range(count):
+            body = data
+            if callable(body):
+                body = body()
+            if body is not None:
+                body = urllib.urlencode(body)
+            start = time.time()
+            try:
+                urllib2.urlopen(url, body).read()
+            except urllib2.URLError, e:
+                errors.append(e)
+            duration = time.time() - start
+            lock.acquire()
+            timings.append(duration)
+            lock.release()
+    threads = [threading.Thread(target=work, args=(requests // concurrency + (i < requests % concurrency),))
+                for i in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result = summarize(timings, time.time() - start)
+    result['errors'] = len(errors)
+    return result
+
+def run_benchmark(author, requests=50, concurrency=4, http=True, only=None):
+    """
+        Benchmark all endpoints and return a dictionary mapping endpoint
+        names to {'client': ..., 'http': ...} results.
+    """
+    client = Client()
+    client.login(username=author.username, password=PASSWORD)
+    anonymous = Client()
+    server = None
+    if http:
+        server = start_server()
+        base_url = 'http://127.0.0.1:%d' % server.server_port
+    results = {}
+    try:
+        for name, method, path, data, login in get_endpoints(author):
+            if only and name not in only:
+                continue
+            result = results[name] = {'path': path}
+            result['client'] = measure_client(login and client or anonymous, method, path, data, requests)
+            if server is not None and not login:
+                result['http'] = measure_http(base_url, method, path, data, requests, concurrency)
+    finally:
+        if server is not None:
+            server.shutdown()
+    return results
+
+def compare_encoders(author, rounds=20):
+    """
+        Encode the results of all JSON endpoints *rounds* times with every
+        installed JSON library, and with `django.utils.simplejson` that
+        was used before, and return a dictionary mapping the library names
+        to the total encoding time (in milliseconds) and the total size
+        of the results, plain and gzip-compressed.
+    """
+    client = Client()
+    client.login(username=author.username, password=PASSWORD)
+    payloads = []
+    for name, method, path, data, login in get_endpoints(author):
+        if not name.startswith('api_') or callable(data):
+            continue
+        response = _client_request(client, method, path, data)
+        # e.g. snapshots, blobs and signatures.
+        if not response['Content-Type'].startswith('application/json'):
+            continue
+        payloads.append(simplejson.loads(response.content))
+    encoders = [('django.utils.simplejson', simplejson.dumps)] + get_available_encoders()
+    results = {}
+    for name, dumps in encoders:
+        start = time.time()
+        for i in range(rounds):
+            encoded = [dumps(payload) for payload in payloads]
+        results[name] = {
+            'ms': (time.time() - start) * 1000,
+            'bytes': sum(len(content) for content in encoded),
+            'gzip_bytes': sum(len(compress(content, 'gzip')) for content in encoded),
+        }
+    return results
+
+def format_encoders(results):
+    lines = ['%-24s %10s %10s %10s' % ('encoder', 'ms', 'bytes', 'gzip')]
+    for name, result in sorted(results.iteritems(), key=lambda item: item[1]['ms']):
+        lines.append('%-24s %10.2f %10d %10d' % (name, result['ms'], result['bytes'], result['gzip_bytes']))
+    return '\n'.join(lines)
+
+def compare_resolvers(author, rounds=1000):
+    """
+        Resolve the path of every endpoint *rounds* times with the urlconf
+        and with the same urlconf resolved by regex only (see
+        `nirvana.pkg.dispatch.flatten`), and return a dictionary mapping
+        the endpoint names to the microseconds per resolution of both.
+    """
+    from nirvana import urls
+    resolvers = (
+        ('regex', RegexURLResolver(r'^/', flatten(urls.urlpatterns))),
+        ('dispatch', RegexURLResolver(r'^/', urls.urlpatterns)),
+    )
+    results = {}
+    for name, method, path, data, login in get_endpoints(author):
+        path = path.split('?')[0]
+        result = results[name] = {}
+        for kind, resolver in resolvers:
+            # the first resolution imports the views.
+            resolver.resolve(path)
+            start = time.time()
+            for i in xrange(rounds):
+                resolver.resolve(path)
+            result[kind] = (time.time() - start) * 1000000 / rounds
+    return results
+
+def format_resolvers(results):
+    lines = ['%-24s %10s %10s %8s' % ('endpoint', 'regex us', 'dispatch us', 'speedup')]
+    for name, result in sorted(results.iteritems()):
+        lines.append('%-24s %10.2f %10.2f %7.1fx' % (name, result['regex'], result['dispatch'],
+            result['regex'] / max(result['dispatch'], 0.001)))
+    return '\n'.join(lines)
+
+def find_regressions(results, baseline, tolerance=0.25):
+    """
+        Compare *results* to the *baseline* results and return a list of
+        messages about endpoints whose p95 latency grew by more than
+        *tolerance* (a fraction) or that issue more queries.
+    """
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        old = baseline.get(name)
+        if old is None:
+            continue
+        for mode in ('client', 'http'):
+            if mode not in result or mode not in old:
+                continue
+            if result[mode]['p95'] > old[mode]['p95'] * (1 + tolerance):
+                regressions.append('%s (%s): p95 %.2fms > %.2fms' % (
+                    name, mode, result[mode]['p95'], old[mode]['p95']))
+        if result['client'].get('queries', 0) > old['client'].get('queries', 0):
+            regressions.append('%s: %d queries > %d' % (
+                name, result['client']['queries'], old['client']['queries']))
+    return regressions
+
+def format_results(results):
+    lines = ['%-24s %6s %8s %8s %8s %10s %8s %8s %8s' % (
+        'endpoint', 'mode', 'p50', 'p95', 'p99', 'req/s', 'queries', 'bytes', 'gzip')]
+    for name, result in sorted(results.iteritems()):
+        for mode in ('client', 'http'):
+            if mode not in result:
+                continue
+            r = result[mode]
+            lines.append('%-24s %6s %8.2f %8.2f %8.2f %10.1f %8s %8s %8s' % (
+                name, mode, r['p50'], r['p95'], r['p99'], r['throughput'] or 0,
+                r.get('queries', ''), r.get('bytes', ''), r.get('gzip_bytes', '')))
+    return '\n'.join(lines)
+
+def dump_results(results, config, fileobj):
+    simplejson.dump({'config': config, 'endpoints': results}, fileobj, indent=2, sort_keys=True)
+
+def load_results(fileobj):
+    return simplejson.load(fileobj)['endpoints']
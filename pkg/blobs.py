@@ -0,0 +1,347 @@
+"""
+    Content-addressed storage for the usefiles, checksums and checksums
+    signatures of variants.
+
+    Every content is stored once under its hash (see `content_hash`), so
+    variants sharing a checksum list or a usefile share one blob, and
+    variant rows only hold the hashes. The store is configured by the
+    `BLOB_STORAGE` setting: if it is empty (the default), blobs are rows
+    of the `Blob` table; otherwise it is a directory and every blob is a
+    file ``<directory>/ab/cdef...`` named after its hash.
+
+    Blobs in a directory are sent by the web server if `BLOB_SENDFILE_HEADER`
+    is set, see `blob_response`.
+"""
+import os
+import time
+import tempfile
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.servers.basehttp import FileWrapper
+from django.db import connection, transaction, IntegrityError
+from django.http import HttpResponse
+
+from nirvana.pkg.stuff import content_hash
+from nirvana.pkg.encoding import compress_response
+
+# the empty content is never stored.
+EMPTY_HASH = content_hash('')
+
+# blobs of files at least this large are streamed from the file instead
+# of being read into memory (and compressed) first.
+STREAM_MIN_SIZE = 64 * 1024
+
+CHUNK_SIZE = 16 * 1024
+
+# hashes per query, below the limit of query parameters of sqlite.
+BATCH_SIZE = 500
+
+class BlobNotFound(Exception):
+    pass
+
+def _contents(contents):
+    """
+        Return the non-empty items of the dictionary *contents*, which maps
+        hashes to contents.
+    """
+    return dict((hash, content) for hash, content in contents.iteritems()
+            if hash not in ('', EMPTY_HASH))
+
+class BlobStore(object):
+    """
+        Base class of the blob stores. Contents are unicode strings.
+    """
+    def get(self, hash):
+        """
+            Return the content stored under *hash*. Raises `BlobNotFound`.
+        """
+        if hash in ('', EMPTY_HASH):
+            return u''
+        contents = self.get_many([hash])
+        if hash not in contents:
+            raise BlobNotFound('No blob %s' % hash)
+        return contents[hash]
+
+    def get_many(self, hashes):
+        """
+            Return a dictionary mapping those of *hashes* that are stored
+            (or empty) to their contents.
+        """
+        result = dict((hash, u'') for hash in hashes if hash in ('', EMPTY_HASH))
+        missing = [hash for hash in set(hashes) if hash not in result]
+        if missing:
+            result.update(self._get_many(missing))
+        return result
+
+    def put(self, content):
+        """
+            Store *content* unless it is already stored and return its hash.
+        """
+        hash = content_hash(content)
+        self.put_many({hash: content})
+        return hash
+
+    def put_many(self, contents):
+        """
+            Store the contents of the dictionary *contents*, which maps
+            hashes to contents, that are not stored yet. Blobs that are
+            stored already count as new again, so `collect_garbage` leaves
+            them alone while the variant using them is being saved.
+        """
+        contents = _contents(contents)
+        if contents:
+            self._put_many(contents)
+
+    def path(self, hash):
+        """
+            Return the file name of the blob *hash*, or None if blobs
+            are not files.
+        """
+        return None
+
+class DatabaseBlobStore(BlobStore):
+    """
+        Keeps blobs in the `Blob` table.
+    """
+    def _get_many(self, hashes):
+        from nirvana.pkg.models import Blob
+        result = {}
+        for i in xrange(0, len(hashes), BATCH_SIZE):
+            result.update(Blob.objects.filter(hash__in=hashes[i:i + BATCH_SIZE]).values_list('hash', 'content'))
+        return result
+
+    def _put_many(self, contents):
+        from nirvana.pkg.models import Blob
+        hashes = contents.keys()
+        existing = set()
+        for i in xrange(0, len(hashes), BATCH_SIZE):
+            batch = list(Blob.objects.filter(hash__in=hashes[i:i + BATCH_SIZE]).values_list('hash', flat=True))
+            if batch:
+                Blob.objects.filter(hash__in=batch).update(created=datetime.now())
+                existing.update(batch)
+        for hash, content in contents.iteritems():
+            if hash in existing:
+                continue
+            # someone else may be storing the same content right now.
+            sid = transaction.savepoint()
+            try:
+                Blob(hash=hash, content=content).save(force_insert=True)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+            else:
+                transaction.savepoint_commit(sid)
+        transaction.commit_unless_managed()
+
+    def hashes(self):
+        from nirvana.pkg.models import Blob
+        return Blob.objects.values_list('hash', flat=True).iterator()
+
+    def delete_many(self, hashes, min_age):
+        from nirvana.pkg.models import Blob
+        qn = connection.ops.quote_name
+        count = 0
+        limit = datetime.now() - timedelta(seconds=min_age)
+        cursor = connection.cursor()
+        for i in xrange(0, len(hashes), BATCH_SIZE):
+            batch = hashes[i:i + BATCH_SIZE]
+            # the references are checked again by the same statement, in
+            # case a new variant refers to a blob since they were read.
+            cursor.execute('DELETE FROM %s WHERE %s IN (%s) AND %s < %%s AND %s NOT IN (%s)' % (
+                    qn(Blob._meta.db_table), qn('hash'), ', '.join(['%s'] * len(batch)),
+                    qn('created'), qn('hash'), _references_sql()), batch + [connection.ops.value_to_db_datetime(limit)])
+            count += cursor.rowcount
+        transaction.commit_unless_managed()
+        return count
+
+class FileBlobStore(BlobStore):
+    """
+        Keeps blobs as files below the directory *root*.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, hash):
+        return os.path.join(self.root, hash[:2], hash[2:])
+
+    def _get_many(self, hashes):
+        result = {}
+        for hash in hashes:
+            try:
+                f = open(self.path(hash), 'rb')
+            except IOError:
+                continue
+            try:
+                result[hash] = f.read().decode('utf-8')
+            finally:
+                f.close()
+        return result
+
+    def _put_many(self, contents):
+        for hash, content in contents.iteritems():
+            path = self.path(hash)
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+            else:
+                continue
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # created in the meantime.
+                    pass
+            # write to a temporary file first, so no one sees half a blob.
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+            try:
+                f = os.fdopen(fd, 'wb')
+                try:
+                    f.write(content.encode('utf-8'))
+                finally:
+                    f.close()
+                os.chmod(tmp, 0644)
+                os.rename(tmp, path)
+            except:
+                os.unlink(tmp)
+                raise
+
+    def hashes(self):
+        if not os.path.isdir(self.root):
+            return
+        for directory in sorted(os.listdir(self.root)):
+            if len(directory) != 2 or not os.path.isdir(os.path.join(self.root, directory)):
+                continue
+            for name in os.listdir(os.path.join(self.root, directory)):
+                if not name.startswith('.'):
+                    yield directory + name
+
+    def delete_many(self, hashes, min_age):
+        count = 0
+        limit = time.time() - min_age
+        for i in xrange(0, len(hashes), BATCH_SIZE):
+            batch = hashes[i:i + BATCH_SIZE]
+            # the references are checked again before the modification
+            # times, which a new variant refreshes before it is saved.
+            referenced = get_referenced(batch)
+            for hash in batch:
+                if hash in referenced:
+                    continue
+                path = self.path(hash)
+                try:
+                    if os.path.getmtime(path) < limit:
+                        os.unlink(path)
+                        count += 1
+                except OSError:
+                    pass
+        return count
+
+def _reference_columns():
+    from nirvana.pkg.models import Variant, Manifest
+    return [(Variant, 'usefile_hash'), (Variant, 'checksums_hash'), (Variant, 'checksums_signature_hash'),
+            (Manifest, 'content_hash'), (Manifest, 'signature_hash')]
+
+def _references_sql():
+    """
+        Return a subquery selecting the hashes of all blobs that variants
+        and manifests refer to.
+    """
+    qn = connection.ops.quote_name
+    return ' UNION '.join('SELECT %s FROM %s WHERE %s IS NOT NULL' % (
+            qn(column), qn(model._meta.db_table), qn(column)) for model, column in _reference_columns())
+
+def get_referenced(hashes):
+    """
+        Return the set of those of *hashes* that variants or manifests
+        refer to.
+    """
+    referenced = set()
+    for model, column in _reference_columns():
+        for i in xrange(0, len(hashes), BATCH_SIZE):
+            referenced.update(model.objects.filter(**{'%s__in' % column: hashes[i:i + BATCH_SIZE]})
+                    .values_list(column, flat=True))
+    return referenced
+
+_store = None
+
+def get_blob_store():
+    """
+        Return the blob store configured by `BLOB_STORAGE`.
+    """
+    global _store
+    if _store is None:
+        root = getattr(settings, 'BLOB_STORAGE', None)
+        if root:
+            _store = FileBlobStore(root)
+        else:
+            _store = DatabaseBlobStore()
+    return _store
+
+def get_sendfile_header():
+    """
+        Return the header telling the web server which file to send,
+        e.g. ``X-Sendfile`` or ``X-Accel-Redirect``, or None.
+    """
+    return getattr(settings, 'BLOB_SENDFILE_HEADER', None)
+
+def blob_response(request, hash, mimetype):
+    """
+        Return a response with the content of the blob *hash*. Blobs in
+        files are sent by the web server if there is a sendfile header,
+        and large ones are streamed; all others are read and compressed.
+    """
+    store = get_blob_store()
+    path = store.path(hash)
+    if path is not None and hash not in ('', EMPTY_HASH):
+        header = get_sendfile_header()
+        if header:
+            response = HttpResponse('', mimetype=mimetype)
+            # e.g. the internal location of nginx serving `BLOB_STORAGE`.
+            prefix = getattr(settings, 'BLOB_SENDFILE_PREFIX', None)
+            if prefix:
+                response[header] = prefix.rstrip('/') + '/' + os.path.relpath(path, store.root).replace(os.sep, '/')
+            else:
+                response[header] = path
+            return response
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            raise BlobNotFound('No blob %s' % hash)
+        if size >= STREAM_MIN_SIZE:
+            response = HttpResponse(FileWrapper(open(path, 'rb'), CHUNK_SIZE), mimetype=mimetype)
+            response['Content-Length'] = str(size)
+            return response
+    return compress_response(request, HttpResponse(store.get(hash), mimetype=mimetype))
+
+def get_contents(hashes):
+    """
+        Return a dictionary mapping those of *hashes* that are stored to
+        their contents, like `BlobStore.get_many`. Blobs missing on the
+        replica, e.g. because they are newer, are read from the primary.
+    """
+    from nirvana.pkg.databases import primary
+    store = get_blob_store()
+    contents = store.get_many(hashes)
+    missing = [hash for hash in hashes if hash not in contents]
+    if missing:
+        with primary():
+            contents.update(store.get_many(missing))
+    return contents
+
+def collect_garbage(min_age=60 * 60):
+    """
+        Delete the blobs no variant or manifest refers to any more that are
+        older than *min_age* seconds (younger ones may belong to a variant
+        that is being saved; storing a blob again makes it young again).
+        References are checked again right before deleting. Return the
+        number of deleted blobs.
+    """
+    from nirvana.pkg.models import Variant, Manifest
+    referenced = set()
+    for hashes in Variant.objects.values_list('usefile_hash', 'checksums_hash', 'checksums_signature_hash').iterator():
+        referenced.update(hashes)
+    for hashes in Manifest.objects.values_list('content_hash', 'signature_hash'):
+        referenced.update(hashes)
+    store = get_blob_store()
+    return store.delete_many([hash for hash in store.hashes() if hash not in referenced], min_age)
@@ -0,0 +1,226 @@
+"""
+    Read-through cache for the serialized responses of read-only views.
+
+    Every cached response belongs to one or more namespaces (e.g. a package).
+    Each namespace has a random generation token that is part of the cache
+    keys, so invalidating a namespace only means replacing its token; the
+    old entries are never hit again and expire on their own.
+
+    The cache has to be shared by all processes (e.g. memcached), or an
+    invalidation only reaches the process that made the change. Nothing
+    is cached by default.
+
+    Generation tokens start with the time they were created. Responses of
+    namespaces changed less than `REPLICA_LAG` seconds ago are read from
+    the primary database rather than a replica that may still be behind,
+    see `nirvana.pkg.databases`.
+"""
+import time
+import random
+import hashlib
+import threading
+from functools import wraps
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags, parse_http_date_safe
+
+from nirvana.pkg.stuff import is_not_modified, not_modified_response, set_validators, strip_coding
+from nirvana.pkg.encoding import choose_encoding
+from nirvana.pkg.blobs import get_sendfile_header
+from nirvana.pkg.databases import get_replica, get_replica_lag, primary
+
+# nothing is cached unless a backend is configured: a cache living in one
+# process would keep serving stale responses in all the others.
+DEFAULT_BACKEND = 'dummy://'
+
+# schemes of the backends that live in one process.
+LOCAL_BACKENDS = ('dummy', 'locmem', 'nirvana.pkg.lrucache')
+
+# generation tokens should outlive all entries.
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+_caches = {}
+
+def _get_backend():
+    return getattr(settings, 'PKG_CACHE_BACKEND', None) or DEFAULT_BACKEND
+
+def get_response_cache():
+    """
+        Return the cache backend configured by `PKG_CACHE_BACKEND`, which is
+        a Django cache backend uri like ``memcached://127.0.0.1:11211/`` or
+        ``file:///var/tmp/nirvana``.
+    """
+    backend = _get_backend()
+    if backend not in _caches:
+        _caches[backend] = get_cache(backend)
+    return _caches[backend]
+
+def is_cache_enabled():
+    return not _get_backend().startswith('dummy:')
+
+def is_shared_cache():
+    """
+        Return whether the cache is shared by all processes, so what one
+        process invalidates is gone for the others as well.
+    """
+    return _get_backend().split(':', 1)[0] not in LOCAL_BACKENDS
+
+class CacheStats(object):
+    """
+        Per-process hit and miss counters.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.hits = self.misses = self.invalidations = 0
+
+    def count(self, attr):
+        self.lock.acquire()
+        try:
+            setattr(self, attr, getattr(self, attr) + 1)
+        finally:
+            self.lock.release()
+
+    def as_dict(self):
+        return {'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations}
+
+stats = CacheStats()
+
+def _new_generation():
+    return '%08x%08x' % (int(time.time()), random.getrandbits(32))
+
+def _generation_time(generation):
+    # tokens of older versions have no time.
+    if len(generation) != 16:
+        return 0
+    return int(generation[:8], 16)
+
+def changed_recently(generations, seconds):
+    """
+        Return whether any of the generation tokens *generations* was
+        created less than *seconds* ago.
+    """
+    limit = time.time() - seconds
+    return any(_generation_time(generation) >= int(limit) for generation in generations)
+
+def _get_generation(namespace):
+    key = 'nirvana:gen:%s' % namespace
+    generation = get_response_cache().get(key)
+    if generation is None:
+        generation = _new_generation()
+        get_response_cache().set(key, generation, GENERATION_TIMEOUT)
+    return generation
+
+def get_generations(namespaces):
+    """
+        Return a dictionary mapping each of *namespaces* to its current
+        generation token, with one cache round trip.
+    """
+    keys = dict(('nirvana:gen:%s' % namespace, namespace) for namespace in namespaces)
+    found = get_response_cache().get_many(keys.keys())
+    generations = {}
+    for key, namespace in keys.iteritems():
+        generation = found.get(key)
+        if generation is None:
+            generation = _new_generation()
+            get_response_cache().set(key, generation, GENERATION_TIMEOUT)
+        generations[namespace] = generation
+    return generations
+
+def invalidate(*namespaces):
+    """
+        Drop all cached responses belonging to any of *namespaces*.
+    """
+    for namespace in namespaces:
+        get_response_cache().set('nirvana:gen:%s' % namespace, _new_generation(), GENERATION_TIMEOUT)
+        stats.count('invalidations')
+
+def package_namespace(slug):
+    return 'package:%s' % slug
+
+CATEGORIES_NAMESPACE = 'categories'
+
+def _get_key(request, generations):
+    generations = ':'.join(generations)
+    path = hashlib.md5(request.get_full_path().encode('utf-8')).hexdigest()
+    # compressed responses are cached separately for each content coding.
+    return 'nirvana:view:%s:%s:%s' % (generations, path, choose_encoding(request) or 'identity')
+
+def _to_entry(response):
+    """
+        Return the cacheable parts of *response*, or None if it should not
+        be cached. Only successful responses have an ETag. Streamed responses
+        and those sent by the web server are not cached.
+    """
+    if response.status_code != 200 or not response.has_header('ETag') or not response._is_string:
+        return None
+    header = get_sendfile_header()
+    if header and response.has_header(header):
+        return None
+    last_modified = None
+    if response.has_header('Last-Modified'):
+        last_modified = parse_http_date_safe(response['Last-Modified'])
+        if last_modified is not None:
+            last_modified = datetime.utcfromtimestamp(last_modified)
+    return {
+        'content': response.content,
+        'content_type': response['Content-Type'],
+        'content_encoding': response.get('Content-Encoding', None),
+        'etag': strip_coding(parse_etags(response['ETag'])[0]),
+        'last_modified': last_modified,
+    }
+
+def _from_entry(request, entry):
+    if is_not_modified(request, entry['etag'], entry['last_modified']):
+        response = not_modified_response(request, entry['etag'], entry['last_modified'])
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+    response = HttpResponse(entry['content'], content_type=entry['content_type'])
+    if entry.get('content_encoding'):
+        response['Content-Encoding'] = entry['content_encoding']
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return set_validators(response, entry['etag'], entry['last_modified'])
+
+def cached_view(get_namespaces):
+    """
+        Cache the responses of the decorated view. *get_namespaces* is
+        called with the view's arguments and returns the namespaces
+        the response depends on.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrap(request, *a, **kw):
+            if request.method not in ('GET', 'HEAD') or not is_cache_enabled():
+                return func(request, *a, **kw)
+            generations = [_get_generation(namespace) for namespace in get_namespaces(*a, **kw)]
+            key = _get_key(request, generations)
+            entry = get_response_cache().get(key)
+            if entry is not None:
+                stats.count('hits')
+                return _from_entry(request, entry)
+            stats.count('misses')
+            if get_replica() is not None and changed_recently(generations, get_replica_lag()):
+                # the replica may not have the change yet, and the stale
+                # response would be cached for the new generation.
+                with primary():
+                    response = func(request, *a, **kw)
+            else:
+                response = func(request, *a, **kw)
+            entry = _to_entry(response)
+            if entry is not None:
+                get_response_cache().set(key, entry)
+            return response
+        return wrap
+    return decorator
+
+def categories_cached(func):
+    return cached_view(lambda *a, **kw: [CATEGORIES_NAMESPACE])(func)
+
+def package_cached(func):
+    return cached_view(lambda slug, *a, **kw: [package_namespace(slug)])(func)
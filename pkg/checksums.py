@@ -0,0 +1,126 @@
+"""
+    Parsing of checksum lists and the index of the files variants ship.
+
+    A checksums file lists one file per line, either in the format of
+    ``md5sum``, ``sha1sum`` and ``sha256sum`` or in the BSD format::
+
+        d41d8cd98f00b204e9800998ecf8427e  helloworld.ooc
+        da39a3ee5e6b4b0d3255bfef95601890afd80709 *helloworld.png
+        SHA256 (source/main.ooc) = e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855
+
+    The algorithm is told by the length of the hash. Submitted lists are
+    normalized to the first format with lowercase hashes, so that is what
+    gets signed. Every line is stored as a `Checksum` row, which answers
+    which variants ship a file with a given hash (see `find_files`).
+"""
+import re
+
+from django.db import connection, transaction
+
+from nirvana.pkg.models import Checksum
+from nirvana.pkg.usefile import _iter_lines
+
+# maps the lengths of hex digests to their algorithms.
+ALGORITHMS = {
+    32: 'md5',
+    40: 'sha1',
+    64: 'sha256',
+}
+
+# the length of `Checksum.filename`.
+MAX_FILENAME_LENGTH = 255
+
+_gnu_re = re.compile(r'^([0-9a-fA-F]+) [ *](.+)$')
+_bsd_re = re.compile(r'^(\w+) ?\((.+)\) ?= ?([0-9a-fA-F]+)$')
+
+class InvalidChecksums(Exception):
+    pass
+
+class ChecksumsSyntaxError(InvalidChecksums):
+    def __init__(self, lineno, message):
+        InvalidChecksums.__init__(self, 'Checksums line %d: %s' % (lineno, message))
+        self.lineno = lineno
+
+def parse_checksums(source):
+    """
+        Parse the checksum list *source* (a string, a file or any other
+        iterable of lines) and return a list of (algorithm, hash, file
+        name) tuples. Empty lines and lines starting with ``#`` are
+        ignored.
+
+        Raise `ChecksumsSyntaxError` for malformed lines, unknown hash
+        lengths, overlong file names and files that are listed twice.
+    """
+    entries = []
+    seen = set()
+    for lineno, line in enumerate(_iter_lines(source), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        match = _gnu_re.match(line)
+        if match is not None:
+            hash, filename = match.groups()
+            name = None
+        else:
+            match = _bsd_re.match(line)
+            if match is None:
+                raise ChecksumsSyntaxError(lineno, "Expected 'hash  file name', got %r." % line)
+            name, filename, hash = match.groups()
+        algorithm = ALGORITHMS.get(len(hash))
+        if algorithm is None:
+            raise ChecksumsSyntaxError(lineno, 'Unknown hash length %d, expected md5, sha1 or sha256.' % len(hash))
+        if name is not None and name.lower() != algorithm:
+            raise ChecksumsSyntaxError(lineno, '%s is no %s hash.' % (hash, name))
+        if len(filename) > MAX_FILENAME_LENGTH:
+            raise ChecksumsSyntaxError(lineno, 'The file name is longer than %d characters.' % MAX_FILENAME_LENGTH)
+        if filename in seen:
+            raise ChecksumsSyntaxError(lineno, '%s is listed twice.' % filename)
+        seen.add(filename)
+        entries.append((algorithm, hash.lower(), filename))
+    return entries
+
+def format_checksums(entries):
+    return u''.join(u'%s  %s\n' % (hash, filename) for algorithm, hash, filename in entries)
+
+def normalize_checksums(source):
+    """
+        Return the checksum list *source* in the normalized format. Raise
+        `InvalidChecksums` if it is malformed.
+    """
+    return format_checksums(parse_checksums(source))
+
+def update_checksums(variants, contents=None):
+    """
+        Replace the `Checksum` rows of the saved *variants* with the
+        entries of their checksum lists. Malformed lists, e.g. of variants
+        submitted before they were checked, have no entries. *contents*
+        may map the hashes of the lists to the lists, e.g. read with one
+        `BlobStore.get_many`; others are read one by one.
+    """
+    Checksum.objects.filter(variant__in=[variant.id for variant in variants]).delete()
+    rows = []
+    for variant in variants:
+        source = None
+        if contents is not None:
+            source = contents.get(variant.get_hash('checksums'))
+        if source is None:
+            source = variant.checksums
+        try:
+            entries = parse_checksums(source)
+        except InvalidChecksums:
+            continue
+        rows.extend((variant.id, algorithm, hash, filename) for algorithm, hash, filename in entries)
+    if rows:
+        qn = connection.ops.quote_name
+        connection.cursor().executemany('INSERT INTO %s (%s, %s, %s, %s) VALUES (%%s, %%s, %%s, %%s)' % (
+                qn(Checksum._meta.db_table), qn('variant_id'), qn('algorithm'), qn('hash'), qn('filename')),
+                rows)
+        transaction.commit_unless_managed()
+
+def find_files(hash):
+    """
+        Return the `Checksum` rows of the files with the hash *hash*, with
+        their variants and versions.
+    """
+    return Checksum.objects.filter(hash=hash.lower()).select_related('variant__version') \
+            .order_by('variant__version__package', 'variant__version__version_key', 'variant__slug', 'filename')
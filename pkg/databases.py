@@ -0,0 +1,246 @@
+"""
+    Database tuning and read replicas.
+
+    SQLite connections are switched to WAL mode, so reads don't wait for
+    writes, and wait up to 20 seconds for locks instead of failing with
+    "database is locked". The pragmas can be changed with the
+    `SQLITE_PRAGMAS` setting.
+
+    All databases but ``default`` (or those listed in `DATABASE_REPLICAS`)
+    are read replicas of it. `ReplicaRouter` and `ReplicaMiddleware` send
+    the queries of the views decorated with `read_only` to a replica and
+    everything else to the primary; streamed response bodies keep reading
+    from the replica of their request. A client that just changed something
+    reads from the primary for `REPLICA_LAG` seconds (default: 5), so it
+    sees its own writes: browsers are recognized by a cookie, api clients
+    by their login or their address. The address is the one forwarded by
+    the proxies listed in `TRUSTED_PROXIES`, if the request comes from
+    one. Logins and addresses are only remembered if the response cache
+    is shared by all processes, see `nirvana.pkg.cache`.
+
+    `on_commit` defers work that other connections have to see the changes
+    of, like signing in the background, until the transaction is committed.
+
+    For pooled PostgreSQL connections see
+    `nirvana.pkg.backends.postgresql_psycopg2`.
+"""
+import random
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.backends.signals import connection_created
+
+DEFAULT_DB = 'default'
+
+DEFAULT_SQLITE_PRAGMAS = (
+    ('busy_timeout', 20000),
+    ('journal_mode', 'WAL'),
+    # safe in WAL mode, only the last transactions may be lost on power loss.
+    ('synchronous', 'NORMAL'),
+)
+
+DEFAULT_REPLICA_LAG = 5
+
+PIN_COOKIE = 'nirvana_primary'
+
+_state = threading.local()
+
+def configure_sqlite(sender, connection, **kwargs):
+    if not connection.settings_dict['ENGINE'].endswith('sqlite3'):
+        return
+    cursor = connection.connection.cursor()
+    for name, value in getattr(settings, 'SQLITE_PRAGMAS', DEFAULT_SQLITE_PRAGMAS):
+        cursor.execute('PRAGMA %s = %s' % (name, value))
+    cursor.close()
+
+connection_created.connect(configure_sqlite, dispatch_uid='nirvana.pkg.databases.configure_sqlite')
+
+def _hook_transactions(db):
+    """
+        Make the database wrapper *db* call the `on_commit` callbacks after
+        a commit and forget them on a rollback. Database wrappers are
+        thread-local, so this has to be done in every thread.
+    """
+    if hasattr(db, '_commit_callbacks'):
+        return
+    db._commit_callbacks = []
+    commit, rollback, close = db._commit, db._rollback, db.close
+    def _commit():
+        result = commit()
+        callbacks, db._commit_callbacks = db._commit_callbacks, []
+        for callback in callbacks:
+            callback()
+        return result
+    def forget(method):
+        def wrapper():
+            db._commit_callbacks = []
+            return method()
+        return wrapper
+    db._commit, db._rollback, db.close = _commit, forget(rollback), forget(close)
+
+def on_commit(callback, using=DEFAULT_DB):
+    """
+        Call *callback* once the current transaction of the database
+        *using* is committed, or right away if no transaction is managed.
+        If the transaction is rolled back, *callback* is never called.
+    """
+    if not transaction.is_managed(using=using):
+        callback()
+        return
+    db = connections[using]
+    _hook_transactions(db)
+    db._commit_callbacks.append(callback)
+
+def get_replicas():
+    """
+        Return the aliases of the read replicas.
+    """
+    replicas = getattr(settings, 'DATABASE_REPLICAS', None)
+    if replicas is None:
+        replicas = [alias for alias in settings.DATABASES if alias != DEFAULT_DB]
+    return replicas
+
+def get_replica_lag():
+    return getattr(settings, 'REPLICA_LAG', DEFAULT_REPLICA_LAG)
+
+def get_replica():
+    """
+        Return the alias of the replica the current thread reads from, or
+        None if it reads from the primary.
+    """
+    return getattr(_state, 'replica', None)
+
+@contextmanager
+def primary():
+    """
+        Read from the primary in the with block.
+    """
+    replica = get_replica()
+    _state.replica = None
+    try:
+        yield
+    finally:
+        _state.replica = replica
+
+def read_only(func):
+    """
+        Mark the view *func* as read-only, so its queries may go to a replica.
+        Has to be the outermost decorator.
+    """
+    func.read_only = True
+    return func
+
+class ReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        return get_replica() or DEFAULT_DB
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # all databases hold the same data.
+        return True
+
+    def allow_syncdb(self, db, model):
+        return db == DEFAULT_DB or db not in get_replicas()
+
+def get_client_address(request):
+    """
+        Return the address of the client of *request*. Requests of the
+        proxies listed in `TRUSTED_PROXIES` are made for the last address
+        in their X-Forwarded-For header that is not a proxy. Returns None
+        if a proxy did not forward the address.
+    """
+    proxies = getattr(settings, 'TRUSTED_PROXIES', ())
+    address = request.META.get('REMOTE_ADDR') or None
+    forwarded = [item.strip() for item in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')]
+    while address in proxies:
+        address = forwarded and forwarded.pop() or None
+    return address
+
+def _pin_key(request):
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated():
+        return 'nirvana:pin:user:%d' % user.id
+    address = get_client_address(request)
+    if address is None:
+        return None
+    return 'nirvana:pin:address:%s' % address
+
+def _get_pin_cache():
+    """
+        Return the response cache if it is shared by all processes, so the
+        next request may be served by any of them, otherwise None.
+    """
+    from nirvana.pkg.cache import get_response_cache, is_shared_cache
+    if is_shared_cache():
+        return get_response_cache()
+    return None
+
+def is_pinned(request):
+    """
+        Return whether the client of *request* changed something recently
+        and has to read from the primary.
+    """
+    if PIN_COOKIE in request.COOKIES:
+        return True
+    cache, key = _get_pin_cache(), _pin_key(request)
+    return cache is not None and key is not None and cache.get(key) is not None
+
+def pin(request, response):
+    """
+        Make the client of *request* read from the primary for the next
+        `REPLICA_LAG` seconds.
+    """
+    lag = get_replica_lag()
+    response.set_cookie(PIN_COOKIE, '1', max_age=lag)
+    cache, key = _get_pin_cache(), _pin_key(request)
+    if cache is not None and key is not None:
+        cache.set(key, 1, lag)
+
+class ReplicaIterator(object):
+    """
+        Iterate over *iterable* reading from *replica*. Streamed response
+        bodies are read after `ReplicaMiddleware` is done with the request,
+        so their queries would go to the primary otherwise.
+    """
+    def __init__(self, iterable, replica):
+        self.iterable = iterable
+        self.iterator = iter(iterable)
+        self.replica = replica
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        previous, _state.replica = get_replica(), self.replica
+        try:
+            return self.iterator.next()
+        finally:
+            _state.replica = previous
+
+    def close(self):
+        if hasattr(self.iterable, 'close'):
+            self.iterable.close()
+
+class ReplicaMiddleware(object):
+    def process_request(self, request):
+        _state.replica = None
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.read_only = getattr(view_func, 'read_only', False)
+        replicas = get_replicas()
+        if request.read_only and replicas and not is_pinned(request):
+            # one replica per request, so it sees a consistent state.
+            _state.replica = random.choice(replicas)
+
+    def process_response(self, request, response):
+        replica, _state.replica = get_replica(), None
+        if replica is not None and not response._is_string:
+            response._container = ReplicaIterator(response._container, replica)
+        if request.method == 'POST' and not getattr(request, 'read_only', False) \
+                and response.status_code < 400 and get_replicas():
+            pin(request, response)
+        return response
@@ -0,0 +1,139 @@
+"""
+    The dependency graph of variants.
+
+    The "Requires" field of a usefile lists the packages a variant needs,
+    optionally with a version constraint (see `nirvana.pkg.versions`)::
+
+        Requires: sdk, gtk >=2.0, sdl (>=1.2, <2)
+
+    The requirements are stored as `Dependency` rows whenever the usefile
+    of a variant changes. `get_dependencies` resolves the transitive
+    closure of a variant: a required package is satisfied by the variant
+    with the same slug of its newest matching version. Closures are cached
+    until one of the packages they touch changes.
+"""
+from django.db import connection, transaction
+from django.db.models import Q
+
+from nirvana.pkg.models import Variant, Dependency
+from nirvana.pkg.usefile import parse_requires, InvalidUsefile
+from nirvana.pkg.versions import constraint_filter
+from nirvana.pkg.cache import get_response_cache, get_generations, invalidate, package_namespace, stats
+
+# bounds how long a closure can be stale if a package changes while
+# the closure is being resolved.
+CLOSURE_TIMEOUT = 60 * 5
+
+def get_requirements(variant):
+    """
+        Return the (package slug, constraint) tuples *variant* requires.
+        Malformed requirements are ignored.
+    """
+    requirements = []
+    for requires in variant.get_usefile_fields().getlist('Requires'):
+        try:
+            requirements.extend(parse_requires(requires))
+        except InvalidUsefile:
+            pass
+    return requirements
+
+def update_dependencies(variants, invalidate_packages=True):
+    """
+        Replace the dependencies of the saved *variants* with the
+        requirements of their usefiles.
+    """
+    Dependency.objects.filter(variant__in=[variant.id for variant in variants]).delete()
+    rows = [(variant.id, slug, constraint) for variant in variants
+                for slug, constraint in get_requirements(variant)]
+    if rows:
+        qn = connection.ops.quote_name
+        connection.cursor().executemany('INSERT INTO %s (%s, %s, %s) VALUES (%%s, %%s, %%s)' % (
+                qn(Dependency._meta.db_table), qn('variant_id'), qn('package_slug'), qn('version_constraint')),
+                rows)
+        transaction.commit_unless_managed()
+    if invalidate_packages:
+        invalidate(*set(package_namespace(variant.version.package_id) for variant in variants))
+
+def resolve_dependencies(variant, pre_releases=False):
+    """
+        Resolve the transitive dependencies of *variant*, breadth-first
+        with one query for the edges and one for the candidates per level.
+        The first (closest) requirement of a package decides its version;
+        requirements of a package on the same level have to be met all.
+
+        Return a tuple (resolved dependencies, unresolved requirements,
+        slugs of all packages involved).
+    """
+    root = variant.version.package_id
+    chosen = set([root])
+    # maps the variants whose requirements are to be resolved next to their packages.
+    frontier = {variant.id: root}
+    resolved = []
+    unresolved = []
+    while frontier:
+        required = {}
+        order = []
+        for variant_id, slug, constraint in Dependency.objects.filter(variant__in=frontier.keys()) \
+                .order_by('id').values_list('variant', 'package_slug', 'version_constraint'):
+            if slug in chosen:
+                continue
+            if slug not in required:
+                order.append(slug)
+                required[slug] = []
+            required[slug].append((constraint, frontier[variant_id]))
+        if not required:
+            break
+        q = None
+        for slug in order:
+            current = Q(version__package=slug)
+            for constraint, required_by in required[slug]:
+                current &= constraint_filter(constraint, pre_releases, 'version__')
+            if q is None:
+                q = current
+            else:
+                q = q | current
+        best = {}
+        for id, slug, version_slug, key in Variant.objects.filter(q, slug=variant.slug) \
+                .values_list('id', 'version__package', 'version__slug', 'version__version_key'):
+            if slug not in best or key > best[slug][2]:
+                best[slug] = (id, version_slug, key)
+        frontier = {}
+        for slug in order:
+            chosen.add(slug)
+            result = {
+                'package': slug,
+                'constraint': ','.join(constraint for constraint, required_by in required[slug]),
+                'required_by': sorted(set(required_by for constraint, required_by in required[slug])),
+            }
+            if slug in best:
+                id, version_slug, key = best[slug]
+                frontier[id] = slug
+                result.update({'version': version_slug, 'variant': variant.slug})
+                resolved.append(result)
+            else:
+                unresolved.append(result)
+    return resolved, unresolved, chosen
+
+def get_dependencies(variant, pre_releases=False):
+    """
+        Return a dictionary describing the resolved dependencies of
+        *variant*, see `resolve_dependencies`.
+    """
+    cache = get_response_cache()
+    key = 'nirvana:deps:%d:%d' % (variant.id, bool(pre_releases))
+    entry = cache.get(key)
+    if entry is not None and get_generations(entry['generations'].keys()) == entry['generations']:
+        stats.count('hits')
+        return entry['result']
+    stats.count('misses')
+    resolved, unresolved, packages = resolve_dependencies(variant, pre_releases)
+    result = {
+        'package': variant.version.package_id,
+        'version': variant.version.slug,
+        'variant': variant.slug,
+        'dependencies': resolved,
+        'unresolved': unresolved,
+    }
+    generations = get_generations([package_namespace(slug) for slug in packages])
+    cache.set(key, {'generations': generations, 'result': result}, CLOSURE_TIMEOUT)
+    return result
@@ -0,0 +1,150 @@
+"""
+    Fast url resolution for the ``packages/`` and ``api/packages/`` trees.
+
+    Django tries the regular expressions of a urlconf one after another.
+    The download and api urls get most of the traffic, so a
+    `SegmentDispatcher` splits their paths at the slashes once and picks the
+    view by the number and values of the segments instead. The regular
+    expressions are kept for reversing urls and for `flatten`, which
+    returns the plain regex urlconf (used by the benchmark as comparison).
+
+    Segments are positional, so version and variant slugs can't be mixed
+    up; only ``latest`` (and ``resolve`` in the api) is no version slug,
+    see `nirvana.pkg.stuff.RESERVED_VERSION_SLUGS`.
+"""
+import re
+
+from django.core.urlresolvers import RegexURLResolver, RegexURLPattern, get_callable
+
+slug_re = re.compile(r'^[-\w]+$', re.UNICODE)
+version_slug_re = re.compile(r'^[-\w.]+$', re.UNICODE)
+
+LATEST = 'latest'
+
+# maps the extensions of the download files to their views, which get the
+# file name (without extension) as keyword argument of the same name.
+FILE_VIEWS = {
+    'use': 'usefile',
+    'checksums': 'checksums',
+    'checksums.sig': 'checksums_signature',
+}
+
+def _version(segment):
+    """
+        Return the version slug of a path segment (None for ``latest``), or
+        raise ValueError if it is none.
+    """
+    if segment == LATEST:
+        return None
+    if not version_slug_re.match(segment):
+        raise ValueError(segment)
+    return segment
+
+def route_packages(segments):
+    """
+        Return (view name, keyword arguments) for the segments of a path
+        below ``packages/``, or None.
+    """
+    slug = segments[0]
+    count = len(segments)
+    if not 2 <= count <= 4 or not slug_re.match(slug):
+        return None
+    if count == 2:
+        if segments[1]:
+            return None
+        return 'package', {'slug': slug}
+    version_slug = _version(segments[1])
+    if count == 3:
+        if segments[2]:
+            return None
+        return 'version', {'slug': slug, 'version_slug': version_slug}
+    variant_slug = segments[2]
+    if not version_slug_re.match(variant_slug):
+        return None
+    kwargs = {'slug': slug, 'version_slug': version_slug, 'variant_slug': variant_slug}
+    if not segments[3]:
+        return 'variant', kwargs
+    name, _, extension = segments[3].partition('.')
+    view = FILE_VIEWS.get(extension)
+    if view is None or not slug_re.match(name):
+        return None
+    kwargs[view] = name
+    return view, kwargs
+
+def route_api_packages(segments):
+    """
+        Return (view name, keyword arguments) for the segments of a path
+        below ``api/packages/``, or None.
+    """
+    slug = segments[0]
+    count = len(segments)
+    if not 2 <= count <= 5 or not slug_re.match(slug) or segments[-1]:
+        # all api urls end with a slash.
+        return None
+    if count == 2:
+        return 'api_package', {'slug': slug}
+    if count == 3 and segments[1] == 'resolve':
+        return 'api_package_resolve', {'slug': slug}
+    version_slug = _version(segments[1])
+    if count == 3:
+        return 'api_version', {'slug': slug, 'version_slug': version_slug}
+    variant_slug = segments[2]
+    if not version_slug_re.match(variant_slug):
+        return None
+    kwargs = {'slug': slug, 'version_slug': version_slug, 'variant_slug': variant_slug}
+    if count == 4:
+        return 'api_variant', kwargs
+    if count == 5 and segments[3] == 'dependencies':
+        return 'api_dependencies', kwargs
+    return None
+
+class SegmentDispatcher(RegexURLResolver):
+    """
+        Resolve the paths starting with *prefix* by calling *route* with
+        their segments, which returns the name of a view in the module
+        *views* and its keyword arguments. *urlpatterns* are the equivalent
+        regex patterns (relative to *prefix*) used for reversing.
+    """
+    def __init__(self, prefix, route, views, urlpatterns):
+        super(SegmentDispatcher, self).__init__('^' + prefix, urlpatterns)
+        self.prefix = prefix
+        self.route = route
+        self.views = views
+        self._callbacks = {}
+
+    def get_callback(self, name):
+        callback = self._callbacks.get(name)
+        if callback is None:
+            callback = self._callbacks[name] = get_callable('%s.%s' % (self.views, name))
+        return callback
+
+    def resolve(self, path):
+        # no match is None rather than `Resolver404`, which is a lot slower
+        # for all the other urls.
+        if not path.startswith(self.prefix):
+            return None
+        try:
+            match = self.route(path[len(self.prefix):].split('/'))
+        except ValueError:
+            return None
+        if match is None:
+            return None
+        name, kwargs = match
+        return self.get_callback(name), (), kwargs
+
+def flatten(urlpatterns):
+    """
+        Return *urlpatterns* with the patterns of the dispatchers in them
+        resolved by regex again. They are moved to the end, where they were
+        before the dispatchers existed.
+    """
+    result = []
+    tail = []
+    for pattern in urlpatterns:
+        if isinstance(pattern, SegmentDispatcher):
+            for sub_pattern in pattern.url_patterns:
+                tail.append(RegexURLPattern(pattern.regex.pattern + sub_pattern.regex.pattern.lstrip('^'),
+                        sub_pattern.callback, sub_pattern.default_args, sub_pattern.name))
+        else:
+            result.append(pattern)
+    return result + tail
@@ -0,0 +1,146 @@
+"""
+    Response encoding: JSON serialization and HTTP compression.
+
+    `dumps` uses the fastest JSON library that is installed, or the one
+    named by the `JSON_ENCODER` setting. Responses of at least
+    `COMPRESS_MIN_SIZE` bytes (default: 512) are compressed with gzip or
+    deflate if the client accepts it, see `compress_response`.
+"""
+import gzip
+import zlib
+from cStringIO import StringIO
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+JSON_MIMETYPE = 'application/json; charset=utf-8'
+
+# in order of preference.
+JSON_ENCODERS = ('orjson', 'ujson', 'simplejson', 'json')
+
+ENCODINGS = ('gzip', 'deflate')
+
+DEFAULT_COMPRESS_MIN_SIZE = 512
+
+COMPRESS_LEVEL = 6
+
+def _get_encoder(name):
+    """
+        Return the `dumps` function of the JSON library *name*, which
+        returns a byte string. Raises ImportError if it is not installed.
+    """
+    if name == 'orjson':
+        import orjson
+        return orjson.dumps
+    elif name == 'ujson':
+        import ujson
+        return lambda obj: ujson.dumps(obj, ensure_ascii=True, escape_forward_slashes=False)
+    elif name == 'simplejson':
+        # not `django.utils.simplejson`, which may be the slow bundled copy.
+        import simplejson
+        return simplejson.dumps
+    elif name == 'json':
+        import json
+        return json.dumps
+    raise ImportError('Unknown JSON encoder: %s' % name)
+
+def get_available_encoders():
+    """
+        Return a list of (name, dumps function) pairs of all installed
+        JSON libraries, fastest first.
+    """
+    encoders = []
+    for name in JSON_ENCODERS:
+        try:
+            encoders.append((name, _get_encoder(name)))
+        except ImportError:
+            pass
+    return encoders
+
+_dumps = None
+
+def get_encoder():
+    global _dumps
+    if _dumps is None:
+        name = getattr(settings, 'JSON_ENCODER', None)
+        if name:
+            _dumps = _get_encoder(name)
+        else:
+            _dumps = get_available_encoders()[0][1]
+    return _dumps
+
+def dumps(obj):
+    """
+        Return *obj* encoded as JSON byte string.
+    """
+    return get_encoder()(obj)
+
+def _parse_accept_encoding(header):
+    """
+        Return a dictionary mapping the codings listed in the
+        Accept-Encoding *header* to their quality.
+    """
+    codings = {}
+    for item in header.split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            key, _, value = param.strip().partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        codings[coding] = quality
+    return codings
+
+def choose_encoding(request):
+    """
+        Return the content coding *request* prefers among `ENCODINGS`,
+        or None if it accepts neither.
+    """
+    codings = _parse_accept_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    best = None
+    best_quality = 0.0
+    for coding in ENCODINGS:
+        quality = codings.get(coding, codings.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+def compress(content, encoding):
+    if encoding == 'gzip':
+        buf = StringIO()
+        # no timestamp, so equal content compresses to equal bytes.
+        gz = gzip.GzipFile(mode='wb', fileobj=buf, compresslevel=COMPRESS_LEVEL, mtime=0)
+        try:
+            gz.write(content)
+        finally:
+            gz.close()
+        return buf.getvalue()
+    elif encoding == 'deflate':
+        return zlib.compress(content, COMPRESS_LEVEL)
+    raise ValueError('Unknown content coding: %s' % encoding)
+
+def compress_response(request, response):
+    """
+        Compress the content of *response* if the client accepts it and it
+        is large enough. Streaming responses are left alone.
+    """
+    patch_vary_headers(response, ('Accept-Encoding',))
+    if (response.status_code != 200 or response.has_header('Content-Encoding')
+            or not response._is_string):
+        return response
+    encoding = choose_encoding(request)
+    if encoding is None:
+        return response
+    content = response.content
+    if len(content) < getattr(settings, 'COMPRESS_MIN_SIZE', DEFAULT_COMPRESS_MIN_SIZE):
+        return response
+    response.content = compress(content, encoding)
+    response['Content-Encoding'] = encoding
+    response['Content-Length'] = str(len(response.content))
+    return response
@@ -1,6 +1,8 @@
-from django.forms import ModelForm, BooleanField, ChoiceField, ValidationError
-from django.forms.models import modelformset_factory
+from django.forms import Form, ModelForm, BooleanField, CharField, ChoiceField, IntegerField, MultipleChoiceField, CheckboxSelectMultiple, Textarea, ValidationError
+from django.forms.models import modelformset_factory, BaseModelFormSet
 from nirvana.pkg.models import Package, Version, Category, Variant, ManagerPermission
+from nirvana.pkg.tokens import SCOPES
+from nirvana.pkg.checksums import normalize_checksums, InvalidChecksums
 
 class NewPackageForm(ModelForm):
     class Meta:
@@ -24,7 +26,32 @@ class NewVersionForm(ModelForm):
 
 EditVersionForm = NewVersionForm
 
-class NewVariantForm(ModelForm):
+class VariantContentForm(ModelForm):
+    """
+        A variant form with the usefile and the checksums, which are no
+        model fields but live in the blob store.
+    """
+    usefile = CharField(widget=Textarea)
+    checksums = CharField(widget=Textarea, required=False)
+
+    def __init__(self, *args, **kwargs):
+        super(VariantContentForm, self).__init__(*args, **kwargs)
+        if self.instance.pk is not None:
+            for field in ('usefile', 'checksums'):
+                self.initial.setdefault(field, getattr(self.instance, field))
+
+    def clean_checksums(self):
+        try:
+            return normalize_checksums(self.cleaned_data['checksums'])
+        except InvalidChecksums, e:
+            raise ValidationError(unicode(e))
+
+    def save(self, commit=True):
+        for field in ('usefile', 'checksums'):
+            setattr(self.instance, field, self.cleaned_data[field])
+        return super(VariantContentForm, self).save(commit)
+
+class NewVariantForm(VariantContentForm):
     class Meta:
         model = Variant
         fields = ('slug', 'name', 'usefile', 'checksums')
@@ -36,4 +63,24 @@ class NewVariantForm(ModelForm):
 
 EditVariantForm = NewVariantForm
 
-ManagerPermissionFormSet = modelformset_factory(ManagerPermission, exclude=('package',), can_delete=True)
+class NewApiTokenForm(Form):
+    name = CharField(max_length=64, required=False)
+    scopes = MultipleChoiceField(choices=SCOPES, widget=CheckboxSelectMultiple,
+            initial=[scope for scope, description in SCOPES])
+    expires_days = IntegerField(min_value=1, required=False, label='Expires after (days)')
+
+class BaseManagerPermissionFormSet(BaseModelFormSet):
+    def clean(self):
+        # the package is excluded, so django does not check this for us.
+        seen = set()
+        for form in self.forms:
+            data = getattr(form, 'cleaned_data', None)
+            if not data or (self.can_delete and data.get('DELETE')):
+                continue
+            key = (data.get('user'), data.get('variant_slug'))
+            if key in seen:
+                raise ValidationError('A user can only be made manager of a variant once.')
+            seen.add(key)
+
+ManagerPermissionFormSet = modelformset_factory(ManagerPermission, formset=BaseManagerPermissionFormSet,
+        exclude=('package',), can_delete=True)
@@ -0,0 +1,267 @@
+"""
+    Per-request timing of database queries, template rendering, signing and
+    JSON serialization.
+
+    `InstrumentationMiddleware` records the timings of every request, adds
+    them to the response as a ``Server-Timing`` header and collects
+    per-endpoint histograms, see `get_histograms`. If the
+    `SLOW_REQUEST_THRESHOLD` setting (in milliseconds) is set, slower
+    requests are logged to the ``nirvana.slow_requests`` logger along with
+    their SQL.
+
+    Streamed response bodies (see `nirvana.pkg.listing`) are read after the
+    middleware is done. Their queries count once the body is finished, for
+    the histograms and the slow request log. The ``Server-Timing`` header
+    is sent before the body, so it leaves them out.
+"""
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.template import Template
+
+# upper bounds of the latency histogram buckets, in milliseconds.
+BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+METRICS = ('db', 'template', 'sign', 'json')
+
+logger = logging.getLogger('nirvana.slow_requests')
+
+_local = threading.local()
+
+def _get_record():
+    return getattr(_local, 'record', None)
+
+def add_timing(metric, seconds):
+    """
+        Add *seconds* to the *metric* of the current request, if any.
+    """
+    record = _get_record()
+    if record is not None:
+        record[metric] += seconds
+
+@contextmanager
+def timed(metric):
+    """
+        Measure the time spent in the with block as *metric*.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        add_timing(metric, time.time() - start)
+
+class TimingCursorWrapper(object):
+    def __init__(self, cursor, db):
+        self.cursor = cursor
+        self.db = db
+
+    def _record(self, sql, start):
+        record = _get_record()
+        if record is not None:
+            duration = time.time() - start
+            record['db'] += duration
+            record['queries'] += 1
+            if record['sql'] is not None:
+                record['sql'].append((duration, sql))
+
+    def execute(self, sql, params=()):
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self._record(sql, start)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self._record('%s times: %s' % (len(param_list), sql), start)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+def instrument_connection(db):
+    """
+        Make the database wrapper *db* time all queries. Database wrappers
+        are thread-local, so this has to be done in every thread.
+    """
+    if getattr(db, '_instrumented', False):
+        return
+    cursor = db.cursor
+    db.cursor = lambda: TimingCursorWrapper(cursor(), db)
+    db._instrumented = True
+
+_template_render = Template.render
+
+def _instrumented_render(self, context):
+    # templates render other templates, only count the outermost one.
+    depth = getattr(_local, 'template_depth', 0)
+    _local.template_depth = depth + 1
+    start = time.time()
+    try:
+        return _template_render(self, context)
+    finally:
+        _local.template_depth = depth
+        if depth == 0:
+            add_timing('template', time.time() - start)
+
+def instrument_templates():
+    Template.render = _instrumented_render
+
+class Histogram(object):
+    def __init__(self):
+        self.count = 0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.totals = dict((metric, 0.0) for metric in METRICS + ('total', 'queries'))
+
+    def add(self, record, total):
+        self.count += 1
+        ms = total * 1000
+        for i, bound in enumerate(BUCKETS):
+            if ms <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+        self.totals['total'] += total
+        self.totals['queries'] += record['queries']
+        for metric in METRICS:
+            self.totals[metric] += record[metric]
+
+    def as_dict(self):
+        buckets = dict(('<=%d' % bound, count) for bound, count in zip(BUCKETS, self.buckets))
+        buckets['>%d' % BUCKETS[-1]] = self.buckets[-1]
+        result = {'count': self.count, 'buckets': buckets}
+        for key, value in self.totals.iteritems():
+            if key == 'queries':
+                result['mean_queries'] = value / self.count
+            else:
+                result['mean_%s_ms' % key] = value * 1000 / self.count
+        return result
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+def get_histograms():
+    """
+        Return a dictionary mapping endpoint names to the histograms of
+        their requests handled by this process.
+    """
+    _histograms_lock.acquire()
+    try:
+        return dict((endpoint, histogram.as_dict()) for endpoint, histogram in _histograms.iteritems())
+    finally:
+        _histograms_lock.release()
+
+def reset_histograms():
+    _histograms_lock.acquire()
+    try:
+        _histograms.clear()
+    finally:
+        _histograms_lock.release()
+
+def format_server_timing(record, total):
+    parts = ['db;dur=%.2f;desc="%d queries"' % (record['db'] * 1000, record['queries'])]
+    for metric in METRICS[1:]:
+        parts.append('%s;dur=%.2f' % (metric, record[metric] * 1000))
+    parts.append('total;dur=%.2f' % (total * 1000))
+    return ', '.join(parts)
+
+class InstrumentationMiddleware(object):
+    def __init__(self):
+        instrument_templates()
+
+    def process_request(self, request):
+        for db in connections.all():
+            instrument_connection(db)
+        threshold = getattr(settings, 'SLOW_REQUEST_THRESHOLD', None)
+        record = dict((metric, 0.0) for metric in METRICS)
+        record.update({
+            'start': time.time(),
+            'queries': 0,
+            'endpoint': None,
+            'sql': threshold is not None and [] or None,
+        })
+        _local.record = record
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        record = _get_record()
+        if record is not None:
+            record['endpoint'] = '%s.%s' % (view_func.__module__, view_func.__name__)
+
+    def process_response(self, request, response):
+        record = _get_record()
+        if record is None:
+            return response
+        _local.record = None
+        response['Server-Timing'] = format_server_timing(record, time.time() - record['start'])
+        if response._is_string:
+            finish_record(request, record)
+        else:
+            response._container = TimedIterator(response._container, record,
+                    lambda: finish_record(request, record))
+        return response
+
+def finish_record(request, record):
+    """
+        Add the timings *record* of *request* to the histogram of its
+        endpoint and log it if it was slow.
+    """
+    total = time.time() - record['start']
+    endpoint = record['endpoint'] or 'unresolved'
+    _histograms_lock.acquire()
+    try:
+        _histograms.setdefault(endpoint, Histogram()).add(record, total)
+    finally:
+        _histograms_lock.release()
+    threshold = getattr(settings, 'SLOW_REQUEST_THRESHOLD', None)
+    if threshold is not None and total * 1000 >= threshold:
+        logger.warning('Slow request: %s %s took %.1fms (%s)\n%s' % (
+            request.method, request.get_full_path(), total * 1000,
+            format_server_timing(record, total),
+            '\n'.join('%.1fms %s' % (duration * 1000, sql) for duration, sql in record['sql'])))
+
+class TimedIterator(object):
+    """
+        Iterate over the streamed body *iterable*, recording its timings
+        in *record*, and call *finish* once it is exhausted or closed.
+    """
+    def __init__(self, iterable, record, finish):
+        self.iterable = iterable
+        self.iterator = iter(iterable)
+        self.record = record
+        self.finish = finish
+        self.finished = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        previous, _local.record = _get_record(), self.record
+        try:
+            return self.iterator.next()
+        except StopIteration:
+            self._finish()
+            raise
+        finally:
+            _local.record = previous
+
+    def _finish(self):
+        if not self.finished:
+            self.finished = True
+            self.finish()
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            self._finish()
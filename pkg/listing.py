@@ -0,0 +1,212 @@
+"""
+    Paginated and streamed API listings.
+
+    A page holds at most ``limit`` rows. The next page is selected by
+    passing the opaque ``__next`` value of the previous page as ``cursor``.
+    Query sets are paginated by their keys (e.g. slug and primary key) instead
+    of offsets, so later pages are as cheap as the first one and no rows
+    are skipped or repeated if rows are added in between.
+
+    With ``stream=json`` or ``stream=ndjson`` rows are written to the
+    client while they are read from the database instead of building
+    the whole result in memory first.
+"""
+import base64
+
+from django.db.models import Q
+from django.http import HttpResponse
+
+from nirvana.pkg.encoding import dumps, JSON_MIMETYPE
+
+MAX_LIMIT = 1000
+
+STREAM_MIMETYPES = {
+    'json': JSON_MIMETYPE,
+    'ndjson': 'application/x-ndjson',
+}
+
+# size of the chunks handed to the web server while streaming.
+CHUNK_SIZE = 16 * 1024
+
+def encode_cursor(value):
+    return base64.urlsafe_b64encode(unicode(value).encode('utf-8')).rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        return base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4)).decode('utf-8')
+    except (TypeError, UnicodeError):
+        raise Exception('Invalid cursor: %s' % cursor)
+
+def get_limit(request):
+    """
+        Return the ``limit`` parameter of *request*, or None if there is none.
+    """
+    limit = request.GET.get('limit')
+    if limit is None:
+        return None
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise Exception('Invalid limit: %s' % limit)
+    if not 0 < limit <= MAX_LIMIT:
+        raise Exception('Invalid limit: %s (must be between 1 and %d)' % (limit, MAX_LIMIT))
+    return limit
+
+def default_row(obj):
+    return {'slug': obj.slug, 'name': obj.name}
+
+class Page(object):
+    """
+        Iterate over the rows made by *row* of the first *limit* objects
+        of *objects* (or of all of them if *limit* is None). *objects*
+        should contain one more object if there is a next page; then,
+        after the iteration, `next_cursor` is the cursor of the next page,
+        calculated by *get_cursor* from the last object of this page.
+
+        *paginated* tells if the client asked for pages at all; only then
+        the result contains ``__next``.
+    """
+    def __init__(self, objects, limit=None, get_cursor=None, row=default_row, paginated=False):
+        self.objects = objects
+        self.limit = limit
+        self.get_cursor = get_cursor
+        self.row = row
+        self.paginated = paginated
+        self.next_cursor = None
+
+    def __iter__(self):
+        count = 0
+        last = None
+        for obj in self.objects:
+            if count == self.limit:
+                self.next_cursor = encode_cursor(self.get_cursor(last))
+                break
+            yield self.row(obj)
+            last = obj
+            count += 1
+
+def paginate(request, queryset, row=default_row, key='slug', fields=('slug', 'name')):
+    """
+        Return a `Page` of *queryset* ordered by the field *key* as requested
+        by the ``limit`` and ``cursor`` parameters of *request*. The objects
+        are read lazily, without filling the query set's result cache, and
+        only with the *fields* that *row* needs (and *key*).
+    """
+    queryset = queryset.only(*(tuple(fields) + (key,)))
+    limit = get_limit(request)
+    cursor = request.GET.get('cursor')
+    paginated = limit is not None or cursor is not None
+    if paginated:
+        # keys are not unique in every table, so the primary key breaks ties.
+        queryset = queryset.order_by(key, 'pk')
+        if cursor:
+            try:
+                value, pk = decode_cursor(cursor).rsplit('/', 1)
+            except ValueError:
+                raise Exception('Invalid cursor: %s' % cursor)
+            queryset = queryset.filter(Q(**{'%s__gt' % key: value}) | Q(**{key: value, 'pk__gt': pk}))
+        if limit is not None:
+            queryset = queryset[:limit + 1]
+    return Page(queryset.iterator(), limit, lambda obj: '%s/%s' % (getattr(obj, key), obj.pk), row, paginated)
+
+class Listing(object):
+    """
+        An API result listing the rows of *page*.
+
+        If *key* is None, the result is a JSON object mapping the slug of
+        each row to its name. Otherwise, it is the JSON object *fields*
+        with *key* mapped to an array of ``item(row)`` for each row.
+    """
+    def __init__(self, page, fields=None, key=None, item=lambda row: row['slug']):
+        self.page = page
+        self.fields = fields or {}
+        self.key = key
+        self.item = item
+
+    def as_dict(self):
+        result = dict(self.fields)
+        if self.key is None:
+            result.update((row['slug'], row['name']) for row in self.page)
+        else:
+            result[self.key] = [self.item(row) for row in self.page]
+        return self._finish(result)
+
+    def _finish(self, result):
+        if self.page.paginated:
+            result['__next'] = self.page.next_cursor
+        result['__result'] = 'ok'
+        return result
+
+    def _error(self, e):
+        return {'__result': 'error', '__text': getattr(e, 'message', None) or str(e)}
+
+    def iter_json(self):
+        """
+            Yield the JSON encoding of `as_dict`, piece by piece. If an
+            error happens on the way, ``__result`` is ``error``.
+        """
+        yield '{'
+        sep = ''
+        for name, value in self.fields.iteritems():
+            yield '%s%s: %s' % (sep, dumps(name), dumps(value))
+            sep = ', '
+        if self.key is not None:
+            yield '%s%s: [' % (sep, dumps(self.key))
+            sep = ''
+        try:
+            for row in self.page:
+                if self.key is None:
+                    yield '%s%s: %s' % (sep, dumps(row['slug']), dumps(row['name']))
+                else:
+                    yield sep + dumps(self.item(row))
+                sep = ', '
+            envelope = self._finish({})
+        except Exception, e:
+            envelope = self._error(e)
+        if self.key is not None:
+            yield ']'
+            sep = ', '
+        for name, value in envelope.iteritems():
+            yield '%s%s: %s' % (sep, dumps(name), dumps(value))
+            sep = ', '
+        yield '}'
+
+    def iter_ndjson(self):
+        """
+            Yield one line of JSON per row, followed by a line holding
+            *fields* and the ``__result`` envelope.
+        """
+        try:
+            for row in self.page:
+                yield dumps(row) + '\n'
+            envelope = self._finish(dict(self.fields))
+        except Exception, e:
+            envelope = self._error(e)
+        yield dumps(envelope) + '\n'
+
+def _chunked(pieces, size=CHUNK_SIZE):
+    buf = []
+    length = 0
+    for piece in pieces:
+        buf.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(buf)
+            buf = []
+            length = 0
+    if buf:
+        yield ''.join(buf)
+
+def listing_result(request, listing):
+    """
+        Return the result of a `json_view` showing *listing*: a streaming
+        response if *request* has a ``stream`` parameter, otherwise a
+        dictionary.
+    """
+    stream = request.GET.get('stream')
+    if not stream:
+        return listing.as_dict()
+    if stream not in STREAM_MIMETYPES:
+        raise Exception('Unknown stream format: %s' % stream)
+    pieces = getattr(listing, 'iter_%s' % stream)()
+    return HttpResponse(_chunked(pieces), mimetype=STREAM_MIMETYPES[stream])
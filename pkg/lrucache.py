@@ -0,0 +1,83 @@
+"""
+    An in-process cache backend that evicts the least recently used entries.
+
+    Usage: CACHE_BACKEND = 'nirvana.pkg.lrucache://?max_entries=1000&timeout=300'
+"""
+import time
+import threading
+from collections import OrderedDict
+
+from django.core.cache.backends.base import BaseCache
+
+class CacheClass(BaseCache):
+    def __init__(self, host, params):
+        super(CacheClass, self).__init__(params)
+        try:
+            self.max_entries = int(params.get('max_entries', 1000))
+        except (ValueError, TypeError):
+            self.max_entries = 1000
+        # maps keys to (expiry time, value) tuples, least recently used first.
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_entry(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            return None
+        # it's the most recently used entry now.
+        self._entries[key] = entry
+        return entry
+
+    def _set(self, key, value, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        self._entries.pop(key, None)
+        while len(self._entries) >= self.max_entries:
+            self._entries.popitem(last=False)
+        self._entries[key] = (time.time() + timeout, value)
+
+    def add(self, key, value, timeout=None):
+        self._lock.acquire()
+        try:
+            if self._get_entry(key) is not None:
+                return False
+            self._set(key, value, timeout)
+            return True
+        finally:
+            self._lock.release()
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            entry = self._get_entry(key)
+            if entry is None:
+                return default
+            return entry[1]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, timeout=None):
+        self._lock.acquire()
+        try:
+            self._set(key, value, timeout)
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def has_key(self, key):
+        return self.get(key) is not None
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
@@ -0,0 +1,64 @@
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection, transaction
+
+from nirvana.pkg.models import Version, Variant, ManagerPermission
+
+# (name, model, fields, unique) of the indexes syncdb creates for new
+# databases, see the models' `unique_together` and sql/version.sql.
+INDEXES = (
+    ('pkg_version_package_slug', Version, ('package', 'slug'), True),
+    ('pkg_variant_version_slug', Variant, ('version', 'slug'), True),
+    ('pkg_managerpermission_package_user', ManagerPermission, ('package', 'user', 'variant_slug'), True),
+    ('pkg_version_package_latest', Version, ('package', 'latest'), False),
+)
+
+def get_indexes(cursor, table):
+    """
+        Return a dictionary mapping the names of the indexes of *table* to
+        tuples (unique, columns), or None if the database is not supported.
+    """
+    qn = connection.ops.quote_name
+    engine = connection.settings_dict['ENGINE']
+    indexes = {}
+    if engine.endswith('sqlite3'):
+        # unlike PRAGMA statements, this does not commit the transaction.
+        cursor.execute('SELECT list.name, list."unique", info.name FROM pragma_index_list(%s) list, '
+                'pragma_index_info(list.name) info ORDER BY list.name, info.seqno', [table])
+        for name, unique, column in cursor.fetchall():
+            unique, columns = indexes.get(name, (bool(unique), ()))
+            indexes[name] = (unique, columns + (column,))
+    elif 'postgresql' in engine:
+        cursor.execute('SELECT indexname, indexdef FROM pg_indexes WHERE tablename = %s', [table])
+        for name, definition in cursor.fetchall():
+            columns = definition[definition.rindex('(') + 1:definition.rindex(')')]
+            indexes[name] = (' UNIQUE ' in definition, tuple(column.strip() for column in columns.split(',')))
+    else:
+        return None
+    return indexes
+
+class Command(NoArgsCommand):
+    help = 'Add the indexes and unique constraints on the lookup keys to an existing database.'
+
+    def handle_noargs(self, **options):
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        count = 0
+        for name, model, fields, unique in INDEXES:
+            table = model._meta.db_table
+            columns = tuple(model._meta.get_field(field).column for field in fields)
+            indexes = get_indexes(cursor, table)
+            if indexes is not None and (name in indexes or (unique, columns) in indexes.values()):
+                continue
+            if unique:
+                cursor.execute('SELECT %s, COUNT(*) FROM %s GROUP BY %s HAVING COUNT(*) > 1' % (
+                        ', '.join(qn(column) for column in columns), qn(table),
+                        ', '.join(qn(column) for column in columns)))
+                duplicates = cursor.fetchall()
+                if duplicates:
+                    raise CommandError('%s has duplicate rows, remove them first:\n%s' % (table,
+                        '\n'.join('%s: %d rows' % (', '.join(map(unicode, row[:-1])), row[-1]) for row in duplicates)))
+            cursor.execute('CREATE %sINDEX %s ON %s (%s)' % (unique and 'UNIQUE ' or '', qn(name), qn(table),
+                    ', '.join(qn(column) for column in columns)))
+            count += 1
+        transaction.commit_unless_managed()
+        print 'Added %d indexes.' % count
@@ -0,0 +1,20 @@
+from django.core.management.base import NoArgsCommand
+
+from nirvana.pkg.models import Package, Version
+from nirvana.pkg.upgrade import check_columns
+
+class Command(NoArgsCommand):
+    help = 'Set the latest version of every package from the versions marked as latest.'
+
+    def handle_noargs(self, **options):
+        check_columns(Package, Version)
+        count = 0
+        for package in Package.objects.all():
+            versions = Version.objects.filter(package=package, latest=True).order_by('-id')
+            if versions:
+                # saving also unmarks any other versions marked as latest.
+                versions[0].save()
+                count += 1
+            elif package.latest_version_id is not None:
+                Package.objects.filter(slug=package.slug).update(latest_version=None)
+        print 'Updated %d packages.' % count
@@ -0,0 +1,18 @@
+from django.core.management.base import NoArgsCommand
+
+from nirvana.pkg.models import Version
+from nirvana.pkg.versions import version_key
+from nirvana.pkg.upgrade import check_columns
+
+class Command(NoArgsCommand):
+    help = 'Calculate the sortable version key of every version.'
+
+    def handle_noargs(self, **options):
+        check_columns(Version)
+        count = 0
+        for id, slug, key in Version.objects.values_list('id', 'slug', 'version_key'):
+            if key != version_key(slug):
+                # the key is derived from the slug, so this is no change to record.
+                Version.objects.filter(id=id).update(version_key=version_key(slug))
+                count += 1
+        print 'Updated %d versions.' % count
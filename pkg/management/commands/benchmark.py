@@ -0,0 +1,98 @@
+import os
+import tempfile
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from nirvana.pkg import benchmark
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--categories', dest='categories', type='int', default=5),
+        make_option('--packages', dest='packages', type='int', default=50),
+        make_option('--versions', dest='versions', type='int', default=5,
+            help='Versions per package.'),
+        make_option('--variants', dest='variants', type='int', default=3,
+            help='Variants per version.'),
+        make_option('--permissions', dest='permissions', type='int', default=2,
+            help='Manager permissions per package.'),
+        make_option('--requests', dest='requests', type='int', default=50,
+            help='Requests per endpoint and mode.'),
+        make_option('--concurrency', dest='concurrency', type='int', default=4,
+            help='Parallel HTTP clients.'),
+        make_option('--no-http', action='store_false', dest='http', default=True,
+            help='Only use the django test client.'),
+        make_option('--encoders', action='store_true', dest='encoders', default=False,
+            help='Also compare the JSON libraries on the API results.'),
+        make_option('--resolvers', action='store_true', dest='resolvers', default=False,
+            help='Also compare the url resolution time with and without the dispatchers.'),
+        make_option('--only', dest='only', default='',
+            help='Comma-separated list of endpoint names to benchmark.'),
+        make_option('--output', dest='output', default=None,
+            help='Write the results as JSON to this file, e.g. to use it as baseline.'),
+        make_option('--baseline', dest='baseline', default=None,
+            help='Fail if the results are worse than the results in this file.'),
+        make_option('--tolerance', dest='tolerance', type='float', default=0.25,
+            help='Allowed p95 latency growth compared to the baseline (default: 0.25).'),
+    )
+    help = ('Seed a synthetic catalogue into a test database and measure the latency, '
+            'throughput and query count of every url.')
+
+    def handle(self, **options):
+        baseline = None
+        if options['baseline']:
+            try:
+                baseline = benchmark.load_results(open(options['baseline']))
+            except (IOError, ValueError, KeyError), e:
+                raise CommandError('Could not read the baseline %s: %s' % (options['baseline'], e))
+        config = dict((key, options[key]) for key in
+            ('categories', 'packages', 'versions', 'variants', 'permissions', 'requests', 'concurrency'))
+
+        # The HTTP server threads need their own connections to the test
+        # database, so it can't live in memory.
+        tmpfile = None
+        if connection.settings_dict['ENGINE'].endswith('sqlite3'):
+            fd, tmpfile = tempfile.mkstemp(suffix='.sqlite', prefix='nirvana-benchmark-')
+            os.close(fd)
+            connection.settings_dict['TEST_NAME'] = tmpfile
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        # only then django records the queries.
+        old_debug, settings.DEBUG = settings.DEBUG, True
+        try:
+            author = benchmark.seed_catalogue(options['categories'], options['packages'],
+                options['versions'], options['variants'], options['permissions'])
+            only = [name for name in options['only'].split(',') if name]
+            results = benchmark.run_benchmark(author, options['requests'], options['concurrency'],
+                options['http'], only)
+            encoders = None
+            if options['encoders']:
+                encoders = benchmark.compare_encoders(author)
+            resolvers = None
+            if options['resolvers']:
+                resolvers = benchmark.compare_resolvers(author)
+        finally:
+            settings.DEBUG = old_debug
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        print benchmark.format_results(results)
+        if encoders is not None:
+            print
+            print benchmark.format_encoders(encoders)
+        if resolvers is not None:
+            print
+            print benchmark.format_resolvers(resolvers)
+        if options['output']:
+            fileobj = open(options['output'], 'w')
+            try:
+                benchmark.dump_results(results, config, fileobj)
+            finally:
+                fileobj.close()
+        if baseline is not None:
+            regressions = benchmark.find_regressions(results, baseline, options['tolerance'])
+            if regressions:
+                raise CommandError('Performance regressions:\n%s' % '\n'.join(regressions))
@@ -0,0 +1,28 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import reset_queries
+
+from nirvana.pkg.manifest import update_manifest
+
+class Command(NoArgsCommand):
+    help = 'Build and sign the catalogue manifest if anything changed.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--full', action='store_true', dest='full', default=False,
+            help='Read all packages again instead of the changed ones.'),
+        make_option('--interval', type='int', dest='interval', default=None,
+            help='Keep running and update the manifest every this many seconds.'),
+    )
+
+    def handle_noargs(self, **options):
+        full = options['full']
+        while True:
+            manifest = update_manifest(full)
+            print 'Manifest %s as of change %d.' % (manifest.content_hash, manifest.sequence)
+            if not options['interval']:
+                break
+            full = False
+            reset_queries()
+            time.sleep(options['interval'])
@@ -0,0 +1,16 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from nirvana.pkg.blobs import collect_garbage
+
+class Command(NoArgsCommand):
+    help = 'Delete the blobs no variant refers to any more.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--min-age', type='int', dest='min_age', default=60 * 60,
+            help='Only delete blobs older than this many seconds.'),
+    )
+
+    def handle_noargs(self, **options):
+        print 'Deleted %d blobs.' % collect_garbage(options['min_age'])
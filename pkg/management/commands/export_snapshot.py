@@ -0,0 +1,31 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from nirvana.pkg.snapshot import write_snapshot
+from nirvana.pkg.blobs import BlobNotFound
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--since', dest='since', type='int', default=None,
+            help='Only export changes made after this change sequence.'),
+    )
+    help = 'Export a gzip-compressed JSON snapshot of all packages, versions and variants.'
+    args = '[filename]'
+
+    def handle(self, filename=None, **options):
+        try:
+            if filename is None or filename == '-':
+                write_snapshot(sys.stdout, options['since'])
+            else:
+                try:
+                    fileobj = open(filename, 'wb')
+                except IOError, e:
+                    raise CommandError('Could not open %s: %s' % (filename, e))
+                try:
+                    write_snapshot(fileobj, options['since'])
+                finally:
+                    fileobj.close()
+        except BlobNotFound, e:
+            raise CommandError('Could not export the snapshot: %s' % e)
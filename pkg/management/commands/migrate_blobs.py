@@ -0,0 +1,38 @@
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+
+from nirvana.pkg.models import Variant, CONTENT_FIELDS
+from nirvana.pkg.blobs import get_blob_store
+from nirvana.pkg.stuff import content_hash
+from nirvana.pkg.upgrade import check_columns
+
+class Command(NoArgsCommand):
+    help = 'Move the usefiles, checksums and signatures stored in the variant table into the blob store.'
+
+    def handle_noargs(self, **options):
+        check_columns(Variant)
+        table = Variant._meta.db_table
+        cursor = connection.cursor()
+        columns = [column[0] for column in connection.introspection.get_table_description(cursor, table)]
+        fields = [field for field in CONTENT_FIELDS if field in columns]
+        if not fields:
+            print 'Nothing to migrate.'
+            return
+        qn = connection.ops.quote_name
+        cursor.execute('SELECT %s, %s FROM %s' % (qn('id'), ', '.join(qn(field) for field in fields), qn(table)))
+        store = get_blob_store()
+        count = 0
+        for row in cursor.fetchall():
+            hashes = {}
+            contents = {}
+            for field, content in zip(fields, row[1:]):
+                content = content or u''
+                hash = content_hash(content)
+                hashes['%s_hash' % field] = hash
+                contents[hash] = content
+            store.put_many(contents)
+            # the contents did not change, so this is no change to record.
+            Variant.objects.filter(id=row[0]).update(**hashes)
+            count += 1
+        transaction.commit_unless_managed()
+        print 'Updated %d variants. The columns %s of %s can be dropped now.' % (count, ', '.join(fields), table)
@@ -0,0 +1,16 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from nirvana.pkg.publish import rebuild
+
+class Command(NoArgsCommand):
+    help = 'Write the files of all variants to PUBLISH_ROOT and remove stale ones.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=4,
+            help='Number of threads publishing packages.'),
+    )
+
+    def handle_noargs(self, **options):
+        print 'Published %d packages.' % rebuild(options['workers'])
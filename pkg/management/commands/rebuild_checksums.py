@@ -0,0 +1,30 @@
+from django.core.management.base import NoArgsCommand
+
+from nirvana.pkg.models import Variant
+from nirvana.pkg.blobs import get_blob_store, BATCH_SIZE
+from nirvana.pkg.checksums import update_checksums
+from nirvana.pkg.upgrade import check_columns
+
+def _update(variants):
+    # one blob store round trip per batch.
+    contents = get_blob_store().get_many(set(variant.get_hash('checksums') for variant in variants))
+    update_checksums(variants, contents)
+
+class Command(NoArgsCommand):
+    help = 'Parse the checksums of all variants again and rebuild the index of their files.'
+
+    def handle_noargs(self, **options):
+        check_columns(Variant)
+        count = 0
+        variants = []
+        # not cached by the query set, only the hashes are needed.
+        for variant in Variant.objects.only('id', 'checksums_hash').iterator():
+            variants.append(variant)
+            if len(variants) == BATCH_SIZE:
+                _update(variants)
+                count += len(variants)
+                variants = []
+        if variants:
+            _update(variants)
+            count += len(variants)
+        print 'Updated %d variants.' % count
@@ -0,0 +1,17 @@
+from django.core.management.base import NoArgsCommand
+
+from nirvana.pkg.models import Variant
+from nirvana.pkg.dependencies import update_dependencies
+
+class Command(NoArgsCommand):
+    help = 'Parse the usefiles of all variants again and rebuild their stored fields and the dependency graph.'
+
+    def handle_noargs(self, **options):
+        count = 0
+        for variant in Variant.objects.select_related('version'):
+            variant.update_usefile_fields()
+            # the fields are derived from the usefile, so this is no change to record.
+            Variant.objects.filter(id=variant.id).update(usefile_fields=variant.usefile_fields)
+            update_dependencies([variant])
+            count += 1
+        print 'Updated %d variants.' % count
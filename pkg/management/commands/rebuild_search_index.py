@@ -0,0 +1,15 @@
+from django.core.management.base import NoArgsCommand
+
+from nirvana.pkg.models import Package, Variant
+from nirvana.pkg.search import index_package, index_variants
+
+class Command(NoArgsCommand):
+    help = 'Rebuild the package search index.'
+
+    def handle_noargs(self, **options):
+        count = 0
+        for package in Package.objects.select_related('author'):
+            index_package(package)
+            index_variants(list(Variant.objects.filter(version__package=package).select_related('version')))
+            count += 1
+        print 'Indexed %d packages.' % count
@@ -0,0 +1,22 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from nirvana.pkg.models import Variant
+from nirvana.pkg.signing import resign_variants
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+            help='Sign all variants again, not only the pending ones (e.g. after changing the key).'),
+        make_option('--workers', dest='workers', type='int', default=4,
+            help='Number of signing threads.'),
+    )
+    help = 'Sign the checksums of all variants whose signature is pending.'
+
+    def handle(self, **options):
+        variants = Variant.objects.all()
+        if not options['all']:
+            variants = variants.filter(signature_pending=True)
+        count = resign_variants(variants, options['workers'])
+        print 'Signed %d variants.' % count
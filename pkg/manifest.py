@@ -0,0 +1,174 @@
+"""
+    A signed catalogue of all packages, so clients can resolve offline.
+
+    The manifest is a JSON document listing every package with its
+    versions, their latest flags and their variants, which only hold the
+    hashes of their usefile, checksums and checksums signature::
+
+        {"format": 1, "packages": {"helloworld": {
+            "name": "Hello World!", "category": "nonsense", "latest": "0.2",
+            "versions": {"0.2": {"latest": true, "variants": {"src": {
+                "usefile": "<hash>", "checksums": "<hash>",
+                "checksums_signature": "<hash>"}}}}}}}
+
+    A signature that is still pending has the hash null. Clients fetch
+    ``api/manifest/`` conditionally (its ETag is the manifest's hash),
+    verify it with the detached signature at ``api/manifest/<hash>.sig``
+    and download the blobs they don't have from ``api/blobs/<hash>/``.
+
+    Manifests and signatures are blobs. ``api/manifest/`` only serves the
+    latest manifest; new ones are built by `manage.py build_manifest`
+    (e.g. run by cron, or with ``--interval``) if something changed. Only
+    the packages that changed since the last one are read from the
+    database, including those whose changes may not have been settled
+    yet (see `Change.settled_sequence`). Each build also prunes the
+    settled changes that are not deletions. Builds wait for each other on
+    the lock file `MANIFEST_LOCK_FILE`, so one catalogue is only signed once.
+"""
+import os
+import fcntl
+import tempfile
+
+from django.conf import settings
+from django.utils import simplejson
+
+from nirvana.pkg.models import Change, Package, Version, Variant, Manifest
+from nirvana.pkg.blobs import get_blob_store, EMPTY_HASH, BATCH_SIZE
+from nirvana.pkg.signing import sign_checksums
+from nirvana.pkg.stuff import content_hash
+
+MANIFEST_FORMAT = 1
+
+# older manifests are kept, so clients can still fetch their signatures.
+HISTORY = 5
+
+def _lock():
+    """
+        Wait for the other builds and return the open lock file, which
+        is unlocked when it is closed.
+    """
+    path = getattr(settings, 'MANIFEST_LOCK_FILE', None) or \
+            os.path.join(tempfile.gettempdir(), 'nirvana-manifest.lock')
+    fileobj = open(path, 'a')
+    try:
+        fcntl.flock(fileobj.fileno(), fcntl.LOCK_EX)
+    except:
+        fileobj.close()
+        raise
+    return fileobj
+
+def _entries(packages, versions, variants):
+    entries = {}
+    for slug, name, category, latest in packages:
+        entries[slug] = {'name': name, 'category': category, 'latest': latest, 'versions': {}}
+    version_entries = {}
+    for id, package_slug, slug, latest in versions:
+        if package_slug in entries:
+            version_entries[id] = entries[package_slug]['versions'][slug] = {'latest': latest, 'variants': {}}
+    for version_id, slug, usefile, checksums, signature, pending in variants:
+        if version_id in version_entries:
+            version_entries[version_id]['variants'][slug] = {
+                'usefile': usefile or EMPTY_HASH,
+                'checksums': checksums or EMPTY_HASH,
+                'checksums_signature': None if pending else (signature or EMPTY_HASH),
+            }
+    return entries
+
+def build_entries(slugs=None):
+    """
+        Return a dictionary mapping the slugs of the packages *slugs*
+        (default: all) to their entries in the manifest. Packages that
+        do not exist are left out.
+    """
+    packages = Package.objects.all()
+    versions = Version.objects.all()
+    variants = Variant.objects.all()
+    chunks = [None]
+    if slugs is not None:
+        slugs = list(slugs)
+        chunks = [slugs[i:i + BATCH_SIZE] for i in xrange(0, len(slugs), BATCH_SIZE)]
+    entries = {}
+    for chunk in chunks:
+        if chunk is not None:
+            packages = Package.objects.filter(slug__in=chunk)
+            versions = Version.objects.filter(package__in=chunk)
+            variants = Variant.objects.filter(version__package__in=chunk)
+        entries.update(_entries(
+            packages.values_list('slug', 'name', 'category', 'latest_version__slug'),
+            versions.values_list('id', 'package', 'slug', 'latest'),
+            variants.values_list('version', 'slug', 'usefile_hash', 'checksums_hash',
+                'checksums_signature_hash', 'signature_pending')))
+    return entries
+
+def changed_packages(since):
+    """
+        Return the set of slugs of the packages that changed (or were
+        deleted) after the change sequence *since*.
+    """
+    slugs = set(Package.objects.filter(sequence__gt=since).values_list('slug', flat=True))
+    slugs.update(Version.objects.filter(sequence__gt=since).values_list('package', flat=True))
+    slugs.update(Variant.objects.filter(sequence__gt=since).values_list('version__package', flat=True))
+    # keys of deleted objects start with the package slug.
+    slugs.update(key.split('/')[0] for key in
+            Change.objects.filter(id__gt=since, deleted=True).values_list('key', flat=True))
+    return slugs
+
+def serialize(packages):
+    """
+        Return the manifest of the package entries *packages* as unicode
+        string. The same catalogue always gives the same manifest.
+    """
+    return unicode(simplejson.dumps({'format': MANIFEST_FORMAT, 'packages': packages},
+            sort_keys=True, separators=(',', ':')))
+
+def get_latest_manifest():
+    manifests = Manifest.objects.order_by('-id')[:1]
+    if manifests:
+        return manifests[0]
+    return None
+
+def update_manifest(full=False):
+    """
+        Return the current `Manifest`, building and signing a new one if
+        anything changed since the last one. If *full* is true, all
+        packages are read again.
+    """
+    lock = _lock()
+    try:
+        # get the sequence first, so changes happening while we are
+        # building will cause the next update. Changes that may still
+        # be joined by lower sequences are read again next time.
+        sequence = Change.settled_sequence()
+        # the changes that are not deletions are never read again.
+        Change.prune(sequence)
+        latest = get_latest_manifest()
+        if latest is not None:
+            sequence = max(sequence, latest.sequence)
+        if latest is not None and latest.sequence >= Change.current_sequence() and not full:
+            return latest
+        store = get_blob_store()
+        if latest is None or full:
+            packages = build_entries()
+        else:
+            packages = simplejson.loads(store.get(latest.content_hash))['packages']
+            slugs = changed_packages(latest.sequence)
+            for slug in slugs:
+                packages.pop(slug, None)
+            packages.update(build_entries(slugs))
+        content = serialize(packages)
+        hash = content_hash(content)
+        if latest is not None and latest.content_hash == hash:
+            # e.g. a homepage changed, which is not part of the manifest.
+            Manifest.objects.filter(id=latest.id).update(sequence=sequence)
+            latest.sequence = sequence
+            return latest
+        signature = sign_checksums(content)
+        store.put_many({hash: content, content_hash(signature): signature})
+        manifest = Manifest.objects.create(sequence=sequence, content_hash=hash,
+                signature_hash=content_hash(signature))
+        old = list(Manifest.objects.order_by('-id').values_list('id', flat=True)[HISTORY:])
+        if old:
+            Manifest.objects.filter(id__in=old).delete()
+        return manifest
+    finally:
+        lock.close()
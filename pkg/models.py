@@ -1,8 +1,83 @@
-from django.db import models
-from django.db.models import Q
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import models, transaction, connection
+from django.db.models.query import QuerySet
+from django.db.models import Max, Q
+from django.db.models.signals import pre_delete, post_save, post_delete
 from django.contrib.auth.models import User
 
-from nirvana.pkg.stuff import DBVersionSlugField, sign
+from nirvana.pkg.stuff import DBVersionSlugField, content_hash
+from nirvana.pkg.signing import signing_queue, sign_checksums
+from nirvana.pkg.databases import on_commit
+from nirvana.pkg.versions import version_key
+
+# seconds a transaction may take from taking a change sequence to
+# committing, see `Change.settled_sequence`.
+DEFAULT_SEQUENCE_SETTLE_TIME = 60
+
+class Change(models.Model):
+    """
+        One row per change to a package, version or variant. The id
+        of a change is the sequence number stored on the changed object,
+        so mirrors can ask for everything that changed since a sequence.
+        Deletions are only recorded here; the other changes are only
+        needed to hand out sequences and are removed by `prune`.
+    """
+    model = models.CharField(max_length=16, blank=True)
+    key = models.CharField(max_length=255, blank=True)
+    deleted = models.BooleanField(default=False)
+    created = models.DateTimeField(auto_now_add=True, null=True)
+
+    def __unicode__(self):
+        return '#%d %s %s' % (self.id, self.model, self.key)
+
+    @classmethod
+    def current_sequence(cls):
+        return cls.objects.aggregate(sequence=Max('id'))['sequence'] or 0
+
+    @classmethod
+    def settled_sequence(cls):
+        """
+            Return the sequence up to which all changes are committed, as
+            far as we can tell. Sequences are taken before the changed rows
+            are committed, so a transaction that is still running may hold
+            a lower sequence than a change that is visible already. Changes
+            younger than `SEQUENCE_SETTLE_TIME` seconds are not counted,
+            deltas since the returned sequence include them again.
+        """
+        cutoff = datetime.now() - timedelta(seconds=getattr(settings, 'SEQUENCE_SETTLE_TIME',
+            DEFAULT_SEQUENCE_SETTLE_TIME))
+        # scans the recent changes only, from the newest one backwards.
+        ids = cls.objects.filter(Q(created__lt=cutoff) | Q(created__isnull=True)) \
+                .order_by('-id').values_list('id', flat=True)[:1]
+        if ids:
+            return ids[0]
+        return 0
+
+    @classmethod
+    def prune(cls, sequence=None):
+        """
+            Delete the changes below the settled sequence (or *sequence*)
+            that are not deletions, and return how many were deleted. The
+            changes from the settled one on are kept, so neither
+            `current_sequence` nor `settled_sequence` go back.
+        """
+        if sequence is None:
+            sequence = cls.settled_sequence()
+        qn = connection.ops.quote_name
+        # a plain DELETE, `QuerySet.delete` would fetch every row first.
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM %s WHERE %s = %%s AND %s < %%s' % (qn(cls._meta.db_table),
+                qn(cls._meta.get_field('deleted').column), qn(cls._meta.pk.column)), [False, sequence])
+        transaction.commit_unless_managed()
+        return cursor.rowcount
+
+def next_sequence():
+    """
+        Return a new change sequence number.
+    """
+    return Change.objects.create().id
 
 class Package(models.Model):
     slug = models.SlugField(primary_key=True, max_length=50)
@@ -10,96 +85,480 @@ class Package(models.Model):
     author = models.ForeignKey(User)
     homepage = models.URLField(null=True, blank=True)
     category = models.ForeignKey('Category')
-
-    @property
-    def latest_version(self):
-        objects = Version.objects.filter(package=self, latest=True)
-        if objects:
-            return objects[0]
-        else:
-            return None
+    sequence = models.PositiveIntegerField(default=0, db_index=True, editable=False)
+    # the version marked as latest, kept up to date by `Version.save`.
+    latest_version = models.ForeignKey('Version', null=True, blank=True, editable=False, related_name='latest_of')
 
     def __unicode__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        self.sequence = next_sequence()
+        # the latest version is only changed by `Version.save`, don't
+        # overwrite it with an outdated value.
+        latest = Package.objects.filter(slug=self.slug).values_list('latest_version', flat=True)
+        if latest:
+            self.latest_version_id = latest[0]
+        super(Package, self).save(*args, **kwargs)
+
+    @property
+    def change_key(self):
+        return self.slug
+
     def get_authorized_variants(self, user):
-        variants = []
-        if user.is_authenticated():
-            versions = Version.objects.filter(package=self)
-            if user == self.author:
-                return [v.slug for v in Variant.objects.filter(version__in=versions)]
-            for permission in self.manager_permissions.filter(user=user):
-                if Variant.objects.filter(slug=permission.variant_slug, version__in=versions):
-                    variants.append(permission.variant_slug)
-        return variants
+        if not user.is_authenticated():
+            return []
+        variants = Variant.objects.filter(version__package=self)
+        if user.id != self.author_id:
+            slugs = [variant_slug for package_slug, variant_slug in get_managed_variants(user)
+                        if package_slug == self.slug]
+            if not slugs:
+                return []
+            variants = variants.filter(slug__in=slugs)
+        return list(variants.values_list('slug', flat=True).distinct())
+
+    def get_authorization(self, user, skip_authentication=False):
+        """
+            Return a function telling whether *user* may create or edit the
+            variant with the slug passed to it. The permissions are read
+            with one query and never cached, so a revoked permission is
+            gone at once.
+        """
+        if not (user.is_authenticated() or skip_authentication):
+            return lambda variant_slug: False
+        if user.id == self.author_id:
+            return lambda variant_slug: True
+        slugs = frozenset(ManagerPermission.objects.filter(package=self, user=user)
+                .values_list('variant_slug', flat=True))
+        return lambda variant_slug: variant_slug in slugs
 
     def is_authorized_for_variant(self, user, variant_slug, skip_authentication=False):
-        if (user.is_authenticated() or skip_authentication):
-            if user == self.author:
-                return True
-            for permission in self.manager_permissions.all():
-                if (permission.user == user and permission.variant_slug == variant_slug):
-                    return True
-        return False
+        return self.get_authorization(user, skip_authentication)(variant_slug)
 
     @classmethod
     def search(cls, text):
-        q = None
-        for field in ('name', 'slug', 'author__username'):
-            kwargs = {'%s__icontains' % field: text}
-            current = Q(**kwargs)
-            if q is None:
-                q = current
-            else:
-                q = q | current
-        return cls.objects.filter(q)
+        """
+            Return a list of packages matching *text*, best matches first.
+            See `nirvana.pkg.search.search`.
+        """
+        from nirvana.pkg.search import search
+        return [package for package, score in search(text)[1]]
+
+class SearchTerm(models.Model):
+    """
+        A lowercase word of a package's slug, name, author or the origin of
+        one of its variants. This is the index used by `Package.search`.
+    """
+    package = models.ForeignKey(Package, related_name='search_terms')
+    # the variant whose origin this is, if any.
+    variant = models.ForeignKey('Variant', null=True, blank=True, related_name='search_terms')
+    field = models.CharField(max_length=16)
+    term = models.CharField(max_length=64, db_index=True)
+
+    def __unicode__(self):
+        return '%s: %s' % (self.field, self.term)
 
 class ManagerPermission(models.Model):
     user = models.ForeignKey(User)
     variant_slug = models.SlugField(max_length=50)
     package = models.ForeignKey(Package, related_name='manager_permissions')
 
+    class Meta:
+        unique_together = (('package', 'user', 'variant_slug'),)
+
     def __unicode__(self):
         return '%s -> %s' % (self.user, self.variant_slug)
 
+class ApiToken(models.Model):
+    """
+        An api token of *user*, allowed to do what its space-separated
+        *scopes* say until it *expires*. Only a hash of the token is stored,
+        see `nirvana.pkg.tokens`.
+    """
+    user = models.ForeignKey(User, related_name='api_tokens')
+    name = models.CharField(max_length=64, blank=True)
+    token_hash = models.CharField(max_length=64, unique=True, editable=False)
+    scopes = models.CharField(max_length=128, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    expires = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return '%s: %s' % (self.user, self.name)
+
+    def get_scopes(self):
+        return frozenset(self.scopes.split())
+
+# how long the variants a user may manage are cached, in seconds.
+MANAGED_VARIANTS_TIMEOUT = 300
+
+def _managed_variants_key(user_id):
+    return 'nirvana:managed:%d' % user_id
+
+def get_managed_variants(user):
+    """
+        Return a frozenset of (package slug, variant slug) tuples of the
+        variants *user* was made a manager of. Packages authored by *user*
+        are not included. The result is cached per user if the cache is
+        shared by all processes, so changes reach all of them. Only use
+        this for display, see `Package.get_authorization`.
+    """
+    from nirvana.pkg.cache import get_response_cache, is_shared_cache
+    if not is_shared_cache():
+        return frozenset(ManagerPermission.objects.filter(user=user).values_list('package', 'variant_slug'))
+    cache = get_response_cache()
+    key = _managed_variants_key(user.id)
+    variants = cache.get(key)
+    if variants is None:
+        variants = frozenset(ManagerPermission.objects.filter(user=user).values_list('package', 'variant_slug'))
+        cache.set(key, variants, MANAGED_VARIANTS_TIMEOUT)
+    return variants
+
+def invalidate_managed_variants(user_ids):
+    from nirvana.pkg.cache import get_response_cache
+    for user_id in user_ids:
+        get_response_cache().delete(_managed_variants_key(user_id))
+
+class VersionQuerySet(QuerySet):
+    def delete(self):
+        # Django would delete the packages pointing to a deleted latest version.
+        Package.objects.filter(latest_version__in=self).update(latest_version=None)
+        super(VersionQuerySet, self).delete()
+
+class VersionManager(models.Manager):
+    def get_query_set(self):
+        return VersionQuerySet(self.model)
+
 class Version(models.Model):
     slug = DBVersionSlugField(max_length=50)
     name = models.CharField('Name', max_length=128, blank=True)
     package = models.ForeignKey('Package')
     latest = models.BooleanField('Latest version')
+    sequence = models.PositiveIntegerField(default=0, db_index=True, editable=False)
+    # see `nirvana.pkg.versions`.
+    version_key = models.CharField(max_length=128, db_index=True, editable=False, default='')
+
+    objects = VersionManager()
+
+    class Meta:
+        # see also sql/version.sql.
+        unique_together = (('package', 'slug'),)
 
     def __unicode__(self):
         return '%s %s' % (self.slug, self.name)
 
+    def save(self, *args, **kwargs):
+        # transactions don't nest, a managed one is committed by the caller.
+        if transaction.is_managed():
+            self._save(*args, **kwargs)
+        else:
+            transaction.commit_on_success(self._save)(*args, **kwargs)
+
+    def _save(self, *args, **kwargs):
+        self.sequence = next_sequence()
+        self.version_key = version_key(self.slug)
+        super(Version, self).save(*args, **kwargs)
+        self.update_latest()
+
+    def delete(self):
+        Package.objects.filter(latest_version=self).update(latest_version=None)
+        super(Version, self).delete()
+
+    def update_latest(self):
+        """
+            Make the package's latest version and the other versions'
+            `latest` flags agree with `self.latest`.
+        """
+        from nirvana.pkg.cache import invalidate, package_namespace
+        from nirvana.pkg.publish import publish_latest
+        packages = Package.objects.filter(slug=self.package_id)
+        if self.latest:
+            Version.objects.filter(package=self.package_id, latest=True).exclude(id=self.id) \
+                    .update(latest=False, sequence=next_sequence())
+            packages.update(latest_version=self)
+            publish_latest(self.package_id, self.slug)
+        elif packages.filter(latest_version=self).update(latest_version=None):
+            publish_latest(self.package_id, None)
+        # `update` does not send any signals.
+        invalidate(package_namespace(self.package_id))
+
+    @property
+    def change_key(self):
+        return '%s/%s' % (self.package_id, self.slug)
+
     def make_latest(self):
         """
             mark this version as the latest available version.
-            This will not save self.
+            This will not save self; saving will unmark the other versions.
         """
-        for version in Version.objects.filter(package=self.package):
-            if (version.latest and version != self):
-                version.latest = False
-                version.save()
         self.latest = True
 
+class Blob(models.Model):
+    """
+        A usefile, checksums list or signature stored under its hash, if
+        blobs are kept in the database. See `nirvana.pkg.blobs`.
+    """
+    hash = models.CharField(max_length=40, primary_key=True)
+    content = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return self.hash
+
+class Manifest(models.Model):
+    """
+        A signed catalogue of all packages as of the change *sequence*. The
+        manifest and its signature are blobs, see `nirvana.pkg.manifest`.
+    """
+    sequence = models.PositiveIntegerField(default=0)
+    content_hash = models.CharField(max_length=40, db_index=True)
+    signature_hash = models.CharField(max_length=40, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return '#%d %s' % (self.sequence, self.content_hash)
+
+CONTENT_FIELDS = ('usefile', 'checksums', 'checksums_signature')
+
+def _content_property(field):
+    """
+        Return a property for the content *field* of a variant, which lives
+        in the blob store under the hash in ``<field>_hash``. The content is
+        loaded on first access; setting it updates the hash right away and
+        stores the content when the variant is saved.
+    """
+    hash_attr = '%s_hash' % field
+    def get(self):
+        hash = getattr(self, hash_attr)
+        cached = self._contents.get(field)
+        if cached is None or cached[0] != hash:
+            from nirvana.pkg.blobs import get_blob_store
+            cached = self._contents[field] = (hash, get_blob_store().get(hash))
+        return cached[1]
+    def set(self, value):
+        # remember the hash of the saved content.
+        self._new_contents.setdefault(field, getattr(self, hash_attr))
+        hash = content_hash(value)
+        setattr(self, hash_attr, hash)
+        self._contents[field] = (hash, value)
+    return property(get, set)
+
+class VariantManager(models.Manager):
+    def insert_many(self, variants):
+        """
+            Insert the unsaved *variants* with one statement and set their
+            ids. The variants share one change sequence. Unlike `save`, this
+            does not send any signals; the search index, the dependency
+            graph, the checksum index, the response cache and the signing
+            queue are updated once for all of them; the variants are
+            queued for signing when the transaction is committed.
+        """
+        from nirvana.pkg.cache import invalidate, package_namespace
+        from nirvana.pkg.search import index_variants
+        from nirvana.pkg.dependencies import update_dependencies
+        from nirvana.pkg.checksums import update_checksums
+        from nirvana.pkg.blobs import get_blob_store
+        from nirvana.pkg.publish import publish_variants
+        if not variants:
+            return
+        sequence = next_sequence()
+        fields = [f for f in Variant._meta.local_fields if not isinstance(f, models.AutoField)]
+        rows = []
+        contents = {}
+        for variant in variants:
+            variant.sequence = sequence
+            contents.update(variant.pop_new_contents()[1])
+            variant.update_usefile_fields()
+            rows.append([f.get_db_prep_save(f.pre_save(variant, True), connection=connection) for f in fields])
+        get_blob_store().put_many(contents)
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.executemany('INSERT INTO %s (%s) VALUES (%s)' % (
+                qn(Variant._meta.db_table),
+                ', '.join(qn(f.column) for f in fields),
+                ', '.join(['%s'] * len(fields))), rows)
+        transaction.commit_unless_managed()
+        # get the ids of the new rows.
+        ids = dict(((version_id, slug), id) for id, version_id, slug in
+            self.filter(sequence=sequence).values_list('id', 'version', 'slug'))
+        package_slugs = set()
+        for variant in variants:
+            variant.id = ids[(variant.version_id, variant.slug)]
+            package_slugs.add(variant.version.package_id)
+        pending = [variant.id for variant in variants if variant.signature_pending]
+        def queue_pending():
+            for variant_id in pending:
+                signing_queue.put(variant_id)
+        if pending:
+            on_commit(queue_pending)
+        update_dependencies(variants, invalidate_packages=False)
+        update_checksums(variants)
+        index_variants(variants)
+        publish_variants(variants)
+        invalidate(*[package_namespace(slug) for slug in package_slugs])
+
 class Variant(models.Model):
     slug = models.SlugField(max_length=50)
     name = models.CharField('Name', max_length=128, blank=True)
     version = models.ForeignKey(Version)
-    usefile = models.TextField()
-    checksums = models.TextField(blank=True)
-    checksums_signature = models.TextField(blank=True)
+    sequence = models.PositiveIntegerField(default=0, db_index=True, editable=False)
+    modified = models.DateTimeField(auto_now=True, null=True)
+    # the contents are stored in the blob store, see `_content_property`.
+    usefile_hash = models.CharField(max_length=40, blank=True, editable=False)
+    checksums_hash = models.CharField(max_length=40, blank=True, editable=False)
+    checksums_signature_hash = models.CharField(max_length=40, blank=True, editable=False)
+    signature_pending = models.BooleanField(default=False, editable=False)
+    # the parsed usefile as JSON, see `get_usefile_fields`.
+    usefile_fields = models.TextField(blank=True, editable=False)
+
+    usefile = _content_property('usefile')
+    checksums = _content_property('checksums')
+    checksums_signature = _content_property('checksums_signature')
+
+    objects = VariantManager()
+
+    class Meta:
+        unique_together = (('version', 'slug'),)
+
+    def __init__(self, *args, **kwargs):
+        # the content properties are set by `Model.__init__` already.
+        self._contents = {}
+        self._new_contents = {}
+        super(Variant, self).__init__(*args, **kwargs)
 
     def __unicode__(self):
         return '%s %s' % (self.slug, self.name)
 
+    def save(self, *args, **kwargs):
+        from nirvana.pkg.dependencies import update_dependencies
+        from nirvana.pkg.checksums import update_checksums
+        from nirvana.pkg.search import index_variants
+        from nirvana.pkg.blobs import get_blob_store
+        self.sequence = next_sequence()
+        old_hashes, contents = self.pop_new_contents()
+        usefile_changed = old_hashes.get('usefile', self.usefile_hash) != self.usefile_hash
+        fields_changed = usefile_changed or not self.usefile_fields
+        if fields_changed:
+            self.update_usefile_fields()
+        # the blobs have to exist before anything refers to them.
+        get_blob_store().put_many(contents)
+        super(Variant, self).save(*args, **kwargs)
+        if usefile_changed:
+            update_dependencies([self])
+        if fields_changed:
+            index_variants([self])
+        if old_hashes.get('checksums', self.checksums_hash) != self.checksums_hash:
+            update_checksums([self])
+        if self.signature_pending:
+            # the workers have their own connections, they can't see the
+            # variant before it is committed.
+            on_commit(lambda: signing_queue.put(self.id))
+
+    def pop_new_contents(self):
+        """
+            Return a tuple (dictionary mapping the changed content fields to
+            their hashes before the change, dictionary mapping the new
+            hashes to the new contents) and forget about the changes.
+        """
+        old_hashes = self._new_contents
+        self._new_contents = {}
+        contents = {}
+        for field in old_hashes:
+            hash, content = self._contents[field]
+            contents[hash] = content
+        return old_hashes, contents
+
+    def set_usefile(self, usefile, fields):
+        """
+            Set the usefile along with its already parsed *fields*, so
+            saving does not parse it again.
+        """
+        self.usefile = usefile
+        self._parsed_usefile = (usefile, fields)
+
+    def update_usefile_fields(self):
+        """
+            Parse the usefile and store its fields. Malformed usefiles have
+            no fields. This will not save self.
+        """
+        from nirvana.pkg.usefile import parse_usefile, InvalidUsefile, UsefileFields
+        parsed = getattr(self, '_parsed_usefile', None)
+        if parsed is not None and parsed[0] == self.usefile:
+            fields = parsed[1]
+        else:
+            try:
+                fields = parse_usefile(self.usefile)
+            except InvalidUsefile:
+                fields = UsefileFields()
+        self.usefile_fields = fields.to_json()
+        self._parsed_usefile = (self.usefile, fields)
+
+    def get_usefile_fields(self):
+        """
+            Return the `UsefileFields` of the usefile as stored at save time.
+        """
+        from nirvana.pkg.usefile import UsefileFields
+        parsed = getattr(self, '_parsed_usefile', None)
+        if parsed is None:
+            if not self.usefile_fields:
+                # saved before the fields were stored.
+                self.update_usefile_fields()
+                return self._parsed_usefile[1]
+            parsed = self._parsed_usefile = (None, UsefileFields.from_json(self.usefile_fields))
+        return parsed[1]
+
+    def get_hash(self, field):
+        """
+            Return the hash of the content *field*. Empty contents may have
+            no stored hash.
+        """
+        return getattr(self, '%s_hash' % field) or content_hash('')
+
+    @property
+    def change_key(self):
+        return '%s/%s/%s' % (self.version.package_id, self.version.slug, self.slug)
+
     def set_signature(self):
+        """
+            Sign the checksums. If there are signing workers, the variant is
+            only marked as pending and gets signed in the background as
+            soon as it is saved and committed.
+            This will not save self.
+        """
+        if self.checksums and not self.checksums.endswith('\n'):
+            self.checksums += '\n'
+        self.checksums_signature = ''
+        self.signature_pending = False
         if self.checksums:
-            if not self.checksums.endswith('\n'):
-                self.checksums += '\n'
-            self.checksums_signature = sign(self.checksums.encode('utf-8'))
-        else:
-            self.checksums_signature = ''
+            if signing_queue.is_async:
+                self.signature_pending = True
+            else:
+                self.checksums_signature = sign_checksums(self.checksums)
+
+class Dependency(models.Model):
+    """
+        An edge of the dependency graph: *variant* requires a version of
+        the package *package_slug* matching *version_constraint*. The package
+        does not have to exist. See `nirvana.pkg.dependencies`.
+    """
+    variant = models.ForeignKey(Variant, related_name='dependencies')
+    package_slug = models.SlugField(max_length=50)
+    version_constraint = models.CharField(max_length=128, default='*')
+
+    def __unicode__(self):
+        return '%s %s' % (self.package_slug, self.version_constraint)
+
+class Checksum(models.Model):
+    """
+        A file listed in the checksums of *variant*, so variants can be
+        found by the hashes of their files. See `nirvana.pkg.checksums`.
+    """
+    variant = models.ForeignKey(Variant, related_name='checksum_entries')
+    algorithm = models.CharField(max_length=8)
+    hash = models.CharField(max_length=64, db_index=True)
+    filename = models.CharField(max_length=255)
+
+    def __unicode__(self):
+        return '%s  %s' % (self.hash, self.filename)
 
 class Category(models.Model):
     slug = models.SlugField(primary_key=True, max_length=50)
@@ -107,3 +566,81 @@ class Category(models.Model):
 
     def __unicode__(self):
         return self.name
+
+def record_deletion(sender, instance, **kwargs):
+    Change.objects.create(model=sender.__name__.lower(), key=instance.change_key, deleted=True)
+
+for model in (Package, Version, Variant):
+    pre_delete.connect(record_deletion, sender=model, dispatch_uid='record_deletion_%s' % model.__name__)
+
+def get_package_slug(sender, instance):
+    """
+        Return the slug of the package *instance* belongs to, or None if it
+        was deleted. *sender* is the class of *instance*.
+    """
+    if sender is Package:
+        return instance.slug
+    elif sender is Variant:
+        # the version might have been deleted along with the variant.
+        slugs = Version.objects.filter(id=instance.version_id).values_list('package', flat=True)
+        if slugs:
+            return slugs[0]
+        return None
+    else:
+        return instance.package_id
+
+def update_search_index(sender, instance, **kwargs):
+    from nirvana.pkg.search import index_package
+    index_package(instance)
+
+# variants index their origins when their usefile changes, their terms are
+# deleted along with them.
+post_save.connect(update_search_index, sender=Package, dispatch_uid='update_search_index_Package')
+
+def invalidate_cache(sender, instance, **kwargs):
+    from nirvana.pkg.cache import invalidate, package_namespace, CATEGORIES_NAMESPACE
+    namespaces = []
+    if sender in (Category, Package):
+        namespaces.append(CATEGORIES_NAMESPACE)
+    if sender is not Category:
+        slug = get_package_slug(sender, instance)
+        if slug is not None:
+            namespaces.append(package_namespace(slug))
+    invalidate(*namespaces)
+
+for model in (Category, Package, Version, Variant, ManagerPermission):
+    post_save.connect(invalidate_cache, sender=model, dispatch_uid='invalidate_cache_%s' % model.__name__)
+    post_delete.connect(invalidate_cache, sender=model, dispatch_uid='invalidate_cache_delete_%s' % model.__name__)
+
+def invalidate_permissions(sender, instance, **kwargs):
+    invalidate_managed_variants([instance.user_id])
+
+post_save.connect(invalidate_permissions, sender=ManagerPermission, dispatch_uid='invalidate_permissions')
+post_delete.connect(invalidate_permissions, sender=ManagerPermission, dispatch_uid='invalidate_permissions_delete')
+
+def publish_files(sender, instance, **kwargs):
+    from nirvana.pkg.publish import get_publish_root, publish_variants, prune_package
+    if get_publish_root() is None:
+        return
+    slug = get_package_slug(sender, instance)
+    if slug is None:
+        return
+    if 'created' in kwargs:
+        if sender is Variant:
+            publish_variants([instance])
+        else:
+            # the version may have been renamed.
+            publish_variants(instance.variant_set.select_related('version'))
+    prune_package(slug)
+
+for model in (Version, Variant):
+    post_save.connect(publish_files, sender=model, dispatch_uid='publish_files_%s' % model.__name__)
+for model in (Package, Version, Variant):
+    post_delete.connect(publish_files, sender=model, dispatch_uid='publish_files_delete_%s' % model.__name__)
+
+def forget_token(sender, instance, **kwargs):
+    from nirvana.pkg.tokens import forget
+    forget(instance.token_hash)
+
+post_save.connect(forget_token, sender=ApiToken, dispatch_uid='forget_token')
+post_delete.connect(forget_token, sender=ApiToken, dispatch_uid='forget_token_delete')
@@ -0,0 +1,255 @@
+"""
+    A static copy of the download urls, so the web server can send usefiles,
+    checksums and signatures without asking Django.
+
+    If the `PUBLISH_ROOT` setting is a directory, every variant's files are
+    written to the same paths as their urls::
+
+        PUBLISH_ROOT/packages/<package>/<version>/<variant>/<package>.use
+        PUBLISH_ROOT/packages/<package>/<version>/<variant>/<package>.checksums
+        PUBLISH_ROOT/packages/<package>/<version>/<variant>/<package>.checksums.sig
+        PUBLISH_ROOT/packages/<package>/latest -> <version>
+
+    Files are replaced atomically whenever a variant or version is saved
+    or deleted, so the web server never sees half a file. Signatures that
+    are still pending are left out; the web server should pass requests
+    for missing files on to Django, which answers them as usual.
+
+    `manage.py publish` rebuilds the whole tree.
+"""
+import os
+import shutil
+import tempfile
+import threading
+from Queue import Queue
+
+from django.conf import settings
+from django.db import connection
+
+from nirvana.pkg.blobs import get_blob_store, EMPTY_HASH
+
+# maps the content fields of a variant to the extensions of their files.
+EXTENSIONS = (
+    ('usefile', '.use'),
+    ('checksums', '.checksums'),
+    ('checksums_signature', '.checksums.sig'),
+)
+
+LATEST = 'latest'
+
+def get_publish_root():
+    """
+        Return the directory the download tree is published to, or None.
+    """
+    return getattr(settings, 'PUBLISH_ROOT', None) or None
+
+def _is_safe(name):
+    return name not in ('', '.', '..', LATEST) and '/' not in name and os.sep not in name
+
+def _package_path(root, package_slug):
+    return os.path.join(root, 'packages', package_slug)
+
+def _makedirs(directory):
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # created in the meantime.
+            if not os.path.isdir(directory):
+                raise
+
+def _temp_name(directory):
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    os.close(fd)
+    return tmp
+
+def _write(path, content):
+    directory = os.path.dirname(path)
+    _makedirs(directory)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(content)
+        finally:
+            f.close()
+        os.chmod(tmp, 0644)
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+def _link(source, path):
+    """
+        Replace *path* by a hard link to *source*, e.g. a file of the blob
+        store. Raises OSError if that is not possible.
+    """
+    directory = os.path.dirname(path)
+    _makedirs(directory)
+    tmp = _temp_name(directory)
+    os.unlink(tmp)
+    os.link(source, tmp)
+    try:
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+def _remove(path):
+    """
+        Remove the file, link or directory tree *path* if it exists. Trees
+        are moved out of the way first, so they disappear at once.
+    """
+    if os.path.islink(path) or os.path.isfile(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+    elif os.path.isdir(path):
+        tmp = _temp_name(os.path.dirname(path))
+        os.unlink(tmp)
+        os.rename(path, tmp)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def _prune(directory, keep):
+    """
+        Remove the entries of *directory* whose names are not in *keep*.
+    """
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if name not in keep and not name.startswith('.'):
+            _remove(os.path.join(directory, name))
+
+def publish_variants(variants):
+    """
+        Write the files of *variants*. The contents are read from the blob
+        store at once, or hard-linked if the blobs are files.
+    """
+    root = get_publish_root()
+    if root is None:
+        return
+    store = get_blob_store()
+    files = []
+    for variant in variants:
+        package_slug, version_slug = variant.version.package_id, variant.version.slug
+        if not (_is_safe(version_slug) and _is_safe(variant.slug)):
+            continue
+        directory = os.path.join(_package_path(root, package_slug), version_slug, variant.slug)
+        for field, extension in EXTENSIONS:
+            path = os.path.join(directory, package_slug + extension)
+            if field == 'checksums_signature' and variant.signature_pending:
+                _remove(path)
+            else:
+                files.append((path, variant.get_hash(field)))
+    missing = []
+    for path, hash in files:
+        source = store.path(hash)
+        if source is not None and hash != EMPTY_HASH:
+            try:
+                _link(source, path)
+                continue
+            except OSError:
+                # e.g. another file system.
+                pass
+        missing.append((path, hash))
+    contents = store.get_many([hash for path, hash in missing])
+    for path, hash in missing:
+        _write(path, contents[hash].encode('utf-8'))
+
+def publish_latest(package_slug, version_slug):
+    """
+        Point the ``latest`` link of the package *package_slug* to the
+        version *version_slug*, or remove it if that is None.
+    """
+    root = get_publish_root()
+    if root is None:
+        return
+    directory = _package_path(root, package_slug)
+    path = os.path.join(directory, LATEST)
+    if version_slug is None or not _is_safe(version_slug):
+        _remove(path)
+        return
+    _makedirs(directory)
+    tmp = _temp_name(directory)
+    os.unlink(tmp)
+    # relative, so the tree can be moved.
+    os.symlink(version_slug, tmp)
+    os.rename(tmp, path)
+
+def prune_package(package_slug):
+    """
+        Remove the files of the versions and variants of the package
+        *package_slug* that do not exist any more, e.g. after renaming or
+        deleting them. The whole package is removed if it is gone.
+    """
+    from nirvana.pkg.models import Version, Variant
+    root = get_publish_root()
+    if root is None:
+        return
+    directory = _package_path(root, package_slug)
+    versions = dict((slug, set()) for slug in
+            Version.objects.filter(package=package_slug).values_list('slug', flat=True))
+    if not versions:
+        _remove(directory)
+        return
+    for version_slug, variant_slug in Variant.objects.filter(version__package=package_slug) \
+            .values_list('version__slug', 'slug'):
+        versions[version_slug].add(variant_slug)
+    _prune(directory, set(versions) | set([LATEST]))
+    for version_slug, variant_slugs in versions.iteritems():
+        if _is_safe(version_slug):
+            _prune(os.path.join(directory, version_slug), variant_slugs)
+
+def publish_package(package_slug):
+    """
+        Write all files of the package *package_slug* and remove stale ones.
+    """
+    from nirvana.pkg.models import Package, Variant
+    if get_publish_root() is None:
+        return
+    publish_variants(Variant.objects.filter(version__package=package_slug).select_related('version'))
+    latest = Package.objects.filter(slug=package_slug).values_list('latest_version__slug', flat=True)
+    publish_latest(package_slug, latest and latest[0] or None)
+    prune_package(package_slug)
+
+def rebuild(workers=4):
+    """
+        Publish all packages using *workers* threads (none: in this thread)
+        and remove the packages that do not exist any more. Return the
+        number of packages.
+    """
+    from nirvana.pkg.models import Package
+    root = get_publish_root()
+    if root is None:
+        raise Exception('PUBLISH_ROOT is not set.')
+    slugs = list(Package.objects.values_list('slug', flat=True))
+    if not workers:
+        for slug in slugs:
+            publish_package(slug)
+    else:
+        queue = Queue()
+        errors = []
+        def work():
+            try:
+                while True:
+                    slug = queue.get()
+                    try:
+                        publish_package(slug)
+                    except Exception, e:
+                        errors.append((slug, e))
+                    finally:
+                        queue.task_done()
+            finally:
+                connection.close()
+        for slug in slugs:
+            queue.put(slug)
+        for i in range(workers):
+            thread = threading.Thread(target=work, name='publisher-%d' % i)
+            thread.setDaemon(True)
+            thread.start()
+        queue.join()
+        if errors:
+            raise Exception('Could not publish %s' % ', '.join('%s (%s)' % error for error in errors))
+    _prune(os.path.join(root, 'packages'), set(slugs))
+    return len(slugs)
@@ -0,0 +1,127 @@
+import re
+
+from django.db import connection, connections, router, transaction
+
+from nirvana.pkg.models import Package, SearchTerm
+
+term_re = re.compile(r'[^\W_]+', re.UNICODE)
+
+# how much a match in a field counts for the ranking.
+FIELD_WEIGHTS = {
+    'slug': 4,
+    'name': 3,
+    'author': 2,
+    'origin': 1,
+}
+
+def tokenize(text):
+    """
+        Split *text* into lowercase search terms.
+    """
+    return term_re.findall(text.lower())
+
+def _get_terms(fields):
+    terms = set()
+    for field, text in fields:
+        for term in tokenize(text):
+            terms.add((field, term[:64]))
+    return terms
+
+def get_package_terms(package):
+    """
+        Return a set of (field, term) tuples of the slug, name and author
+        of *package*.
+    """
+    return _get_terms([
+        ('slug', package.slug),
+        ('name', package.name),
+        ('author', package.author.username),
+    ])
+
+def get_variant_terms(variant):
+    """
+        Return a set of (field, term) tuples of the origins of *variant*.
+    """
+    return _get_terms(('origin', origin) for origin in variant.get_usefile_fields().getlist('Origin'))
+
+def _insert_terms(rows):
+    if rows:
+        qn = connection.ops.quote_name
+        connection.cursor().executemany('INSERT INTO %s (%s, %s, %s, %s) VALUES (%%s, %%s, %%s, %%s)' % (
+                qn(SearchTerm._meta.db_table), qn('package_id'), qn('variant_id'), qn('field'), qn('term')),
+                rows)
+        transaction.commit_unless_managed()
+
+def index_package(package):
+    """
+        Replace the search terms of the fields of *package*. The terms of
+        its variants are left alone, see `index_variants`.
+    """
+    SearchTerm.objects.filter(package=package, variant__isnull=True).delete()
+    _insert_terms([(package.slug, None, field, term) for field, term in get_package_terms(package)])
+
+def index_variants(variants):
+    """
+        Replace the search terms of the saved *variants*.
+    """
+    SearchTerm.objects.filter(variant__in=[variant.id for variant in variants]).delete()
+    _insert_terms([(variant.version.package_id, variant.id, field, term)
+        for variant in variants for field, term in get_variant_terms(variant)])
+
+def _get_matches(db, words):
+    """
+        Return the SQL and parameters of a query for (package slug, score)
+        rows of the packages matching all *words* on the database *db*. A
+        package gets the best weight of its terms for each word.
+    """
+    qn = db.ops.quote_name
+    weights = FIELD_WEIGHTS.items()
+    weight = 'CASE %s %s END * CASE WHEN %s = %%s THEN 2 ELSE 1 END' % (qn('field'),
+            ' '.join('WHEN %%s THEN %d' % w for field, w in weights), qn('term'))
+    selects = []
+    params = []
+    for word in words:
+        selects.append('SELECT %s, MAX(%s) AS weight FROM %s WHERE %s LIKE %%s GROUP BY %s' % (
+            qn('package_id'), weight, qn(SearchTerm._meta.db_table), qn('term'), qn('package_id')))
+        params.extend(field for field, w in weights)
+        params.extend([word, word + '%'])
+    sql = 'SELECT %s, SUM(weight) AS score FROM (%s) words GROUP BY %s HAVING COUNT(*) = %d' % (
+            qn('package_id'), ' UNION ALL '.join(selects), qn('package_id'), len(words))
+    return sql, params
+
+def search(text, limit=None, offset=0):
+    """
+        Search for packages matching all words in *text*. A word matches
+        if it is a prefix of a term of the package's slug, name, author or
+        its variants' origins.
+
+        Return a tuple (total number of matches, [(package, score), ...])
+        ordered by descending score. *limit* and *offset* select a slice of
+        the matches.
+    """
+    words = []
+    for word in tokenize(text):
+        if word not in words:
+            words.append(word)
+    if not words:
+        return 0, []
+    db = connections[router.db_for_read(SearchTerm)]
+    sql, params = _get_matches(db, words)
+    query = '%s ORDER BY score DESC, %s' % (sql, db.ops.quote_name('package_id'))
+    if limit is not None:
+        query += ' LIMIT %d' % limit
+    elif offset and db.ops.no_limit_value() is not None:
+        query += ' LIMIT %d' % db.ops.no_limit_value()
+    if offset:
+        query += ' OFFSET %d' % offset
+    cursor = db.cursor()
+    cursor.execute(query, params)
+    ranked = cursor.fetchall()
+    if limit is None and (ranked or not offset):
+        total = offset + len(ranked)
+    else:
+        cursor.execute('SELECT COUNT(*) FROM (%s) matches' % sql, params)
+        total = cursor.fetchone()[0]
+    packages = Package.objects.in_bulk([package_id for package_id, score in ranked])
+    return total, [(packages[package_id], score)
+                for package_id, score in ranked if package_id in packages]
@@ -0,0 +1,130 @@
+import threading
+from Queue import Queue
+from datetime import datetime
+
+from django.conf import settings
+from django.db import connection
+from django.utils.importlib import import_module
+
+from nirvana.pkg.instrumentation import timed
+
+def get_signer():
+    """
+        Return the function used to sign checksums, configured by the
+        `SIGNER` setting (default: `nirvana.pkg.stuff.sign`).
+    """
+    path = getattr(settings, 'SIGNER', None) or 'nirvana.pkg.stuff.sign'
+    module, attr = path.rsplit('.', 1)
+    return getattr(import_module(module), attr)
+
+def sign_checksums(checksums):
+    """
+        Sign the unicode string *checksums* and return the signature.
+    """
+    if not checksums:
+        return ''
+    with timed('sign'):
+        return get_signer()(checksums.encode('utf-8'))
+
+def sign_variant(variant_id):
+    """
+        Sign the checksums of the variant with the id *variant_id* and store
+        the signature. If the checksums were changed while signing, the
+        signature is thrown away; the change has queued a new job anyway.
+    """
+    from nirvana.pkg.models import Variant, next_sequence
+    from nirvana.pkg.blobs import get_blob_store
+    try:
+        variant = Variant.objects.get(id=variant_id)
+    except Variant.DoesNotExist:
+        return
+    signature = sign_checksums(variant.checksums)
+    updated = Variant.objects.filter(id=variant.id, checksums_hash=variant.checksums_hash).update(
+            checksums_signature_hash=get_blob_store().put(signature),
+            signature_pending=False,
+            sequence=next_sequence(),
+            modified=datetime.now())
+    if updated:
+        # `update` does not send any signals.
+        from nirvana.pkg.cache import invalidate, package_namespace
+        from nirvana.pkg.publish import publish_variants
+        invalidate(package_namespace(variant.version.package_id))
+        publish_variants(Variant.objects.filter(id=variant.id).select_related('version'))
+
+class SigningQueue(object):
+    """
+        A queue of variant ids waiting for a signature, processed by
+        *workers* long-lived threads. If *workers* is 0, variants are
+        signed right away.
+
+        The queue only lives in memory, but the "signature pending" state
+        is stored in the database, so `manage.py sign_variants` can pick up
+        whatever was lost.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self.queue = Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    @property
+    def is_async(self):
+        return self.workers > 0
+
+    def start(self):
+        self.lock.acquire()
+        try:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work, name='signer-%d' % len(self.threads))
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+        finally:
+            self.lock.release()
+
+    def put(self, variant_id):
+        if not self.is_async:
+            sign_variant(variant_id)
+        else:
+            self.start()
+            self.queue.put(variant_id)
+
+    def join(self):
+        """
+            Wait until all queued variants are signed.
+        """
+        self.queue.join()
+
+    def work(self):
+        while True:
+            variant_id = self.queue.get()
+            try:
+                try:
+                    sign_variant(variant_id)
+                except Exception:
+                    # the variant stays pending, nothing else we can do here.
+                    pass
+            finally:
+                connection.close()
+                self.queue.task_done()
+
+signing_queue = SigningQueue(getattr(settings, 'SIGNING_WORKERS', 0))
+
+def resign_variants(variants, workers=None):
+    """
+        Mark all *variants* (a queryset) as pending and sign them using
+        *workers* threads, e.g. after the key was changed. Return the
+        number of variants.
+    """
+    from nirvana.pkg.blobs import EMPTY_HASH
+    variants = variants.exclude(checksums_hash__in=('', EMPTY_HASH))
+    variants.update(signature_pending=True)
+    ids = list(variants.values_list('id', flat=True))
+    if workers is None:
+        queue = signing_queue
+    else:
+        queue = SigningQueue(workers)
+    for variant_id in ids:
+        queue.put(variant_id)
+    queue.join()
+    return len(ids)
@@ -0,0 +1,87 @@
+import gzip
+from cStringIO import StringIO
+
+from django.utils import simplejson
+
+from nirvana.pkg.models import Change, Category, Package, Version, Variant, CONTENT_FIELDS
+from nirvana.pkg.blobs import get_contents, BlobNotFound
+
+SNAPSHOT_FORMAT = 1
+
+def build_snapshot(since=None):
+    """
+        Return a dictionary describing every package, version and variant.
+        If *since* is given, only include objects that changed after the
+        change sequence *since* and the deletions that happened since then.
+        Raises `BlobNotFound` if the contents of a variant are missing.
+    """
+    # get the sequence first, so changes happening while we are
+    # exporting will be part of the next delta. Changes that may still
+    # be joined by lower sequences are exported again next time.
+    sequence = Change.settled_sequence()
+    if since is not None:
+        sequence = max(sequence, since)
+    packages = Package.objects.select_related('author')
+    versions = Version.objects.all()
+    variants = Variant.objects.select_related('version')
+    deleted = []
+    if since is not None:
+        packages = packages.filter(sequence__gt=since)
+        versions = versions.filter(sequence__gt=since)
+        variants = variants.filter(sequence__gt=since)
+        deleted = [{'type': change.model, 'key': change.key}
+            for change in Change.objects.filter(id__gt=since, deleted=True)]
+    variants = list(variants)
+    # shared contents are only fetched once.
+    hashes = set(variant.get_hash(field) for variant in variants for field in CONTENT_FIELDS)
+    contents = get_contents(hashes)
+    missing = sorted(hashes.difference(contents))
+    if missing:
+        raise BlobNotFound('Missing blobs: %s' % ', '.join(missing))
+    return {
+        'format': SNAPSHOT_FORMAT,
+        'sequence': sequence,
+        'since': since,
+        'categories': dict((c.slug, c.name) for c in Category.objects.all()),
+        'packages': [{
+                'slug': p.slug,
+                'name': p.name,
+                'author': p.author.username,
+                'homepage': p.homepage,
+                'category': p.category_id,
+            } for p in packages.iterator()],
+        'versions': [{
+                'package': v.package_id,
+                'slug': v.slug,
+                'name': v.name,
+                'latest': v.latest,
+            } for v in versions.iterator()],
+        'variants': [{
+                'package': v.version.package_id,
+                'version': v.version.slug,
+                'slug': v.slug,
+                'name': v.name,
+                'usefile': contents[v.get_hash('usefile')],
+                'checksums': contents[v.get_hash('checksums')],
+                'checksums_signature': contents[v.get_hash('checksums_signature')],
+            } for v in variants],
+        'deleted': deleted,
+    }
+
+def write_snapshot(fileobj, since=None):
+    """
+        Write a gzip-compressed JSON snapshot to the file-like object *fileobj*.
+    """
+    gz = gzip.GzipFile(fileobj=fileobj, mode='wb')
+    try:
+        simplejson.dump(build_snapshot(since), gz)
+    finally:
+        gz.close()
+
+def get_snapshot(since=None):
+    """
+        Return a gzip-compressed JSON snapshot as string.
+    """
+    buf = StringIO()
+    write_snapshot(buf, since)
+    return buf.getvalue()
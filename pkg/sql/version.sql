@@ -0,0 +1,5 @@
+-- Installed by syncdb. Resolving version constraints scans the versions
+-- of one package by their version key, see nirvana.pkg.versions.
+CREATE INDEX pkg_version_package_key ON pkg_version (package_id, version_key);
+-- The latest version of a package is looked up by both columns.
+CREATE INDEX pkg_version_package_latest ON pkg_version (package_id, latest);
@@ -1,26 +1,41 @@
 import sys
 import re
 import hashlib
+from calendar import timegm
+from functools import wraps
 from subprocess import PIPE, Popen
 
 from django.conf import settings
-from django.http import HttpResponse
-from django.utils import simplejson
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import http_date, parse_http_date_safe, parse_etags, quote_etag
 from django.core.mail import mail_admins
 from django.utils.translation import ugettext as _
 from django.db.models.fields import SlugField
-from django.forms import RegexField
+from django.forms import RegexField, ValidationError
+
+from nirvana.pkg.instrumentation import timed
+from nirvana.pkg.encoding import dumps, compress_response, JSON_MIMETYPE, ENCODINGS
 
 version_slug_re = re.compile(r'^[-\w.]+$')
 
+# these mean something else in the urls of a package, see `nirvana.pkg.dispatch`.
+RESERVED_VERSION_SLUGS = ('latest', 'resolve')
+
 class FormVersionSlugField(RegexField):
     default_error_messages = {
         'invalid': (u"Enter a valid 'slug' consisting of letters, numbers,"
                      u" underscores, hyphens and dots."),
+        'reserved': u"'%s' can't be used as version slug.",
     }
     def __init__(self, *args, **kwargs):
         super(FormVersionSlugField, self).__init__(version_slug_re, *args, **kwargs)
 
+    def clean(self, value):
+        value = super(FormVersionSlugField, self).clean(value)
+        if value in RESERVED_VERSION_SLUGS:
+            raise ValidationError(self.error_messages['reserved'] % value)
+        return value
+
 class DBVersionSlugField(SlugField):
     def formfield(self, **kwargs):
         defaults = {'form_class': FormVersionSlugField}
@@ -28,13 +43,119 @@ class DBVersionSlugField(SlugField):
         return super(DBVersionSlugField, self).formfield(**defaults)
 
 
+def content_hash(content):
+    """
+        Return the hash of *content* that is used as its ETag.
+    """
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return hashlib.sha1(content).hexdigest()
+
+def strip_coding(etag):
+    """
+        Return the ETag *etag* without the content coding that
+        `set_validators` appended to it.
+    """
+    for coding in ENCODINGS:
+        if etag.endswith('-' + coding):
+            return etag[:-len(coding) - 1]
+    return etag
+
+def get_matching_etag(request, etag):
+    """
+        Return the ETag in the If-None-Match header of *request* that
+        belongs to a representation of the content *etag*, in any content
+        coding, or None.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if not if_none_match or etag is None:
+        return None
+    try:
+        etags = parse_etags(if_none_match)
+    except ValueError:
+        return None
+    for tag in etags:
+        if strip_coding(tag) == etag:
+            return tag
+    return None
+
+def is_not_modified(request, etag=None, last_modified=None):
+    """
+        Return True if the client's cached copy described by the
+        If-None-Match and If-Modified-Since headers of *request* is
+        still valid for *etag* and the datetime *last_modified*.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        # If-None-Match takes precedence over If-Modified-Since.
+        try:
+            etags = parse_etags(if_none_match)
+        except ValueError:
+            return False
+        return etag is not None and ('*' in etags or get_matching_etag(request, etag) is not None)
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and last_modified is not None:
+        if_modified_since = parse_http_date_safe(if_modified_since)
+        return (if_modified_since is not None and
+                timegm(last_modified.utctimetuple()) <= if_modified_since)
+    return False
+
+def set_validators(response, etag=None, last_modified=None):
+    """
+        Add ETag and Last-Modified headers to *response*. The content
+        coding of a compressed response is appended to the ETag (e.g.
+        ``"<hash>-gzip"``), so every representation has its own.
+    """
+    if etag is not None:
+        if response.has_header('Content-Encoding'):
+            etag = '%s-%s' % (etag, response['Content-Encoding'])
+        response['ETag'] = quote_etag(etag)
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(timegm(last_modified.utctimetuple()))
+    return response
+
+def not_modified_response(request, etag=None, last_modified=None):
+    """
+        Return a 304 response to *request*. Its ETag is the one of the
+        client's copy, which may be compressed.
+    """
+    return set_validators(HttpResponseNotModified(), get_matching_etag(request, etag) or etag, last_modified)
+
+def conditional_response(request, get_content, etag=None, last_modified=None, mimetype='text/plain; charset=utf-8'):
+    """
+        Return a 304 response if the client's copy is still valid, otherwise
+        call *get_content* and return its result in a normal (possibly
+        compressed) response. *get_content* may return a response itself.
+    """
+    if is_not_modified(request, etag, last_modified):
+        return not_modified_response(request, etag, last_modified)
+    content = get_content()
+    if isinstance(content, HttpResponse):
+        response = content
+    else:
+        response = compress_response(request, HttpResponse(content, mimetype=mimetype))
+    return set_validators(response, etag, last_modified)
+
 def json_view(func):
+    @wraps(func)
     def wrap(request, *a, **kw):
         response = None
+        etag = None
         try:
-            response = dict(func(request, *a, **kw))
-            if 'result' not in response:
+            response = func(request, *a, **kw)
+            if isinstance(response, HttpResponse):
+                # e.g. a streaming response, see `nirvana.pkg.listing`.
+                return response
+            response = dict(response)
+            if '__result' not in response:
                 response['__result'] = 'ok'
+            with timed('json'):
+                json = dumps(response)
+            # only successful responses can be cached.
+            if response['__result'] == 'ok':
+                etag = content_hash(json)
         except KeyboardInterrupt:
             # Allow keyboard interrupts through for debugging.
             raise
@@ -60,9 +181,11 @@ def json_view(func):
                 msg = _('Internal error')+': '+str(e)
             response = {'__result': 'error',
                         '__text': msg}
+            json = dumps(response)
 
-        json = simplejson.dumps(response)
-        return HttpResponse(json, mimetype='text/plain') # TODO: i guess that should be application/json
+        if is_not_modified(request, etag):
+            return not_modified_response(request, etag)
+        return set_validators(compress_response(request, HttpResponse(json, mimetype=JSON_MIMETYPE)), etag)
     return wrap
 
 def get_api_token(user):
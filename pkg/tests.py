@@ -5,7 +5,44 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+import os
+import re
+import sys
+import time
+import gzip
+import shutil
+import tempfile
+import zlib
+from cStringIO import StringIO
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import connection, reset_queries, router, transaction
+from django.http import HttpRequest, HttpResponse, Http404
+from django.test import TestCase, TransactionTestCase
+from django.contrib.auth.models import User
+from django.core.urlresolvers import RegexURLResolver, Resolver404, reverse
+from django.utils import simplejson
+
+from nirvana.pkg.models import Category, Package, Version, Variant, ManagerPermission, Blob, ApiToken, Manifest, \
+        Checksum, Change, SearchTerm, next_sequence
+from nirvana.pkg.signing import resign_variants, sign_variant, SigningQueue
+from nirvana.pkg.cache import get_response_cache, stats as cache_stats
+from nirvana.pkg.stuff import get_api_token, content_hash
+from nirvana.pkg import benchmark
+from nirvana.pkg.instrumentation import get_histograms, reset_histograms
+from nirvana.pkg.versions import version_key
+from nirvana.pkg.search import search
+from nirvana.pkg.usefile import parse_usefile, parse_requires, validate_usefile, InvalidUsefile, UsefileSyntaxError
+from nirvana.pkg.encoding import get_available_encoders, DEFAULT_COMPRESS_MIN_SIZE
+from nirvana.pkg import blobs, publish
+from nirvana.pkg.dispatch import flatten
+from nirvana.pkg.tokens import create_token, authenticate, hash_token, InvalidToken
+from nirvana.pkg.databases import ReplicaMiddleware, primary, PIN_COOKIE
+from nirvana.pkg.cache import cached_view, invalidate, is_cache_enabled, is_shared_cache
+from nirvana.pkg import views
+from nirvana.pkg.manifest import update_manifest, changed_packages
+from nirvana.pkg.checksums import parse_checksums, normalize_checksums, ChecksumsSyntaxError
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -21,3 +58,1526 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+USEFILE = """Name: Hello World
+Version: %s
+Variant: %s
+Origin: meatshop://
+"""
+
+def fake_sign(checksums):
+    """
+        Stand-in for `nirvana.pkg.stuff.sign` that does not need gpg.
+    """
+    return 'signature of %s' % checksums
+
+class PackageTestCase(TestCase):
+    """
+        Base class for tests that need a small catalogue.
+    """
+    def setUp(self):
+        self.old_signer = getattr(settings, 'SIGNER', None)
+        settings.SIGNER = 'nirvana.pkg.tests.fake_sign'
+        self.old_template_dirs = settings.TEMPLATE_DIRS
+        settings.TEMPLATE_DIRS = (os.path.join(os.path.dirname(os.path.dirname(__file__)), 'templates'),)
+        self.old_cache_backend = getattr(settings, 'PKG_CACHE_BACKEND', None)
+        settings.PKG_CACHE_BACKEND = 'nirvana.pkg.lrucache://?max_entries=1000&timeout=300'
+        get_response_cache().clear()
+        self.user = User.objects.create_user('fred', 'fred@example.org', 'secret')
+        self.category = Category.objects.create(slug='nonsense', name='Nonsense')
+        self.package = Package.objects.create(slug='helloworld', name='Hello World!',
+                author=self.user, category=self.category)
+        self.old_version = self.create_version('0.1')
+        self.version = self.create_version('0.2', latest=True)
+
+    def tearDown(self):
+        settings.SIGNER = self.old_signer
+        settings.TEMPLATE_DIRS = self.old_template_dirs
+        settings.PKG_CACHE_BACKEND = self.old_cache_backend
+
+    def create_version(self, slug, latest=False, package=None):
+        version = Version(slug=slug, package=package or self.package, latest=latest)
+        if latest:
+            version.make_latest()
+        version.save()
+        return version
+
+    def create_variant(self, slug, version, checksums=''):
+        return Variant.objects.create(slug=slug, version=version,
+                usefile=USEFILE % (version.slug, slug), checksums=checksums)
+
+    def get_json(self, url, data=None):
+        response = self.client.get(url, data or {})
+        self.failUnlessEqual(response.status_code, 200)
+        return simplejson.loads(response.content)
+
+class ResolveTest(PackageTestCase):
+    def test_resolve(self):
+        self.create_variant('src', self.old_version)
+        self.create_variant('src', self.version, checksums='abc  helloworld.ooc\n')
+        result = self.get_json('/api/resolve/', {'variant': [
+            'helloworld/latest/src',
+            'helloworld/0.1/src',
+            'helloworld/0.3/src',
+        ]})
+        self.failUnlessEqual(result['__result'], 'ok')
+        latest, old, missing = result['variants']
+        self.failUnlessEqual(latest['version'], '0.2')
+        self.failUnlessEqual(latest['usefile'], USEFILE % ('0.2', 'src'))
+        self.failUnlessEqual(latest['checksums'], 'abc  helloworld.ooc\n')
+        self.failUnlessEqual(old['version'], '0.1')
+        self.failUnlessEqual(missing['error'], 'Not found.')
+
+    def test_invalid_variant(self):
+        result = self.get_json('/api/resolve/', {'variant': 'helloworld/src'})
+        self.failUnlessEqual(result['__result'], 'error')
+
+class SnapshotTest(PackageTestCase):
+    def setUp(self):
+        super(SnapshotTest, self).setUp()
+        self.old_settle_time = getattr(settings, 'SEQUENCE_SETTLE_TIME', None)
+        settings.SEQUENCE_SETTLE_TIME = 0
+
+    def tearDown(self):
+        super(SnapshotTest, self).tearDown()
+        settings.SEQUENCE_SETTLE_TIME = self.old_settle_time
+
+    def get_snapshot(self, data=None):
+        response = self.client.get('/api/snapshot/', data or {})
+        self.failUnlessEqual(response.status_code, 200)
+        return simplejson.loads(gzip.GzipFile(fileobj=StringIO(response.content)).read())
+
+    def test_full_snapshot(self):
+        self.create_variant('src', self.version)
+        snapshot = self.get_snapshot()
+        self.failUnlessEqual(snapshot['packages'][0]['slug'], 'helloworld')
+        self.failUnlessEqual(len(snapshot['versions']), 2)
+        self.failUnlessEqual(snapshot['variants'][0]['usefile'], USEFILE % ('0.2', 'src'))
+
+    def test_delta(self):
+        sequence = self.get_snapshot()['sequence']
+        self.create_variant('src', self.version)
+        self.old_version.delete()
+        snapshot = self.get_snapshot({'since': sequence})
+        self.failUnlessEqual(snapshot['packages'], [])
+        self.failUnlessEqual(snapshot['versions'], [])
+        self.failUnlessEqual([v['slug'] for v in snapshot['variants']], ['src'])
+        self.failUnlessEqual(snapshot['deleted'], [{'type': 'version', 'key': 'helloworld/0.1'}])
+        self.failUnless(snapshot['sequence'] > sequence)
+
+    def test_late_commit(self):
+        settings.SEQUENCE_SETTLE_TIME = 60
+        # a transaction takes a sequence, another one commits a change after it ...
+        sequence = next_sequence()
+        self.create_variant('src', self.version)
+        snapshot = self.get_snapshot()
+        self.failUnless(snapshot['sequence'] < sequence)
+        # ... and the first one commits later.
+        Version.objects.filter(id=self.old_version.id).update(name='Late', sequence=sequence)
+        snapshot = self.get_snapshot({'since': snapshot['sequence']})
+        self.failUnlessEqual([v['name'] for v in snapshot['versions'] if v['slug'] == '0.1'], ['Late'])
+        self.failUnlessEqual([v['slug'] for v in snapshot['variants']], ['src'])
+        # old enough changes are settled.
+        Change.objects.update(created=datetime.now() - timedelta(minutes=5))
+        self.failUnlessEqual(self.get_snapshot()['sequence'], Change.current_sequence())
+
+class ConditionalGetTest(PackageTestCase):
+    def test_usefile_etag(self):
+        self.create_variant('src', self.version)
+        url = '/packages/helloworld/0.2/src/helloworld.use'
+        response = self.client.get(url)
+        self.failUnlessEqual(response.content, USEFILE % ('0.2', 'src'))
+        etag = response['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.failUnlessEqual(response.status_code, 304)
+        self.failUnlessEqual(response.content, '')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='"outdated"')
+        self.failUnlessEqual(response.status_code, 200)
+
+    def test_usefile_last_modified(self):
+        self.create_variant('src', self.version)
+        response = self.client.get('/packages/helloworld/0.2/src/helloworld.use')
+        response = self.client.get('/packages/helloworld/0.2/src/helloworld.use',
+                HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.failUnlessEqual(response.status_code, 304)
+        response = self.client.get('/packages/helloworld/latest/src/helloworld.use')
+        self.failIf(response.has_header('Last-Modified'))
+
+    def test_json_etag(self):
+        response = self.client.get('/api/packages/helloworld/')
+        response = self.client.get('/api/packages/helloworld/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.failUnlessEqual(response.status_code, 304)
+        self.create_version('0.3')
+        response = self.client.get('/api/packages/helloworld/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.failUnlessEqual(response.status_code, 200)
+
+class SigningTest(PackageTestCase):
+    def test_set_signature(self):
+        variant = Variant(slug='src', version=self.version, usefile='', checksums='abc  foo.ooc')
+        variant.set_signature()
+        variant.save()
+        self.failUnlessEqual(variant.checksums_signature, 'signature of abc  foo.ooc\n')
+        self.failIf(variant.signature_pending)
+
+    def test_pending_signature(self):
+        variant = self.create_variant('src', self.version, checksums='abc  foo.ooc\n')
+        Variant.objects.filter(id=variant.id).update(signature_pending=True)
+        url = '/packages/helloworld/0.2/src/helloworld.checksums.sig'
+        response = self.client.get(url)
+        self.failUnlessEqual(response.status_code, 503)
+        self.failUnlessEqual(resign_variants(Variant.objects.filter(signature_pending=True), 0), 1)
+        response = self.client.get(url)
+        self.failUnlessEqual(response.status_code, 200)
+        self.failUnlessEqual(response.content, 'signature of abc  foo.ooc\n')
+
+class ManualSigningQueue(SigningQueue):
+    """
+        A signing queue with one worker, which only works when `run` is
+        called.
+    """
+    def __init__(self):
+        SigningQueue.__init__(self, 1)
+
+    def start(self):
+        pass
+
+    def queued(self):
+        return list(self.queue.queue)
+
+    def run(self):
+        while not self.queue.empty():
+            sign_variant(self.queue.get())
+            self.queue.task_done()
+
+class AsyncSigningTest(TransactionTestCase):
+    """
+        Background signing, with transactions that are really committed.
+    """
+    CHECKSUMS = 'd41d8cd98f00b204e9800998ecf8427e  foo.ooc\n'
+
+    def setUp(self):
+        self.old_signer = getattr(settings, 'SIGNER', None)
+        settings.SIGNER = 'nirvana.pkg.tests.fake_sign'
+        # the module the models were loaded from, see INSTALLED_APPS.
+        self.models = sys.modules[Variant.__module__]
+        self.old_queue = self.models.signing_queue
+        self.queue = self.models.signing_queue = ManualSigningQueue()
+        get_response_cache().clear()
+        self.user = User.objects.create_user('fred', 'fred@example.org', 'secret')
+        category = Category.objects.create(slug='nonsense', name='Nonsense')
+        self.package = Package.objects.create(slug='helloworld', name='Hello World!',
+                author=self.user, category=category)
+        self.version = Version.objects.create(slug='0.2', package=self.package, latest=True)
+
+    def tearDown(self):
+        settings.SIGNER = self.old_signer
+        self.models.signing_queue = self.old_queue
+
+    def new_variant(self, slug):
+        variant = Variant(slug=slug, version=self.version, usefile=USEFILE % ('0.2', slug),
+                checksums=self.CHECKSUMS)
+        variant.set_signature()
+        self.failUnless(variant.signature_pending)
+        return variant
+
+    def save_variant(self, slug):
+        variant = self.new_variant(slug)
+        variant.save()
+        return variant
+
+    def failUnlessSigned(self, variant):
+        variant = Variant.objects.get(id=variant.id)
+        self.failIf(variant.signature_pending)
+        self.failUnlessEqual(variant.checksums_signature, fake_sign(self.CHECKSUMS))
+
+    def test_save(self):
+        variant = self.save_variant('src')
+        self.failUnlessEqual(self.queue.queued(), [variant.id])
+        self.queue.run()
+        self.failUnlessSigned(variant)
+
+    def test_managed_transaction(self):
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            variant = self.save_variant('src')
+            # the workers could not see the variant yet.
+            self.failIf(self.queue.queued())
+            transaction.commit()
+            self.failUnlessEqual(self.queue.queued(), [variant.id])
+            self.save_variant('linux')
+            transaction.rollback()
+            self.failUnlessEqual(self.queue.queued(), [variant.id])
+        finally:
+            transaction.leave_transaction_management()
+        self.queue.run()
+        self.failUnlessSigned(variant)
+        self.failIf(Variant.objects.filter(slug='linux'))
+
+    def test_batch(self):
+        response = self.client.post('/api/submit/batch/', {
+            'user': 'fred',
+            'token': get_api_token(self.user),
+            'slug': 'helloworld',
+            'variants': simplejson.dumps([{'usefile': USEFILE % ('0.2', slug), 'checksums': self.CHECKSUMS}
+                for slug in ('src', 'linux')]),
+        })
+        self.failUnlessEqual(simplejson.loads(response.content)['__result'], 'ok')
+        variants = list(Variant.objects.order_by('id'))
+        self.failUnlessEqual(self.queue.queued(), [variant.id for variant in variants])
+        self.queue.run()
+        for variant in variants:
+            self.failUnlessSigned(variant)
+        response = self.client.get('/packages/helloworld/0.2/linux/helloworld.checksums.sig')
+        self.failUnlessEqual(response.content, fake_sign(self.CHECKSUMS))
+
+    def test_insert_many(self):
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            variants = [self.new_variant(slug) for slug in ('src', 'linux')]
+            Variant.objects.insert_many(variants)
+            self.failIf(self.queue.queued())
+            transaction.rollback()
+            Variant.objects.insert_many([self.new_variant('osx')])
+            transaction.commit()
+        finally:
+            transaction.leave_transaction_management()
+        self.failUnlessEqual(self.queue.queued(), [Variant.objects.get(slug='osx').id])
+
+class VersionTransactionTest(TransactionTestCase):
+    def setUp(self):
+        user = User.objects.create_user('fred', 'fred@example.org', 'secret')
+        category = Category.objects.create(slug='nonsense', name='Nonsense')
+        self.package = Package.objects.create(slug='helloworld', name='Hello World!',
+                author=user, category=category)
+
+    def test_outer_transaction(self):
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            Version(slug='0.1', package=self.package, latest=True).save()
+            transaction.rollback()
+        finally:
+            transaction.leave_transaction_management()
+        self.failIf(Version.objects.all())
+        self.failUnlessEqual(Package.objects.get(slug='helloworld').latest_version, None)
+
+    def test_own_transaction(self):
+        version = Version(slug='0.1', package=self.package, latest=True)
+        version.save()
+        self.failUnlessEqual(Package.objects.get(slug='helloworld').latest_version, version)
+        self.failIf(transaction.is_dirty())
+
+class SearchTest(PackageTestCase):
+    def setUp(self):
+        super(SearchTest, self).setUp()
+        Package.objects.create(slug='hello-gtk', name='GTK bindings',
+                author=self.user, category=self.category)
+
+    def test_search(self):
+        result = self.get_json('/api/search/', {'pattern': 'hel'})
+        self.failUnlessEqual(result, {'__result': 'ok', 'helloworld': 'Hello World!', 'hello-gtk': 'GTK bindings'})
+        result = self.get_json('/api/search/', {'pattern': 'hello gt'})
+        self.failUnlessEqual(result, {'__result': 'ok', 'hello-gtk': 'GTK bindings'})
+        result = self.get_json('/api/search/', {'pattern': 'world'})
+        self.failUnlessEqual(result, {'__result': 'ok', 'helloworld': 'Hello World!'})
+
+    def test_origin(self):
+        self.create_variant('src', self.version)
+        result = self.get_json('/api/search/', {'pattern': 'meatshop'})
+        self.failUnlessEqual(result, {'__result': 'ok', 'helloworld': 'Hello World!'})
+
+    def test_variant_terms(self):
+        variant = self.create_variant('src', self.version)
+        self.create_variant('src', self.old_version)
+        package_terms = list(SearchTerm.objects.filter(variant__isnull=True).order_by('id'))
+        variant.usefile = (USEFILE % ('0.2', 'src')).replace('meatshop://', 'git://example.org')
+        variant.save()
+        self.failUnlessEqual(list(SearchTerm.objects.filter(variant__isnull=True).order_by('id')), package_terms)
+        self.failUnlessEqual(Package.search('example'), [self.package])
+        self.failUnlessEqual(Package.search('meatshop'), [self.package])
+        Variant.objects.filter(version=self.old_version).delete()
+        self.failUnlessEqual(Package.search('meatshop'), [])
+        self.failUnlessEqual(Package.search('hello example'), [self.package])
+
+    def test_rank(self):
+        result = self.get_json('/api/search/', {'pattern': 'hello', 'rank': '1', 'limit': '1'})
+        self.failUnlessEqual(result['total'], 2)
+        self.failUnlessEqual([r['slug'] for r in result['results']], ['hello-gtk'])
+        result = self.get_json('/api/search/', {'pattern': 'hello', 'rank': '1', 'offset': '1'})
+        self.failUnlessEqual([r['slug'] for r in result['results']], ['helloworld'])
+        self.failUnlessEqual(search('hello', None, 5), (2, []))
+        self.failUnlessEqual(search('hello gtk world'), (0, []))
+        # exact matches count twice, the best match of each word counts.
+        self.failUnlessEqual([(p.slug, score) for p, score in search('hello')[1]],
+                [('hello-gtk', 8), ('helloworld', 6)])
+        self.failUnlessEqual([(p.slug, score) for p, score in search('hello-gtk')[1]], [('hello-gtk', 16)])
+
+class ListingTest(PackageTestCase):
+    def setUp(self):
+        super(ListingTest, self).setUp()
+        for slug in ('0.3', '0.4', '0.5'):
+            self.create_version(slug)
+
+    def get_pages(self, url, data):
+        slugs = []
+        cursor = None
+        while True:
+            if cursor is not None:
+                data['cursor'] = cursor
+            result = self.get_json(url, data)
+            self.failUnlessEqual(result['__result'], 'ok')
+            slugs.extend(result['versions'])
+            cursor = result['__next']
+            if cursor is None:
+                return slugs
+
+    def test_pages(self):
+        slugs = self.get_pages('/api/packages/helloworld/', {'type': 'details', 'limit': '2'})
+        self.failUnlessEqual(slugs, ['0.1', '0.2', '0.3', '0.4', '0.5'])
+        result = self.get_json('/api/packages/helloworld/', {'limit': '2'})
+        self.failUnlessEqual(sorted(result), ['0.1', '0.2', '__next', '__result'])
+
+    def test_unpaginated(self):
+        result = self.get_json('/api/packages/helloworld/', {'type': 'details'})
+        self.failIf('__next' in result)
+        self.failUnlessEqual(len(result['versions']), 5)
+
+    def test_invalid(self):
+        result = self.get_json('/api/packages/helloworld/', {'limit': '0'})
+        self.failUnlessEqual(result['__result'], 'error')
+        result = self.get_json('/api/packages/helloworld/', {'cursor': 'garbage'})
+        self.failUnlessEqual(result['__result'], 'error')
+
+    def test_stream_json(self):
+        for data in ({'type': 'details'}, {'type': 'contents', 'limit': '3'}):
+            expected = self.get_json('/api/packages/helloworld/', data)
+            data['stream'] = 'json'
+            self.failUnlessEqual(self.get_json('/api/packages/helloworld/', data), expected)
+
+    def test_stream_ndjson(self):
+        response = self.client.get('/api/packages/helloworld/', {'type': 'details', 'stream': 'ndjson', 'limit': '4'})
+        self.failUnlessEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = [simplejson.loads(line) for line in response.content.splitlines()]
+        self.failUnlessEqual([line['slug'] for line in lines[:-1]], ['0.1', '0.2', '0.3', '0.4'])
+        self.failUnlessEqual(lines[-1]['__result'], 'ok')
+        self.failUnlessEqual(lines[-1]['slug'], 'helloworld')
+        self.failUnless(lines[-1]['__next'])
+
+    def test_columns(self):
+        self.create_variant('src', self.version)
+        old_debug, settings.DEBUG = settings.DEBUG, True
+        try:
+            reset_queries()
+            result = self.get_json('/api/packages/helloworld/0.2/', {'type': 'details'})
+            queries = [query['sql'] for query in connection.queries if 'FROM "pkg_variant"' in query['sql']]
+        finally:
+            settings.DEBUG = old_debug
+        self.failUnlessEqual(result['variants'], ['src'])
+        self.failUnless(queries)
+        for sql in queries:
+            self.failIf('usefile' in sql, sql)
+
+    def test_search(self):
+        Package.objects.create(slug='hello-gtk', name='GTK bindings',
+                author=self.user, category=self.category)
+        result = self.get_json('/api/search/', {'pattern': 'hello', 'rank': '1', 'limit': '1'})
+        self.failUnlessEqual([r['slug'] for r in result['results']], ['hello-gtk'])
+        result = self.get_json('/api/search/', {'pattern': 'hello', 'rank': '1', 'cursor': result['__next']})
+        self.failUnlessEqual([r['slug'] for r in result['results']], ['helloworld'])
+        self.failUnlessEqual(result['__next'], None)
+
+class VersionKeyTest(PackageTestCase):
+    def test_order(self):
+        slugs = ['trunk', '0.9', '0.10-dev', '0.10a1', '0.10-beta2', '0.10-rc1', '0.10-rc10',
+                 '0.10', '0.10-1', '0.10.1', '1.0', 'v1.0.1', '2']
+        self.failUnlessEqual(sorted(slugs, key=version_key), slugs)
+
+    def resolve(self, constraint, **data):
+        data['constraint'] = constraint
+        result = self.get_json('/api/packages/helloworld/resolve/', data)
+        self.failUnlessEqual(result['__result'], 'ok', result)
+        return result['versions']
+
+    def test_resolve(self):
+        for slug in ('0.10', '1.0-rc1', '1.0', '1.2', '1.4.1', '1.10', '2.0-beta', '2.0'):
+            self.create_version(slug)
+        self.failUnlessEqual(self.resolve('*')[0], '2.0')
+        self.failUnlessEqual(self.resolve('>=1.2,<2'), ['1.10', '1.4.1', '1.2'])
+        self.failUnlessEqual(self.resolve('>=1.2, <2', prereleases='1'), ['1.10', '1.4.1', '1.2'])
+        self.failUnlessEqual(self.resolve('<2', prereleases='1')[:2], ['1.10', '1.4.1'])
+        self.failUnlessEqual(self.resolve('~1.4'), ['1.4.1'])
+        self.failUnlessEqual(self.resolve('^1.2'), ['1.10', '1.4.1', '1.2'])
+        self.failUnlessEqual(self.resolve('^0.2'), ['0.2'])
+        self.failUnlessEqual(self.resolve('1.*'), ['1.10', '1.4.1', '1.2', '1.0'])
+        self.failUnlessEqual(self.resolve('<1.0', prereleases='1'), ['0.10', '0.2', '0.1'])
+        self.failUnlessEqual(self.resolve('1.0-rc1'), ['1.0-rc1'])
+        self.failUnlessEqual(self.resolve('>=2 || ~0.1'), ['2.0', '0.1'])
+        self.failUnlessEqual(self.resolve('>3'), [])
+
+    def test_invalid(self):
+        result = self.get_json('/api/packages/helloworld/resolve/', {'constraint': '>=trunk'})
+        self.failUnlessEqual(result['__result'], 'error')
+        result = self.get_json('/api/packages/nonexistent/resolve/', {'constraint': '*'})
+        self.failUnlessEqual(result['__result'], 'error')
+
+    def test_version_lists(self):
+        self.create_version('0.10')
+        result = self.get_json('/api/packages/helloworld/', {'type': 'details'})
+        self.failUnlessEqual(result['versions'], ['0.1', '0.2', '0.10'])
+        response = self.client.get('/packages/helloworld/')
+        self.failUnless(response.content.index('0.10') < response.content.index('0.2'))
+
+class DependencyTest(PackageTestCase):
+    def add(self, slug, version_slug, requires=''):
+        package, created = Package.objects.get_or_create(slug=slug,
+                defaults={'name': slug, 'author': self.user, 'category': self.category})
+        version = self.create_version(version_slug, package=package)
+        usefile = USEFILE % (version_slug, 'src')
+        if requires:
+            usefile += 'Requires: %s\n' % requires
+        return Variant.objects.create(slug='src', version=version, usefile=usefile)
+
+    def test_parse(self):
+        self.failUnlessEqual(parse_requires('sdk, gtk >=2.0, sdl (>=1.2, <2)'),
+            [('sdk', '*'), ('gtk', '>=2.0'), ('sdl', '>=1.2, <2')])
+        self.failUnlessRaises(InvalidUsefile, parse_requires, 'gtk >=trunk')
+        self.failUnlessRaises(InvalidUsefile, validate_usefile,
+            parse_usefile(USEFILE % ('0.1', 'src') + 'Name: a\nRequires: a b c\n'))
+
+    def get_dependencies(self):
+        result = self.get_json('/api/packages/helloworld/latest/src/dependencies/')
+        self.failUnlessEqual(result['__result'], 'ok', result)
+        return result
+
+    def test_resolve(self):
+        self.add('helloworld', '0.3', 'sdk, gtk (>=1.0, <2), missing')
+        self.version = Version.objects.get(package=self.package, slug='0.3')
+        self.version.make_latest()
+        self.version.save()
+        self.add('sdk', '1.0', 'base, helloworld')
+        self.add('gtk', '1.5', 'base >=0.1')
+        self.add('gtk', '2.0')
+        self.add('base', '0.1')
+        result = self.get_dependencies()
+        self.failUnlessEqual(result['version'], '0.3')
+        self.failUnlessEqual([(d['package'], d['version']) for d in result['dependencies']],
+            [('sdk', '1.0'), ('gtk', '1.5'), ('base', '0.1')])
+        self.failUnlessEqual(result['dependencies'][2]['required_by'], ['gtk', 'sdk'])
+        self.failUnlessEqual(result['dependencies'][2]['constraint'], '*,>=0.1')
+        self.failUnlessEqual([d['package'] for d in result['unresolved']], ['missing'])
+
+        cache_stats.reset()
+        self.get_dependencies()
+        self.failUnlessEqual(cache_stats.hits, 1)
+        # a new version of a dependency invalidates the closure.
+        self.add('gtk', '1.8')
+        result = self.get_dependencies()
+        self.failUnlessEqual(result['dependencies'][1]['version'], '1.8')
+        # so does a new edge.
+        self.add('missing', '1.0', 'extra')
+        result = self.get_dependencies()
+        self.failUnlessEqual([d['package'] for d in result['unresolved']], ['extra'])
+
+    def test_edit(self):
+        variant = self.add('helloworld', '0.3', 'sdk')
+        self.failUnlessEqual([d.package_slug for d in variant.dependencies.all()], ['sdk'])
+        variant.usefile = USEFILE % ('0.3', 'src')
+        variant.save()
+        self.failUnlessEqual(variant.dependencies.count(), 0)
+
+class UsefileTest(PackageTestCase):
+    TEXT = """# a comment
+Name: Hello World
+
+Version: 0.1
+Description: first line
+  second line
+\t# an indented comment
+Requires: sdk
+Requires: gtk >=2.0
+"""
+
+    def test_parse(self):
+        for source in (self.TEXT, StringIO(self.TEXT), self.TEXT.replace('\n', '\r\n')):
+            fields = parse_usefile(source)
+            self.failUnlessEqual(fields['Name'], 'Hello World')
+            self.failUnlessEqual(fields['Description'], 'first line\nsecond line')
+            self.failUnlessEqual(fields.getlist('Requires'), ['sdk', 'gtk >=2.0'])
+            self.failUnlessEqual(fields['Requires'], 'gtk >=2.0')
+
+    def test_errors(self):
+        for text, lineno in (('Name: x\n\nbroken\n', 3), ('  Name: x\n', 1), ('Name: x\n: y\n', 2)):
+            try:
+                parse_usefile(text)
+            except UsefileSyntaxError, e:
+                self.failUnlessEqual(e.lineno, lineno)
+                self.failUnless(str(e).startswith('Line %d: ' % lineno))
+            else:
+                self.fail('%r parsed' % text)
+
+    def test_stored(self):
+        variant = self.create_variant('src', self.version)
+        variant = Variant.objects.get(id=variant.id)
+        self.failUnlessEqual(simplejson.loads(variant.usefile_fields)['Origin'], ['meatshop://'])
+        self.failUnlessEqual(variant.get_usefile_fields()['Variant'], 'src')
+        variant.usefile = 'broken'
+        variant.save()
+        self.failUnlessEqual(dict(variant.get_usefile_fields()), {})
+
+class BlobTest(PackageTestCase):
+    def test_deduplication(self):
+        first = self.create_variant('src', self.version, checksums='abc  helloworld.ooc\n')
+        second = self.create_variant('linux', self.version, checksums='abc  helloworld.ooc\n')
+        self.failUnlessEqual(first.checksums_hash, second.checksums_hash)
+        self.failUnlessEqual(Blob.objects.filter(hash=first.checksums_hash).count(), 1)
+        variant = Variant.objects.get(id=second.id)
+        self.failUnlessEqual(variant.checksums, 'abc  helloworld.ooc\n')
+        self.failUnlessEqual(variant.usefile, USEFILE % ('0.2', 'linux'))
+
+    def test_empty(self):
+        variant = self.create_variant('src', self.version)
+        self.failIf(Blob.objects.filter(hash=variant.checksums_hash).exists())
+        self.failUnlessEqual(Variant.objects.get(id=variant.id).checksums, '')
+
+    def test_change(self):
+        variant = self.create_variant('src', self.version, checksums='abc  helloworld.ooc\n')
+        old_hash = variant.checksums_hash
+        variant.checksums = 'def  helloworld.ooc\n'
+        variant.save()
+        self.failIfEqual(variant.checksums_hash, old_hash)
+        response = self.client.get('/packages/helloworld/0.2/src/helloworld.checksums')
+        self.failUnlessEqual(response.content, 'def  helloworld.ooc\n')
+        # the old blob is only collected once it is old enough.
+        self.failUnlessEqual(blobs.collect_garbage(), 0)
+        self.failUnlessEqual(blobs.collect_garbage(min_age=-1), 1)
+        self.failIf(Blob.objects.filter(hash=old_hash).exists())
+        self.failUnless(Blob.objects.filter(hash=variant.checksums_hash).exists())
+
+    def test_reuse(self):
+        variant = self.create_variant('src', self.version, checksums='abc  helloworld.ooc\n')
+        old_hash = variant.checksums_hash
+        variant.checksums = 'def  helloworld.ooc\n'
+        variant.save()
+        Blob.objects.filter(hash=old_hash).update(created=datetime.now() - timedelta(days=1))
+        # a new variant is about to use the old blob.
+        blobs.get_blob_store().put(u'abc  helloworld.ooc\n')
+        self.failUnlessEqual(blobs.collect_garbage(), 0)
+        self.failUnless(Blob.objects.filter(hash=old_hash).exists())
+
+    def test_referenced(self):
+        variant = self.create_variant('src', self.version, checksums='abc  helloworld.ooc\n')
+        # referenced since the collector read the references.
+        self.failUnlessEqual(blobs.get_blob_store().delete_many([variant.checksums_hash], -1), 0)
+        self.failUnless(Blob.objects.filter(hash=variant.checksums_hash).exists())
+
+    def test_missing(self):
+        variant = self.create_variant('src', self.version, checksums='abc  helloworld.ooc\n')
+        Blob.objects.filter(hash=variant.checksums_hash).delete()
+        result = self.get_json('/api/resolve/', {'variant': 'helloworld/latest/src'})
+        self.failUnlessEqual(result['__result'], 'ok')
+        self.failUnlessEqual(result['variants'][0]['error'], 'The contents of this variant are missing.')
+        response = self.client.get('/api/snapshot/')
+        self.failUnlessEqual(response.status_code, 503)
+        self.failUnless(variant.checksums_hash in response.content)
+
+class FileBlobTest(PackageTestCase):
+    def setUp(self):
+        super(FileBlobTest, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.old_store = blobs._store
+        blobs._store = blobs.FileBlobStore(self.root)
+        self.variant = self.create_variant('src', self.version, checksums=u'abc  h\xe9lloworld.ooc\n')
+
+    def tearDown(self):
+        super(FileBlobTest, self).tearDown()
+        blobs._store = self.old_store
+        settings.BLOB_SENDFILE_HEADER = None
+        shutil.rmtree(self.root)
+
+    def test_files(self):
+        path = blobs.get_blob_store().path(self.variant.checksums_hash)
+        self.failUnless(os.path.isfile(path))
+        self.failUnlessEqual(open(path, 'rb').read(), 'abc  h\xc3\xa9lloworld.ooc\n')
+        self.failUnlessEqual(Variant.objects.get(id=self.variant.id).checksums, u'abc  h\xe9lloworld.ooc\n')
+        response = self.client.get('/packages/helloworld/0.2/src/helloworld.checksums')
+        self.failUnlessEqual(response.content, 'abc  h\xc3\xa9lloworld.ooc\n')
+
+    def test_sendfile(self):
+        settings.BLOB_SENDFILE_HEADER = 'X-Sendfile'
+        cache_stats.reset()
+        for i in range(2):
+            response = self.client.get('/packages/helloworld/0.2/src/helloworld.checksums')
+            self.failUnlessEqual(response['X-Sendfile'], blobs.get_blob_store().path(self.variant.checksums_hash))
+            self.failUnlessEqual(response.content, '')
+            self.failUnlessEqual(response['ETag'], '"%s"' % self.variant.checksums_hash)
+        # the web server sends the content, so there is nothing to cache.
+        self.failUnlessEqual(cache_stats.hits, 0)
+
+    def test_collect(self):
+        store = blobs.get_blob_store()
+        path = store.path(self.variant.checksums_hash)
+        os.utime(path, (0, 0))
+        self.failUnlessEqual(store.delete_many([self.variant.checksums_hash], 60), 0)
+        self.failUnless(os.path.isfile(path))
+        store.put(u'abc  h\xe9lloworld.ooc\n')
+        self.failUnless(os.path.getmtime(path) > 0)
+        self.variant.checksums = u'def  helloworld.ooc\n'
+        self.variant.save()
+        self.failUnlessEqual(blobs.collect_garbage(), 0)
+        self.failUnlessEqual(blobs.collect_garbage(min_age=-1), 1)
+        self.failIf(os.path.exists(path))
+
+class PublishTest(PackageTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        settings.PUBLISH_ROOT = self.root
+        super(PublishTest, self).setUp()
+
+    def tearDown(self):
+        super(PublishTest, self).tearDown()
+        settings.PUBLISH_ROOT = None
+        shutil.rmtree(self.root)
+
+    def read(self, path):
+        return open(os.path.join(self.root, path)).read()
+
+    def exists(self, path):
+        return os.path.exists(os.path.join(self.root, path))
+
+    def test_variant(self):
+        variant = self.create_variant('src', self.version, checksums='abc  helloworld.ooc\n')
+        for url in ('packages/helloworld/0.2/src/helloworld.use', 'packages/helloworld/latest/src/helloworld.use'):
+            self.failUnlessEqual(self.read(url), USEFILE % ('0.2', 'src'))
+            self.failUnlessEqual(self.read(url), self.client.get('/' + url).content)
+        self.failUnlessEqual(self.read('packages/helloworld/0.2/src/helloworld.checksums'), 'abc  helloworld.ooc\n')
+        self.failUnlessEqual(self.read('packages/helloworld/0.2/src/helloworld.checksums.sig'),
+                self.client.get('/packages/helloworld/0.2/src/helloworld.checksums.sig').content)
+        variant.slug = 'source'
+        variant.save()
+        self.failIf(self.exists('packages/helloworld/0.2/src'))
+        self.failUnless(self.exists('packages/helloworld/0.2/source/helloworld.use'))
+        variant.delete()
+        self.failIf(self.exists('packages/helloworld/0.2/source'))
+
+    def test_pending_signature(self):
+        variant = self.create_variant('src', self.version)
+        Variant.objects.filter(id=variant.id).update(signature_pending=True)
+        publish.publish_variants(Variant.objects.filter(id=variant.id).select_related('version'))
+        self.failUnless(self.exists('packages/helloworld/0.2/src/helloworld.use'))
+        self.failIf(self.exists('packages/helloworld/0.2/src/helloworld.checksums.sig'))
+
+    def test_latest(self):
+        self.create_variant('src', self.version)
+        self.failUnlessEqual(os.readlink(os.path.join(self.root, 'packages/helloworld/latest')), '0.2')
+        version = self.create_version('0.3', latest=True)
+        self.create_variant('src', version)
+        self.failUnlessEqual(self.read('packages/helloworld/latest/src/helloworld.use'), USEFILE % ('0.3', 'src'))
+        version.latest = False
+        version.save()
+        self.failIf(self.exists('packages/helloworld/latest'))
+
+    def test_rebuild(self):
+        self.create_variant('src', self.version)
+        shutil.rmtree(os.path.join(self.root, 'packages'))
+        os.makedirs(os.path.join(self.root, 'packages/gone/0.1'))
+        self.failUnlessEqual(publish.rebuild(workers=0), 1)
+        self.failUnless(self.exists('packages/helloworld/latest/src/helloworld.use'))
+        self.failIf(self.exists('packages/gone'))
+
+class TokenTest(PackageTestCase):
+    def tearDown(self):
+        super(TokenTest, self).tearDown()
+        settings.API_LEGACY_TOKENS = True
+
+    def submit(self, token):
+        return simplejson.loads(self.client.post('/api/submit/', {
+            'usefile': USEFILE % ('0.2', 'src'),
+            'user': 'fred',
+            'slug': 'helloworld',
+            'token': token,
+        }).content)
+
+    def test_create(self):
+        api_token, token = create_token(self.user, 'laptop')
+        self.failUnlessEqual(api_token.token_hash, hash_token(token))
+        self.failIf(ApiToken.objects.filter(token_hash=token).exists())
+        self.failUnlessEqual(authenticate('fred', token, 'submit'), self.user)
+        self.failUnlessEqual(self.submit(token)['__result'], 'ok')
+        self.failUnlessRaises(InvalidToken, authenticate, 'other', token, 'submit')
+        self.failUnlessRaises(InvalidToken, authenticate, 'fred', token + 'x', 'submit')
+
+    def test_scopes(self):
+        api_token, token = create_token(self.user, scopes=['check'])
+        self.failUnlessEqual(authenticate('fred', token, 'check'), self.user)
+        self.failUnlessRaises(InvalidToken, authenticate, 'fred', token, 'submit')
+        self.failUnlessEqual(self.submit(token)['__text'], 'The api token is incorrect.')
+
+    def test_expired(self):
+        api_token, token = create_token(self.user, expires=timedelta(days=-1))
+        self.failUnlessRaises(InvalidToken, authenticate, 'fred', token, 'submit')
+
+    def test_revoke(self):
+        api_token, token = create_token(self.user)
+        self.failUnlessEqual(authenticate('fred', token, 'submit'), self.user)
+        self.client.login(username='fred', password='secret')
+        response = self.client.post('/token/', {'revoke': str(api_token.id)})
+        self.failUnlessEqual(response.status_code, 302)
+        self.failUnlessRaises(InvalidToken, authenticate, 'fred', token, 'submit')
+
+    def test_page(self):
+        self.client.login(username='fred', password='secret')
+        response = self.client.post('/token/', {'name': 'ci', 'scopes': ['submit'], 'expires_days': '30'})
+        api_token = ApiToken.objects.get(user=self.user)
+        self.failUnlessEqual((api_token.name, api_token.scopes), ('ci', 'submit'))
+        self.failUnless(api_token.expires is not None)
+        token = re.search(r'new api token is: <b>(\w+)</b>', response.content).group(1)
+        self.failUnlessEqual(authenticate('fred', token, 'submit'), self.user)
+
+    def test_legacy(self):
+        self.failUnlessEqual(authenticate('fred', get_api_token(self.user), 'submit'), self.user)
+        settings.API_LEGACY_TOKENS = False
+        self.failUnlessRaises(InvalidToken, authenticate, 'fred', get_api_token(self.user), 'check')
+
+class CacheTest(PackageTestCase):
+    def test_hit(self):
+        self.create_variant('src', self.version)
+        cache_stats.reset()
+        first = self.client.get('/packages/helloworld/latest/src/helloworld.use')
+        second = self.client.get('/packages/helloworld/latest/src/helloworld.use')
+        self.failUnlessEqual(first.content, second.content)
+        self.failUnlessEqual(first['ETag'], second['ETag'])
+        self.failUnlessEqual((cache_stats.hits, cache_stats.misses), (1, 1))
+        response = self.client.get('/packages/helloworld/latest/src/helloworld.use',
+                HTTP_IF_NONE_MATCH=first['ETag'])
+        self.failUnlessEqual(response.status_code, 304)
+
+    def test_make_latest(self):
+        self.failUnlessEqual(self.get_json('/api/packages/helloworld/latest/', {'type': 'details'})['slug'], '0.2')
+        self.create_version('0.3', latest=True)
+        self.failUnlessEqual(self.get_json('/api/packages/helloworld/latest/', {'type': 'details'})['slug'], '0.3')
+
+    def test_errors_not_cached(self):
+        cache_stats.reset()
+        self.get_json('/api/categories/', {'type': 'wrong'})
+        self.get_json('/api/categories/', {'type': 'wrong'})
+        self.failUnlessEqual(cache_stats.hits, 0)
+
+    def test_disabled(self):
+        settings.PKG_CACHE_BACKEND = None
+        self.failIf(is_cache_enabled() or is_shared_cache())
+        self.create_variant('src', self.version)
+        cache_stats.reset()
+        for i in range(2):
+            self.client.get('/packages/helloworld/latest/src/helloworld.use')
+        self.failUnlessEqual((cache_stats.hits, cache_stats.misses), (0, 0))
+        self.create_version('0.3', latest=True)
+        self.failUnlessEqual(self.get_json('/api/packages/helloworld/latest/', {'type': 'details'})['slug'], '0.3')
+        settings.PKG_CACHE_BACKEND = 'file:///var/tmp/nirvana_cache'
+        self.failUnless(is_shared_cache())
+
+    def test_stats(self):
+        result = self.get_json('/api/cache/')
+        self.failUnless('hits' in result and 'misses' in result)
+
+class CompressionTest(PackageTestCase):
+    def setUp(self):
+        super(CompressionTest, self).setUp()
+        self.old_min_size = getattr(settings, 'COMPRESS_MIN_SIZE', DEFAULT_COMPRESS_MIN_SIZE)
+        settings.COMPRESS_MIN_SIZE = 0
+        self.create_variant('src', self.version, checksums='abc  helloworld.ooc\n')
+
+    def tearDown(self):
+        super(CompressionTest, self).tearDown()
+        settings.COMPRESS_MIN_SIZE = self.old_min_size
+
+    def gunzip(self, content):
+        return gzip.GzipFile(fileobj=StringIO(content)).read()
+
+    def test_json(self):
+        plain = self.client.get('/api/packages/helloworld/')
+        self.failUnlessEqual(plain['Content-Type'], 'application/json; charset=utf-8')
+        self.failIf(plain.has_header('Content-Encoding'))
+        compressed = self.client.get('/api/packages/helloworld/', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.failUnlessEqual(compressed['Content-Encoding'], 'gzip')
+        self.failUnlessEqual(compressed['Vary'], 'Accept-Encoding')
+        # every representation has its own ETag.
+        self.failUnlessEqual(compressed['ETag'], plain['ETag'][:-1] + '-gzip"')
+        self.failUnlessEqual(self.gunzip(compressed.content), plain.content)
+        # served from the cache now
+        compressed = self.client.get('/api/packages/helloworld/', HTTP_ACCEPT_ENCODING='gzip')
+        self.failUnlessEqual(compressed['ETag'], plain['ETag'][:-1] + '-gzip"')
+        self.failUnlessEqual(self.gunzip(compressed.content), plain.content)
+        deflated = self.client.get('/api/packages/helloworld/', HTTP_ACCEPT_ENCODING='gzip;q=0, deflate')
+        self.failUnlessEqual(deflated['Content-Encoding'], 'deflate')
+        self.failUnlessEqual(deflated['ETag'], plain['ETag'][:-1] + '-deflate"')
+        self.failUnlessEqual(zlib.decompress(deflated.content), plain.content)
+
+    def test_conditional(self):
+        for url in ('/api/packages/helloworld/', '/packages/helloworld/latest/src/helloworld.checksums'):
+            compressed = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+            self.failUnless(compressed['ETag'].endswith('-gzip"'), url)
+            response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=compressed['ETag'])
+            self.failUnlessEqual(response.status_code, 304, url)
+            self.failUnlessEqual(response['ETag'], compressed['ETag'])
+            self.failUnlessEqual(response['Vary'], 'Accept-Encoding')
+
+    def test_download(self):
+        url = '/packages/helloworld/latest/src/helloworld.checksums'
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.failUnlessEqual(response['Content-Type'], 'text/plain; charset=utf-8')
+        self.failUnlessEqual(self.gunzip(response.content), 'abc  helloworld.ooc\n')
+
+    def test_threshold(self):
+        settings.COMPRESS_MIN_SIZE = 10000
+        response = self.client.get('/api/packages/helloworld/', HTTP_ACCEPT_ENCODING='gzip')
+        self.failIf(response.has_header('Content-Encoding'))
+
+    def test_encoders(self):
+        result = {'__result': 'ok', 'name': u'H\xe9llo', 'versions': ['0.1', '0.2'], 'latest': True}
+        for name, dumps in get_available_encoders():
+            self.failUnlessEqual(simplejson.loads(dumps(result)), result)
+
+class LatestVersionTest(PackageTestCase):
+    def get_package(self):
+        return Package.objects.get(slug='helloworld')
+
+    def test_make_latest(self):
+        self.failUnlessEqual(self.get_package().latest_version, self.version)
+        version = self.create_version('0.3', latest=True)
+        self.failUnlessEqual(self.get_package().latest_version, version)
+        self.failUnlessEqual(list(Version.objects.filter(latest=True)), [version])
+        version.latest = False
+        version.save()
+        self.failUnlessEqual(self.get_package().latest_version, None)
+
+    def test_save_package(self):
+        self.package.name = 'Hello!'
+        self.package.save()
+        self.failUnlessEqual(self.get_package().latest_version, self.version)
+
+    def test_delete_latest(self):
+        self.version.delete()
+        self.failUnlessEqual(self.get_package().latest_version, None)
+        Version.objects.filter(slug='0.1').delete()
+        self.create_version('0.3', latest=True)
+        Version.objects.all().delete()
+        self.failUnlessEqual(self.get_package().latest_version, None)
+
+class PermissionTest(PackageTestCase):
+    def setUp(self):
+        super(PermissionTest, self).setUp()
+        self.manager = User.objects.create_user('manager', 'manager@example.org', 'secret')
+        self.create_variant('src', self.version)
+        self.create_variant('linux', self.version)
+
+    def test_author(self):
+        self.failUnless(self.package.is_authorized_for_variant(self.user, 'anything'))
+        self.failUnlessEqual(sorted(self.package.get_authorized_variants(self.user)), ['linux', 'src'])
+
+    def test_manager(self):
+        self.failIf(self.package.is_authorized_for_variant(self.manager, 'src'))
+        permission = ManagerPermission.objects.create(package=self.package, user=self.manager, variant_slug='src')
+        self.failUnless(self.package.is_authorized_for_variant(self.manager, 'src'))
+        self.failIf(self.package.is_authorized_for_variant(self.manager, 'linux'))
+        self.failUnlessEqual(self.package.get_authorized_variants(self.manager), ['src'])
+        permission.delete()
+        self.failIf(self.package.is_authorized_for_variant(self.manager, 'src'))
+
+    def test_revoked_elsewhere(self):
+        ManagerPermission.objects.create(package=self.package, user=self.manager, variant_slug='src')
+        self.failUnlessEqual(self.package.get_authorized_variants(self.manager), ['src'])
+        # another process revokes it, this one is not told.
+        ManagerPermission.objects.filter(user=self.manager).update(variant_slug='linux')
+        self.failUnlessEqual(self.package.get_authorized_variants(self.manager), ['linux'])
+        self.failIf(self.package.is_authorized_for_variant(self.manager, 'src'))
+
+    def test_shared_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            settings.PKG_CACHE_BACKEND = 'file://%s' % directory
+            ManagerPermission.objects.create(package=self.package, user=self.manager, variant_slug='src')
+            self.failUnlessEqual(self.package.get_authorized_variants(self.manager), ['src'])
+            ManagerPermission.objects.filter(user=self.manager).update(variant_slug='linux')
+            # the cached variants are only shown, authorization is checked anew.
+            self.failUnlessEqual(self.package.get_authorized_variants(self.manager), ['src'])
+            self.failIf(self.package.is_authorized_for_variant(self.manager, 'src'))
+            ManagerPermission.objects.get(user=self.manager).delete()
+            self.failUnlessEqual(self.package.get_authorized_variants(self.manager), [])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_edit_managers(self):
+        self.client.login(username='fred', password='secret')
+        self.failIf(self.package.is_authorized_for_variant(self.manager, 'linux'))
+        response = self.client.post('/package/helloworld/managers/', {
+            'form-TOTAL_FORMS': '1',
+            'form-INITIAL_FORMS': '0',
+            'form-0-user': str(self.manager.id),
+            'form-0-variant_slug': 'linux',
+        })
+        self.failUnlessEqual(response.status_code, 302)
+        self.failUnless(self.package.is_authorized_for_variant(self.manager, 'linux'))
+
+class BatchSubmitTest(PackageTestCase):
+    def submit(self, variants, **kwargs):
+        data = {
+            'user': 'fred',
+            'token': get_api_token(self.user),
+            'slug': 'helloworld',
+            'variants': simplejson.dumps(variants),
+        }
+        data.update(kwargs)
+        response = self.client.post('/api/submit/batch/', data)
+        self.failUnlessEqual(response.status_code, 200)
+        return simplejson.loads(response.content)
+
+    def test_submit(self):
+        result = self.submit([
+            {'usefile': USEFILE % ('0.2', 'src'), 'checksums': 'D41D8CD98F00B204E9800998ECF8427E *foo.ooc'},
+            {'usefile': USEFILE % ('0.1', 'linux'), 'name': 'Linux'},
+        ])
+        self.failUnlessEqual(result['__result'], 'ok')
+        self.failUnlessEqual([r['path'] for r in result['variants']],
+                ['/packages/helloworld/0.2/src/', '/packages/helloworld/0.1/linux/'])
+        variant = Variant.objects.get(version=self.version, slug='src')
+        self.failUnlessEqual(variant.checksums_signature, 'signature of d41d8cd98f00b204e9800998ecf8427e  foo.ooc\n')
+        self.failUnlessEqual(variant.checksums_hash, content_hash(variant.checksums))
+        self.failUnlessEqual(Variant.objects.get(version=self.old_version).name, 'Linux')
+        self.failUnless('helloworld' in self.get_json('/api/search/', {'pattern': 'meatshop'}))
+
+    def test_invalid(self):
+        variants = [
+            {'usefile': USEFILE % ('0.2', 'src')},
+            {'usefile': USEFILE % ('0.2', 'src')},
+            {'usefile': USEFILE % ('0.9', 'src')},
+        ]
+        result = self.submit(variants)
+        self.failUnlessEqual(result['__result'], 'error')
+        self.failUnlessEqual([r['__result'] for r in result['variants']], ['skipped', 'error', 'error'])
+        self.failIf(Variant.objects.all())
+        result = self.submit(variants, skip_invalid='1')
+        self.failUnlessEqual([r['__result'] for r in result['variants']], ['ok', 'error', 'error'])
+        self.failUnlessEqual(Variant.objects.count(), 1)
+
+    def test_wrong_token(self):
+        result = self.submit([], token='wrong')
+        self.failUnlessEqual(result['__result'], 'error')
+
+class UniqueTest(PackageTestCase):
+    def test_submit_duplicate(self):
+        self.create_variant('src', self.version)
+        result = simplejson.loads(self.client.post('/api/submit/', {
+            'usefile': USEFILE % ('0.2', 'src'),
+            'user': 'fred',
+            'slug': 'helloworld',
+            'token': get_api_token(self.user),
+        }).content)
+        self.failUnlessEqual(result['__text'], 'A variant like this already exists.')
+        self.failUnlessEqual(Variant.objects.filter(version=self.version).count(), 1)
+
+    def post(self, view, data, *args):
+        request = HttpRequest()
+        request.method = 'POST'
+        request.user = self.user
+        request.POST.update(data)
+        return view(request, *args)
+
+    def test_new_duplicates(self):
+        self.create_variant('src', self.version)
+        self.failUnlessRaises(Http404, self.post, views.version_new, {'slug': '0.1', 'name': ''}, 'helloworld')
+        self.failUnlessEqual(Version.objects.filter(package=self.package).count(), 2)
+        self.failUnlessRaises(Http404, self.post, views.version_edit, {'slug': '0.2', 'name': ''},
+                'helloworld', '0.1')
+        self.failUnlessRaises(Http404, self.post, views.variant_new, {'slug': 'src', 'name': '',
+            'usefile': USEFILE % ('0.2', 'src'), 'checksums': ''}, 'helloworld', '0.2')
+        self.failUnlessEqual(Variant.objects.filter(version=self.version).count(), 1)
+
+    def test_indexes(self):
+        from django.db import connection
+        from nirvana.pkg.management.commands.add_indexes import INDEXES, get_indexes
+        cursor = connection.cursor()
+        for name, model, fields, unique in INDEXES:
+            columns = tuple(model._meta.get_field(field).column for field in fields)
+            self.failUnless((unique, columns) in get_indexes(cursor, model._meta.db_table).values(), name)
+
+    def test_columns(self):
+        from django.core.management.base import CommandError
+        from nirvana.pkg.upgrade import get_missing_columns, check_columns
+        self.failUnlessEqual(get_missing_columns(Package, Version, Variant), [])
+        column = Version._meta.get_field('version_key').column
+        Version._meta.get_field('version_key').column = 'version_sort_key'
+        try:
+            self.failUnlessEqual(get_missing_columns(Package, Version), ['pkg_version.version_sort_key'])
+            self.failUnlessRaises(CommandError, check_columns, Version)
+        finally:
+            Version._meta.get_field('version_key').column = column
+
+class DispatchTest(TestCase):
+    PATHS = [
+        '/packages/helloworld/',
+        '/packages/helloworld/latest/',
+        '/packages/helloworld/1.0-rc1/',
+        '/packages/helloworld/latest/src/',
+        '/packages/helloworld/1.0/src/',
+        '/packages/helloworld/latest/src/helloworld.use',
+        '/packages/helloworld/1.0/src/helloworld.use',
+        '/packages/helloworld/1.0/src/helloworld.checksums',
+        '/packages/helloworld/latest/src/helloworld.checksums.sig',
+        '/packages/helloworld/1.0/linux.x86/helloworld.checksums.sig',
+        '/api/packages/helloworld/',
+        '/api/packages/helloworld/latest/',
+        '/api/packages/helloworld/resolve/',
+        '/api/packages/helloworld/0.2/',
+        '/api/packages/helloworld/latest/src/',
+        '/api/packages/helloworld/0.2/src/',
+        '/api/packages/helloworld/latest/src/dependencies/',
+        '/api/packages/helloworld/0.2/src/dependencies/',
+        '/api/categories/',
+        '/package/helloworld/0.2/src/edit/',
+    ]
+
+    NOT_FOUND = [
+        '/packages/helloworld',
+        '/packages/helloworld/0.2/src/helloworld.zip',
+        '/packages/helloworld/0.2/src/helloworld.use/',
+        '/packages/hello.world/',
+        '/packages/helloworld/0.2/src/extra/helloworld.use',
+        '/api/packages/helloworld/0.2/src/other/',
+        '/api/packages/helloworld/0.2',
+    ]
+
+    def setUp(self):
+        from nirvana import urls
+        self.regex = RegexURLResolver(r'^/', flatten(urls.urlpatterns))
+        self.dispatch = RegexURLResolver(r'^/', urls.urlpatterns)
+
+    def test_same_views(self):
+        for path in self.PATHS:
+            self.failUnlessEqual(self.dispatch.resolve(path), self.regex.resolve(path), path)
+
+    def test_not_found(self):
+        for path in self.NOT_FOUND:
+            self.failUnlessRaises(Resolver404, self.dispatch.resolve, path)
+            self.failUnlessRaises(Resolver404, self.regex.resolve, path)
+
+    def test_reverse(self):
+        self.failUnlessEqual(reverse('nirvana.pkg.views.usefile',
+            kwargs={'slug': 'helloworld', 'version_slug': '1.0', 'variant_slug': 'src', 'usefile': 'helloworld'}),
+            '/packages/helloworld/1.0/src/helloworld.use')
+        self.failUnlessEqual(reverse('nirvana.pkg.views.api_dependencies',
+            kwargs={'slug': 'helloworld', 'variant_slug': 'src', 'version_slug': '0.2'}),
+            '/api/packages/helloworld/0.2/src/dependencies/')
+
+    def test_reserved_version_slugs(self):
+        from nirvana.pkg.forms import NewVersionForm
+        form = NewVersionForm({'slug': 'latest', 'name': ''})
+        self.failIf(form.is_valid())
+        self.failUnless(NewVersionForm({'slug': '1.0', 'name': ''}).is_valid())
+
+class ManifestTest(PackageTestCase):
+    def setUp(self):
+        super(ManifestTest, self).setUp()
+        self.old_settle_time = getattr(settings, 'SEQUENCE_SETTLE_TIME', None)
+        settings.SEQUENCE_SETTLE_TIME = 0
+
+    def tearDown(self):
+        super(ManifestTest, self).tearDown()
+        settings.SEQUENCE_SETTLE_TIME = self.old_settle_time
+
+    def get_manifest(self):
+        update_manifest()
+        response = self.client.get('/api/manifest/')
+        self.failUnlessEqual(response.status_code, 200)
+        return response, simplejson.loads(response.content)
+
+    def test_manifest(self):
+        variant = self.create_variant('src', self.version, checksums='abc  helloworld.ooc\n')
+        variant.set_signature()
+        variant.save()
+        response, manifest = self.get_manifest()
+        package = manifest['packages']['helloworld']
+        self.failUnlessEqual(package['latest'], '0.2')
+        self.failUnlessEqual(sorted(package['versions']), ['0.1', '0.2'])
+        self.failIf(package['versions']['0.1']['latest'])
+        self.failUnlessEqual(package['versions']['0.2']['variants']['src'], {
+            'usefile': content_hash(USEFILE % ('0.2', 'src')),
+            'checksums': content_hash('abc  helloworld.ooc\n'),
+            'checksums_signature': content_hash(fake_sign('abc  helloworld.ooc\n')),
+        })
+        self.failUnlessEqual(response['ETag'], '"%s"' % content_hash(response.content))
+        self.failUnlessEqual(self.client.get('/api/manifest/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        signature = self.client.get(response['X-Manifest-Signature'])
+        self.failUnlessEqual(signature.content, fake_sign(response.content))
+        blob = self.client.get('/api/blobs/%s/' % package['versions']['0.2']['variants']['src']['usefile'])
+        self.failUnlessEqual(blob.content, USEFILE % ('0.2', 'src'))
+
+    def test_incremental(self):
+        other = Package.objects.create(slug='other', name='Other', author=self.user, category=self.category)
+        first = update_manifest()
+        self.failUnless(update_manifest() == first)
+        self.create_variant('src', self.old_version)
+        self.failUnlessEqual(changed_packages(first.sequence), set(['helloworld']))
+        second = update_manifest()
+        self.failIfEqual(second.content_hash, first.content_hash)
+        self.old_version.delete()
+        other.delete()
+        response, manifest = self.get_manifest()
+        self.failUnlessEqual(manifest, simplejson.loads(self.client.get(
+            '/api/blobs/%s/' % update_manifest(full=True).content_hash).content))
+        self.failUnlessEqual(manifest['packages'].keys(), ['helloworld'])
+        self.failUnlessEqual(manifest['packages']['helloworld']['versions'].keys(), ['0.2'])
+        # the signature of the previous manifest is still there.
+        self.failUnlessEqual(self.client.get('/api/manifest/%s.sig' % second.content_hash).status_code, 200)
+
+    def test_prune(self):
+        self.create_variant('src', self.version)
+        self.old_version.delete()
+        sequence = Change.current_sequence()
+        self.failUnless(Change.objects.filter(deleted=False).count() > 1)
+        update_manifest()
+        # only the deletions and the newest change are left.
+        self.failIf(Change.objects.filter(deleted=False, id__lt=sequence).exists())
+        self.failUnlessEqual(Change.objects.filter(deleted=True).count(), 1)
+        self.failUnlessEqual(changed_packages(0), set(['helloworld']))
+        self.failUnlessEqual(Change.current_sequence(), sequence)
+        self.failUnless(next_sequence() > sequence)
+
+    def test_not_built(self):
+        # requests only serve the manifest, they never build it.
+        request = HttpRequest()
+        request.method = 'GET'
+        self.failUnlessRaises(Http404, views.api_manifest, request)
+        self.failIf(Manifest.objects.exists())
+
+    def test_late_commit(self):
+        settings.SEQUENCE_SETTLE_TIME = 60
+        # a transaction takes a sequence, another one commits a change after it ...
+        sequence = next_sequence()
+        self.create_variant('src', self.version)
+        first = update_manifest()
+        self.failUnless(first.sequence < sequence)
+        # ... and the first one commits later.
+        Version.objects.filter(id=self.old_version.id).update(latest=True, sequence=sequence)
+        response, manifest = self.get_manifest()
+        self.failUnless(manifest['packages']['helloworld']['versions']['0.1']['latest'])
+
+    def test_unchanged(self):
+        first = update_manifest()
+        self.package.homepage = 'http://example.org'
+        self.package.save()
+        self.failUnlessEqual(update_manifest().id, first.id)
+        self.failUnlessEqual(Manifest.objects.count(), 1)
+
+class ChecksumTest(PackageTestCase):
+    MD5 = 'd41d8cd98f00b204e9800998ecf8427e'
+    SHA1 = 'da39a3ee5e6b4b0d3255bfef95601890afd80709'
+    SHA256 = 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'
+
+    def test_parse(self):
+        self.failUnlessEqual(parse_checksums(
+            '# checksums\n'
+            '%s  helloworld.ooc\n'
+            '\n'
+            '%s *helloworld.png\n'
+            'SHA256 (source/main file.ooc) = %s\n' % (self.MD5.upper(), self.SHA1, self.SHA256)), [
+            ('md5', self.MD5, 'helloworld.ooc'),
+            ('sha1', self.SHA1, 'helloworld.png'),
+            ('sha256', self.SHA256, 'source/main file.ooc'),
+        ])
+        self.failUnlessEqual(normalize_checksums('%s *a.ooc\nSHA1 (b.ooc) = %s' % (self.MD5, self.SHA1)),
+                '%s  a.ooc\n%s  b.ooc\n' % (self.MD5, self.SHA1))
+        self.failUnlessEqual(normalize_checksums(''), '')
+
+    def test_errors(self):
+        for source, lineno in [
+                ('abc  foo.ooc', 1),
+                ('%s  foo.ooc\nbroken' % self.MD5, 2),
+                ('%s  foo.ooc\n%s  foo.ooc' % (self.MD5, self.SHA1), 2),
+                ('MD5 (foo.ooc) = %s' % self.SHA1, 1),
+                ('%s  %s' % (self.MD5, 'x' * 256), 1),
+                ]:
+            try:
+                parse_checksums(source)
+            except ChecksumsSyntaxError, e:
+                self.failUnlessEqual(e.lineno, lineno)
+            else:
+                self.fail('%r was accepted' % source)
+
+    def submit(self, checksums):
+        return simplejson.loads(self.client.post('/api/submit/', {
+            'usefile': USEFILE % ('0.2', 'src'),
+            'user': 'fred',
+            'slug': 'helloworld',
+            'token': get_api_token(self.user),
+            'checksums': checksums,
+        }).content)
+
+    def test_submit(self):
+        result = self.submit('%s  foo.ooc\n%s  foo.ooc' % (self.MD5, self.MD5))
+        self.failUnlessEqual(result['__text'], 'Checksums line 2: foo.ooc is listed twice.')
+        self.failIf(Variant.objects.all())
+        result = self.submit('SHA1 (foo.ooc) = %s' % self.SHA1.upper())
+        self.failUnlessEqual(result['__result'], 'ok')
+        variant = Variant.objects.get(version=self.version, slug='src')
+        self.failUnlessEqual(variant.checksums, '%s  foo.ooc\n' % self.SHA1)
+        self.failUnlessEqual(list(Checksum.objects.values_list('variant', 'algorithm', 'hash', 'filename')),
+                [(variant.id, 'sha1', self.SHA1, 'foo.ooc')])
+
+    def test_lookup(self):
+        first = self.create_variant('src', self.old_version, checksums='%s  foo.ooc\n' % self.MD5)
+        self.create_variant('src', self.version, checksums='%s  bar.ooc\n%s  foo.ooc\n' % (self.MD5, self.SHA1))
+        self.create_variant('broken', self.version, checksums='%s  foo.ooc\nbroken\n' % self.MD5)
+        self.failUnlessEqual(self.get_json('/api/checksums/%s/' % self.MD5.upper())['files'], [
+            {'package': 'helloworld', 'version': '0.1', 'variant': 'src', 'filename': 'foo.ooc', 'algorithm': 'md5'},
+            {'package': 'helloworld', 'version': '0.2', 'variant': 'src', 'filename': 'bar.ooc', 'algorithm': 'md5'},
+        ])
+        # editing the checksums replaces the rows.
+        first.checksums = '%s  foo.ooc\n' % self.SHA256
+        first.save()
+        self.failUnlessEqual(len(self.get_json('/api/checksums/%s/' % self.MD5)['files']), 1)
+        self.failUnlessEqual(self.get_json('/api/checksums/%s/' % self.SHA256)['files'][0]['version'], '0.1')
+        first.delete()
+        self.failIf(self.get_json('/api/checksums/%s/' % self.SHA256)['files'])
+
+    def test_rebuild(self):
+        from nirvana.pkg.management.commands.rebuild_checksums import Command
+        self.create_variant('src', self.old_version, checksums='%s  foo.ooc\n' % self.MD5)
+        self.create_variant('src', self.version, checksums='%s  bar.ooc\n' % self.SHA1)
+        Checksum.objects.all().delete()
+        store = blobs.get_blob_store()
+        calls = []
+        store.get_many = lambda hashes: calls.append(hashes) or type(store).get_many(store, hashes)
+        old_stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            Command().handle_noargs()
+        finally:
+            sys.stdout = old_stdout
+            del store.get_many
+        self.failUnlessEqual(len(calls), 1)
+        self.failUnlessEqual(sorted(Checksum.objects.values_list('filename', flat=True)), ['bar.ooc', 'foo.ooc'])
+
+    def get_form(self, checksums):
+        from nirvana.pkg.forms import NewVariantForm
+        form = NewVariantForm({'slug': 'src', 'name': '', 'usefile': USEFILE % ('0.2', 'src'),
+            'checksums': checksums})
+        form.package = self.package
+        form.request = HttpRequest()
+        form.request.user = self.user
+        return form
+
+    def test_form(self):
+        form = self.get_form('abc  foo.ooc')
+        self.failIf(form.is_valid())
+        self.failUnlessEqual(form.errors.keys(), ['checksums'])
+        form = self.get_form('%s *foo.ooc' % self.MD5)
+        self.failUnless(form.is_valid())
+        self.failUnlessEqual(form.cleaned_data['checksums'], '%s  foo.ooc\n' % self.MD5)
+
+class DatabaseTest(PackageTestCase):
+    def setUp(self):
+        super(DatabaseTest, self).setUp()
+        settings.DATABASE_REPLICAS = ['replica']
+        # api clients are only remembered by a shared cache.
+        self.directory = tempfile.mkdtemp()
+        settings.PKG_CACHE_BACKEND = 'file://%s' % self.directory
+        self.middleware = ReplicaMiddleware()
+
+    def tearDown(self):
+        super(DatabaseTest, self).tearDown()
+        self.middleware.process_response(HttpRequest(), HttpResponse())
+        settings.DATABASE_REPLICAS = None
+        settings.TRUSTED_PROXIES = ()
+        shutil.rmtree(self.directory)
+
+    def request(self, addr, view=views.api_package, method='GET', cookies=None, forwarded=None):
+        request = HttpRequest()
+        request.method = method
+        request.META['REMOTE_ADDR'] = addr
+        if forwarded is not None:
+            request.META['HTTP_X_FORWARDED_FOR'] = forwarded
+        request.COOKIES.update(cookies or {})
+        self.middleware.process_request(request)
+        self.middleware.process_view(request, view, (), {'slug': 'helloworld'})
+        return request
+
+    def test_sqlite_pragmas(self):
+        from django.db.backends.sqlite3.base import DatabaseWrapper
+        # pragmas commit, so not in the test database.
+        directory = tempfile.mkdtemp()
+        try:
+            db = DatabaseWrapper({'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(directory, 'test.sqlite'),
+                'OPTIONS': {}}, 'test')
+            cursor = db.cursor()
+            cursor.execute('PRAGMA journal_mode')
+            self.failUnlessEqual(cursor.fetchone()[0], 'wal')
+            cursor.execute('PRAGMA busy_timeout')
+            self.failUnlessEqual(cursor.fetchone()[0], 20000)
+            db.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_read_only_view(self):
+        request = self.request('10.0.0.1')
+        self.failUnlessEqual(router.db_for_read(Package), 'replica')
+        self.failUnlessEqual(router.db_for_write(Package), 'default')
+        with primary():
+            self.failUnlessEqual(router.db_for_read(Package), 'default')
+        self.failUnlessEqual(router.db_for_read(Package), 'replica')
+        self.middleware.process_response(request, HttpResponse())
+        self.failUnlessEqual(router.db_for_read(Package), 'default')
+
+    def test_read_your_writes(self):
+        request = self.request('10.0.0.2', views.api_submit, 'POST')
+        self.failUnlessEqual(router.db_for_read(Package), 'default')
+        response = self.middleware.process_response(request, HttpResponse())
+        self.failUnless(PIN_COOKIE in response.cookies)
+        # the api client is known by its address, browsers by the cookie.
+        self.request('10.0.0.2')
+        self.failUnlessEqual(router.db_for_read(Package), 'default')
+        self.request('10.0.0.3', cookies={PIN_COOKIE: '1'})
+        self.failUnlessEqual(router.db_for_read(Package), 'default')
+        self.request('10.0.0.3')
+        self.failUnlessEqual(router.db_for_read(Package), 'replica')
+
+    def test_proxy(self):
+        settings.TRUSTED_PROXIES = ('127.0.0.1',)
+        request = self.request('127.0.0.1', views.api_submit, 'POST', forwarded='10.0.0.5, 127.0.0.1')
+        self.middleware.process_response(request, HttpResponse())
+        self.request('127.0.0.1', forwarded='10.0.0.5')
+        self.failUnlessEqual(router.db_for_read(Package), 'default')
+        # other clients behind the same proxy are not affected.
+        self.request('127.0.0.1', forwarded='10.0.0.6')
+        self.failUnlessEqual(router.db_for_read(Package), 'replica')
+        self.request('127.0.0.1')
+        self.failUnlessEqual(router.db_for_read(Package), 'replica')
+        # the header of untrusted clients is ignored.
+        self.request('10.0.0.6', forwarded='10.0.0.5')
+        self.failUnlessEqual(router.db_for_read(Package), 'replica')
+
+    def test_local_cache(self):
+        settings.PKG_CACHE_BACKEND = 'nirvana.pkg.lrucache://?max_entries=1000&timeout=300'
+        request = self.request('10.0.0.7', views.api_submit, 'POST')
+        response = self.middleware.process_response(request, HttpResponse())
+        self.failUnless(PIN_COOKIE in response.cookies)
+        # the next request may be served by another process.
+        self.request('10.0.0.7')
+        self.failUnlessEqual(router.db_for_read(Package), 'replica')
+
+    def test_streamed(self):
+        databases = []
+        def body():
+            databases.append(router.db_for_read(Package))
+            yield 'content'
+        request = self.request('10.0.0.8')
+        response = self.middleware.process_response(request, HttpResponse(body()))
+        self.failUnlessEqual(router.db_for_read(Package), 'default')
+        # the body is read after the middleware is done.
+        self.failUnlessEqual(response.content, 'content')
+        self.failUnlessEqual(databases, ['replica'])
+        self.failUnlessEqual(router.db_for_read(Package), 'default')
+
+    def test_recently_changed(self):
+        databases = []
+        @cached_view(lambda: ['database-test'])
+        def view(request):
+            databases.append(router.db_for_read(Package))
+            response = HttpResponse('content')
+            response['ETag'] = '"content"'
+            return response
+        invalidate('database-test')
+        view(self.request('10.0.0.4'))
+        # an hour later.
+        get_response_cache().set('nirvana:gen:database-test', '%08x00000000' % (int(time.time()) - 3600))
+        view(self.request('10.0.0.4'))
+        self.failUnlessEqual(databases, ['default', 'replica'])
+
+class BenchmarkTest(TestCase):
+    def test_percentile(self):
+        values = range(1, 101)
+        self.failUnlessEqual(benchmark.percentile(values, 50), 50)
+        self.failUnlessEqual(benchmark.percentile(values, 99), 99)
+        self.failUnlessEqual(benchmark.percentile([3], 95), 3)
+
+    def test_regressions(self):
+        old = {'usefile': {'client': {'p95': 1.0, 'queries': 3}}}
+        new = {'usefile': {'client': {'p95': 1.2, 'queries': 3}}}
+        self.failUnlessEqual(benchmark.find_regressions(new, old, 0.25), [])
+        new = {'usefile': {'client': {'p95': 1.3, 'queries': 4}}}
+        self.failUnlessEqual(len(benchmark.find_regressions(new, old, 0.25)), 2)
+
+    def test_endpoints(self):
+        old_template_dirs = settings.TEMPLATE_DIRS
+        settings.TEMPLATE_DIRS = (os.path.join(os.path.dirname(os.path.dirname(__file__)), 'templates'),)
+        old_signer = getattr(settings, 'SIGNER', None)
+        settings.SIGNER = 'nirvana.pkg.tests.fake_sign'
+        try:
+            author = benchmark.seed_catalogue(categories=2, packages=3, versions=2, variants=2, permissions=1)
+            results = benchmark.run_benchmark(author, requests=1, http=False)
+        finally:
+            settings.TEMPLATE_DIRS = old_template_dirs
+            settings.SIGNER = old_signer
+        for name, result in results.iteritems():
+            self.failUnlessEqual(result['client']['status'], 200, name)
+        # a cold, a timed and two size requests, each with new variants.
+        self.failUnlessEqual(Variant.objects.filter(slug__startswith='bench-').count(), 4 + 4 * 5)
+        resolvers = benchmark.compare_resolvers(author, rounds=1)
+        self.failUnlessEqual(set(resolvers), set(results))
+
+class InstrumentationTest(PackageTestCase):
+    def test_server_timing(self):
+        reset_histograms()
+        response = self.client.get('/api/packages/helloworld/?type=details')
+        self.failUnless('queries' in response['Server-Timing'])
+        self.failUnless('json;dur=' in response['Server-Timing'])
+        histograms = get_histograms()
+        self.failUnlessEqual(histograms['nirvana.pkg.views.api_package']['count'], 1)
+
+    def test_streamed(self):
+        queries = []
+        for data in ({'type': 'details', 'stream': 'ndjson'}, {'type': 'details'}):
+            reset_histograms()
+            response = self.client.get('/api/packages/helloworld/', data)
+            self.failUnless(response.content)
+            histogram = get_histograms()['nirvana.pkg.views.api_package']
+            self.failUnlessEqual(histogram['count'], 1)
+            queries.append(histogram['mean_queries'])
+        # the listing query is counted although it runs after the middleware.
+        self.failUnlessEqual(queries[0], queries[1])
+
+    def test_stats_for_staff_only(self):
+        # non-staff users get the admin login form.
+        response = self.client.get('/api/stats/')
+        self.failIf('endpoints' in response.content)
+        self.user.is_staff = True
+        self.user.save()
+        self.client.login(username='fred', password='secret')
+        result = self.get_json('/api/stats/')
+        self.failUnless('endpoints' in result)
+
+class QueryCountTest(PackageTestCase):
+    def count_queries(self, url):
+        response = self.client.get(url)
+        self.failUnlessEqual(response.status_code, 200)
+        return int(re.search(r'"(\d+) queries"', response['Server-Timing']).group(1))
+
+    def add_rows(self, start, count):
+        for i in range(start, start + count):
+            package = Package.objects.create(slug='package-%d' % i, name='Package %d' % i,
+                    author=self.user, category=self.category)
+            self.create_version('1.0', latest=True, package=package)
+            version = self.create_version('%d.0' % (i + 3))
+            self.create_variant('variant-%d' % i, version)
+            self.create_variant('variant-%d' % i, self.version)
+            ManagerPermission.objects.create(package=self.package, user=self.user, variant_slug='variant-%d' % i)
+        Category.objects.create(slug='category-%d' % start, name='Category')
+
+    def test_constant_queries(self):
+        self.client.login(username='fred', password='secret')
+        urls = ['/categories/', '/category/nonsense/', '/category/my/',
+                '/packages/helloworld/', '/packages/helloworld/0.2/', '/packages/helloworld/latest/']
+        self.add_rows(0, 1)
+        counts = [self.count_queries(url) for url in urls]
+        self.add_rows(1, 5)
+        self.failUnlessEqual([self.count_queries(url) for url in urls], counts)
@@ -0,0 +1,140 @@
+"""
+    Api tokens.
+
+    A user can have several tokens (`ApiToken`), each with scopes and an
+    optional expiry date. Tokens are random; only their SHA-256 hash is
+    stored, so a token is found by its hash with one indexed lookup and
+    never compared character by character.
+
+    Verified tokens are remembered in memory for `API_TOKEN_CACHE_TIMEOUT`
+    seconds (default: 60), so repeated submissions skip the database. A
+    revoked token keeps working in other processes for at most that long.
+
+    The old token derived from the username and the password hash (see
+    `nirvana.pkg.stuff.get_api_token`) is accepted with all scopes unless
+    `API_LEGACY_TOKENS` is False.
+"""
+import os
+import hmac
+import hashlib
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from nirvana.pkg.models import ApiToken
+from nirvana.pkg.lrucache import CacheClass
+from nirvana.pkg.stuff import get_api_token
+
+SCOPES = (
+    ('submit', 'Submit variants'),
+    ('check', 'Check authorization'),
+)
+
+DEFAULT_CACHE_TIMEOUT = 60
+
+TOKEN_BYTES = 20
+
+class InvalidToken(Exception):
+    def __init__(self, message='The api token is incorrect.'):
+        super(InvalidToken, self).__init__(message)
+
+def constant_time_compare(a, b):
+    """
+        Compare the strings *a* and *b* in a time that does not depend on
+        where they differ.
+    """
+    if hasattr(hmac, 'compare_digest'):
+        return hmac.compare_digest(a, b)
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+def hash_token(token):
+    if isinstance(token, unicode):
+        token = token.encode('utf-8')
+    return hashlib.sha256(token).hexdigest()
+
+def generate_token():
+    return os.urandom(TOKEN_BYTES).encode('hex')
+
+def create_token(user, name='', scopes=None, expires=None):
+    """
+        Create a token for *user* with *scopes* (default: all) that expires
+        after the timedelta *expires*, if given. Return a tuple (`ApiToken`,
+        token); the token itself is not stored and can't be shown again.
+    """
+    if scopes is None:
+        scopes = [scope for scope, description in SCOPES]
+    token = generate_token()
+    api_token = ApiToken(user=user, name=name, token_hash=hash_token(token), scopes=' '.join(scopes))
+    if expires is not None:
+        api_token.expires = datetime.now() + expires
+    api_token.save()
+    return api_token, token
+
+_cache = None
+
+def _get_cache():
+    global _cache
+    if _cache is None:
+        _cache = CacheClass('', {
+            'max_entries': 10000,
+            'timeout': getattr(settings, 'API_TOKEN_CACHE_TIMEOUT', DEFAULT_CACHE_TIMEOUT),
+        })
+    return _cache
+
+def forget(token_hash):
+    """
+        Drop the token with the hash *token_hash* from this process' cache.
+    """
+    _get_cache().delete('token:%s' % token_hash)
+
+def _lookup(token_hash):
+    """
+        Return a tuple (user, scopes, expiry date) of the token hashed to
+        *token_hash*, or None.
+    """
+    key = 'token:%s' % token_hash
+    entry = _get_cache().get(key)
+    if entry is None:
+        tokens = ApiToken.objects.filter(token_hash=token_hash).select_related('user')
+        if not tokens:
+            return None
+        entry = (tokens[0].user, tokens[0].get_scopes(), tokens[0].expires)
+        _get_cache().set(key, entry)
+    return entry
+
+def _lookup_legacy(username, token):
+    key = 'legacy:%s' % hash_token(u'%s:%s' % (username, token))
+    user = _get_cache().get(key)
+    if user is None:
+        users = User.objects.filter(username=username)
+        if not users or not constant_time_compare(get_api_token(users[0]), token.encode('utf-8')):
+            return None
+        user = users[0]
+        _get_cache().set(key, user)
+    return user
+
+def authenticate(username, token, scope):
+    """
+        Return the user *username* if *token* is one of their tokens that
+        is allowed to do *scope*. Raises `InvalidToken`.
+    """
+    entry = _lookup(hash_token(token))
+    if entry is not None:
+        user, scopes, expires = entry
+        if user.username != username or scope not in scopes:
+            raise InvalidToken()
+        if expires is not None and expires < datetime.now():
+            raise InvalidToken('The api token has expired.')
+    elif getattr(settings, 'API_LEGACY_TOKENS', True):
+        user = _lookup_legacy(username, token)
+    else:
+        user = None
+    if user is None or not user.is_active:
+        raise InvalidToken()
+    return user
@@ -0,0 +1,36 @@
+"""
+    Checks for the columns syncdb does not add to existing tables. They
+    have to be added by hand, see docs/upgrade.rst.
+"""
+from django.core.management.base import CommandError
+from django.db import connection
+
+UPGRADE_DOCS = 'docs/upgrade.rst'
+
+def get_missing_columns(*models):
+    """
+        Return the list of the columns of *models* that their tables
+        lack, as ``table.column`` strings.
+    """
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    missing = []
+    for model in models:
+        table = model._meta.db_table
+        # unlike the introspection of sqlite3, which uses PRAGMA statements,
+        # this does not commit the transaction.
+        cursor.execute('SELECT * FROM %s LIMIT 0' % qn(table))
+        columns = set(column[0] for column in cursor.description)
+        missing.extend('%s.%s' % (table, field.column) for field in model._meta.local_fields
+                if field.column not in columns)
+    return missing
+
+def check_columns(*models):
+    """
+        Raise a `CommandError` explaining how to upgrade the database if
+        the tables of *models* lack any of their columns.
+    """
+    missing = get_missing_columns(*models)
+    if missing:
+        raise CommandError('The database lacks the columns %s. Add them as described in %s first.' % (
+                ', '.join(missing), UPGRADE_DOCS))
@@ -1,27 +1,130 @@
-def parse_usefile(s):
-    """
-        parse the usefile in the string *s* and return its contents as dictionary.
-    """
-    dct = {}
-    for line in s.splitlines():
-        line = line.strip()
-        # ignore empty lines and comments
-        if (not line or line.startswith('#')):
-            return line
-        key, value = line.split(':', 1)
-        dct[key.strip()] = value.strip()
-    return dct
+import re
+
+from django.utils import simplejson
+from django.utils.datastructures import MultiValueDict
+
+from nirvana.pkg.versions import constraint_filter, InvalidConstraint
+
+# commas in parentheses separate the comparisons of a constraint.
+_requires_split_re = re.compile(r',(?![^()]*\))')
+_requirement_re = re.compile(r'^([-\w]+)\s*(?:\((.*)\)|(.*))$')
 
 class InvalidUsefile(Exception):
     pass
 
+class UsefileSyntaxError(InvalidUsefile):
+    def __init__(self, lineno, message):
+        InvalidUsefile.__init__(self, 'Line %d: %s' % (lineno, message))
+        self.lineno = lineno
+
+class UsefileFields(MultiValueDict):
+    """
+        The fields of a usefile. ``fields[key]`` is the last value of a
+        field, ``fields.getlist(key)`` all of them.
+    """
+    def to_json(self):
+        return simplejson.dumps(dict(self.lists()))
+
+    @classmethod
+    def from_json(cls, json):
+        return cls(simplejson.loads(json))
+
+def _iter_lines(source):
+    """
+        Yield the lines of *source*, a string or an iterable of lines
+        like a file, without line endings.
+    """
+    if isinstance(source, basestring):
+        start = 0
+        length = len(source)
+        while start < length:
+            end = source.find('\n', start)
+            if end == -1:
+                end = length
+            yield source[start:end].rstrip('\r')
+            start = end + 1
+    else:
+        for line in source:
+            yield line.rstrip('\r\n')
+
+def iter_usefile(source):
+    """
+        Parse the usefile *source* (a string, a file or any other iterable
+        of lines) line by line and yield a (line number, key, value) tuple
+        for each field.
+
+        Empty lines and lines starting with ``#`` are ignored. Lines
+        starting with whitespace continue the value of the previous field,
+        joined by newlines. Keys may appear more than once.
+
+        Raise `UsefileSyntaxError` for malformed lines.
+    """
+    field = None
+    lineno = 0
+    for lineno, line in enumerate(_iter_lines(source), 1):
+        stripped = line.strip()
+        if not stripped or stripped.startswith('#'):
+            continue
+        if line[0] in ' \t':
+            if field is None:
+                raise UsefileSyntaxError(lineno, 'Continuation line without a field.')
+            field[2].append(stripped)
+            continue
+        if field is not None:
+            yield field[0], field[1], '\n'.join(field[2])
+        key, colon, value = stripped.partition(':')
+        key = key.strip()
+        if not colon:
+            raise UsefileSyntaxError(lineno, "Expected 'Key: value', got %r." % stripped)
+        if not key:
+            raise UsefileSyntaxError(lineno, 'Missing field name.')
+        field = (lineno, key, [value.strip()])
+    if field is not None:
+        yield field[0], field[1], '\n'.join(field[2])
+
+def parse_usefile(source):
+    """
+        Parse the usefile *source* (see `iter_usefile`) and return its
+        fields as `UsefileFields`.
+    """
+    fields = UsefileFields()
+    for lineno, key, value in iter_usefile(source):
+        fields.appendlist(key, value)
+    return fields
+
 def validate_usefile(dct):
     """
-        Raise `InvalidUsefile` if there's something wrong with the dictionary *dct*.
+        Raise `InvalidUsefile` if there's something wrong with the `UsefileFields` *dct*.
 
         Requirements:
             - should have "Name", "Version", "Variant" and "Origin" fields.
+            - the "Requires" field, if any, has to be valid (see `parse_requires`).
     """
     fields = (k in dct for k in ('Name', 'Version', 'Variant', 'Origin'))
     if not all(fields):
         raise InvalidUsefile("The usefile has to contain 'Name', 'Version', 'Variant' and 'Origin' fields.")
+    for requires in dct.getlist('Requires'):
+        parse_requires(requires)
+
+def parse_requires(value):
+    """
+        Return a list of (package slug, version constraint) tuples for the
+        value of a "Requires" field like ``sdk, gtk >=2.0, sdl (>=1.2, <2)``.
+        The constraint is ``*`` if there is none.
+        Raise `InvalidUsefile` if it is malformed.
+    """
+    requirements = []
+    for item in _requires_split_re.split(value):
+        item = item.strip()
+        if not item:
+            continue
+        match = _requirement_re.match(item)
+        if match is None:
+            raise InvalidUsefile("Invalid requirement: %s" % item)
+        constraint = (match.group(2) or match.group(3) or '').strip() or '*'
+        try:
+            constraint_filter(constraint)
+        except InvalidConstraint, e:
+            raise InvalidUsefile("Invalid requirement: %s (%s)" % (item, e))
+        requirements.append((match.group(1), constraint))
+    return requirements
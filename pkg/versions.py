@@ -0,0 +1,179 @@
+"""
+    Sortable version keys and version constraints.
+
+    `version_key` turns a version slug into a string that sorts like the
+    version, e.g. ``0.9 < 1.0-beta2 < 1.0-rc1 < 1.0 < 1.0.1 < 1.10``. It is
+    stored in `Version.version_key`, so versions are sorted and constraints
+    like ``>=1.2,<2`` are answered by the database with range queries.
+
+    Slugs that do not start with a number (``trunk``) sort before all
+    numbered versions.
+"""
+import re
+
+from django.db.models import Q
+
+# number of release numbers and digits per number in a key.
+COMPONENTS = 6
+WIDTH = 8
+
+MAX_KEY_LENGTH = 128
+
+# follow the release numbers; pre-releases < release < post-releases.
+PRE_RELEASE = '!'
+RELEASE = '#'
+POST_RELEASE = '$'
+
+# suffixes that mark pre-releases, mapped to their rank.
+PRE_RELEASE_TAGS = {
+    'dev': '0',
+    'a': '1', 'alpha': '1',
+    'b': '2', 'beta': '2',
+    'c': '3', 'pre': '3', 'preview': '3', 'rc': '3',
+}
+
+_version_re = re.compile(r'^v?(\d+(?:\.\d+)*)(.*)$', re.I)
+_part_re = re.compile(r'\d+|[a-z]+')
+_clause_re = re.compile(r'^(>=|<=|>|<|==|=|~|\^)?\s*([-\w.]+)$')
+_wildcard_re = re.compile(r'^v?(\d+(?:\.\d+)*)\.[*xX]$')
+
+class InvalidConstraint(Exception):
+    pass
+
+def _number(value):
+    return str(min(int(value), 10 ** WIDTH - 1)).zfill(WIDTH)
+
+def parse_version(slug):
+    """
+        Return a tuple (list of release numbers, suffix) for the version
+        slug *slug*, or None if it does not start with a number.
+    """
+    match = _version_re.match(slug)
+    if match is None:
+        return None
+    return [int(n) for n in match.group(1).split('.')], match.group(2)
+
+def release_prefix(numbers):
+    """
+        Return the part of the version keys of the releases *numbers* that
+        all their pre- and post-releases share.
+    """
+    numbers = (list(numbers) + [0] * COMPONENTS)[:COMPONENTS]
+    return '1' + '.'.join(_number(n) for n in numbers)
+
+def version_key(slug):
+    """
+        Return the sortable key of the version slug *slug*.
+    """
+    parsed = parse_version(slug)
+    if parsed is None:
+        return ('0' + slug.lower())[:MAX_KEY_LENGTH]
+    numbers, suffix = parsed
+    parts = _part_re.findall(suffix.lower())
+    if not parts:
+        marker = RELEASE
+    elif parts[0] in PRE_RELEASE_TAGS:
+        marker = PRE_RELEASE
+        parts[0] = PRE_RELEASE_TAGS[parts[0]]
+    else:
+        marker = POST_RELEASE
+    suffix = '.'.join(part.isdigit() and _number(part) or part for part in parts)
+    return (release_prefix(numbers) + marker + suffix)[:MAX_KEY_LENGTH]
+
+def is_pre_release(slug):
+    return PRE_RELEASE in version_key(slug)
+
+def _bump(numbers, index):
+    return numbers[:index] + [numbers[index] + 1]
+
+def _q(field, **lookups):
+    return Q(**dict(('%s__%s' % (field, lookup), value) for lookup, value in lookups.iteritems()))
+
+def _parse_clause(clause, field):
+    """
+        Return a tuple (Q object on the version key *field*, mentions a
+        pre-release) for one comparison like ``>=1.2``.
+    """
+    numbered = _q(field, gt='1')
+    if clause == '*':
+        return Q(), False
+    wildcard = _wildcard_re.match(clause)
+    if wildcard is not None:
+        numbers = [int(n) for n in wildcard.group(1).split('.')]
+        return numbered & _q(field, gte=release_prefix(numbers),
+                lt=release_prefix(_bump(numbers, len(numbers) - 1))), False
+    match = _clause_re.match(clause)
+    if match is None:
+        raise InvalidConstraint('Invalid version comparison: %s' % clause)
+    op, slug = match.groups()
+    parsed = parse_version(slug)
+    key = version_key(slug)
+    pre_release = PRE_RELEASE in key
+    if op in (None, '=', '=='):
+        return _q(field, exact=key), pre_release
+    if parsed is None:
+        raise InvalidConstraint('Not a numbered version: %s' % slug)
+    numbers, suffix = parsed
+    if op == '>=':
+        q = _q(field, gte=key)
+    elif op == '>':
+        q = _q(field, gt=key)
+    elif op == '<=':
+        q = _q(field, lte=key)
+    elif op == '<':
+        # `<2` excludes the pre-releases of 2, `<2-rc1` does not.
+        if suffix:
+            q = _q(field, lt=key)
+        else:
+            q = _q(field, lt=release_prefix(numbers))
+    elif op == '~':
+        # ~1.4.2 allows 1.4.x, ~1 allows 1.x.
+        upper = _bump(numbers, min(len(numbers), 2) - 1)
+        q = _q(field, gte=key, lt=release_prefix(upper))
+    elif op == '^':
+        # ^1.4 allows 1.x, ^0.4 allows 0.4.x.
+        index = len(numbers) - 1
+        for i, number in enumerate(numbers):
+            if number:
+                index = i
+                break
+        q = _q(field, gte=key, lt=release_prefix(_bump(numbers, index)))
+    return numbered & q, pre_release
+
+def constraint_filter(constraint, pre_releases=False, prefix=''):
+    """
+        Return a Q object selecting the versions matching *constraint*.
+
+        A constraint is a comma-separated list of comparisons that all have
+        to match, like ``>=1.2,<2``. Comparisons are ``*``, ``1.2.*``,
+        ``=1.2`` (or just ``1.2``), ``>1.2``, ``>=1.2``, ``<1.2``, ``<=1.2``,
+        ``~1.2`` (1.2.x) and ``^1.2`` (1.x). Several constraints can be
+        joined with ``||``.
+
+        Pre-releases only match if *pre_releases* is True or the
+        constraint mentions a pre-release.
+
+        *prefix* is prepended to the ``version_key`` lookups, e.g.
+        ``version__`` to filter variants.
+
+        Raises `InvalidConstraint`.
+    """
+    field = prefix + 'version_key'
+    result = None
+    for alternative in constraint.split('||'):
+        q = Q()
+        mentions_pre_release = False
+        for clause in alternative.split(','):
+            clause = clause.strip()
+            if not clause:
+                raise InvalidConstraint('Invalid constraint: %s' % constraint)
+            clause_q, pre_release = _parse_clause(clause, field)
+            q &= clause_q
+            mentions_pre_release = mentions_pre_release or pre_release
+        if not (pre_releases or mentions_pre_release):
+            q &= ~_q(field, contains=PRE_RELEASE)
+        if result is None:
+            result = q
+        else:
+            result |= q
+    return result
@@ -1,35 +1,84 @@
+from datetime import timedelta
+
+from django.conf import settings
 from django.http import HttpResponse, Http404
 from django.core import serializers, urlresolvers
 from django.template import RequestContext
 from django.views.decorators.csrf import csrf_exempt
 from django.shortcuts import render_to_response, get_object_or_404, redirect
 from django.contrib.auth import login
-from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
-
-from nirvana.pkg.models import Category, Package, Version, Variant, ManagerPermission
-from nirvana.pkg.forms import EditPackageForm, NewPackageForm, EditVersionForm, NewVersionForm, NewCategoryForm, NewVariantForm, EditVariantForm, ManagerPermissionFormSet
-from nirvana.pkg.stuff import json_view, get_api_token
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db import transaction, IntegrityError
+from django.db.models import Q, Count
+from django.utils import simplejson
+
+from nirvana.pkg.models import Category, Package, Version, Variant, ManagerPermission, ApiToken, Manifest, invalidate_managed_variants, CONTENT_FIELDS
+from nirvana.pkg.forms import EditPackageForm, NewPackageForm, EditVersionForm, NewVersionForm, NewCategoryForm, NewVariantForm, EditVariantForm, ManagerPermissionFormSet, NewApiTokenForm
+from nirvana.pkg.stuff import json_view, get_api_token, conditional_response
 from nirvana.pkg.usefile import parse_usefile, validate_usefile
+from nirvana.pkg.snapshot import get_snapshot
+from nirvana.pkg.search import search
+from nirvana.pkg.versions import constraint_filter
+from nirvana.pkg.dependencies import get_dependencies
+from nirvana.pkg.listing import Page, Listing, paginate, listing_result, get_limit, decode_cursor
+from nirvana.pkg.cache import package_cached, categories_cached, stats as cache_stats
+from nirvana.pkg.instrumentation import get_histograms
+from nirvana.pkg.blobs import get_contents, blob_response, BlobNotFound
+from nirvana.pkg.tokens import authenticate as authenticate_token, create_token
+from nirvana.pkg.databases import read_only, primary
+from nirvana.pkg.manifest import get_latest_manifest
+from nirvana.pkg.checksums import normalize_checksums, find_files
+
+def _get_package(slug):
+    return get_object_or_404(Package.objects.select_related('latest_version', 'author'), slug=slug)
+
+def _package_list(packages):
+    """
+        Return *packages* with everything the package lists display.
+    """
+    return packages.select_related('latest_version').annotate(version_count=Count('version'))
+
+def _version_list(package):
+    """
+        Return the versions of *package*, newest first, with everything the
+        version lists display.
+    """
+    return Version.objects.filter(package=package).order_by('-version_key') \
+            .annotate(variant_count=Count('variant'))
+
+def _get_version(package, version_slug):
+    """
+        Return the version of *package* with the slug *version_slug*,
+        or its latest version if *version_slug* is None.
+    """
+    if version_slug is None:
+        if package.latest_version is None:
+            raise Http404('There is no latest version.')
+        return package.latest_version
+    return get_object_or_404(Version, package=package, slug=version_slug)
 
+@read_only
 def categories(request):
-    categories = Category.objects.all()
+    categories = Category.objects.annotate(package_count=Count('package'))
     return render_to_response(
             'pkg/categories.html',
             {'categories': categories},
             context_instance=RequestContext(request),
             )
 
+@read_only
 def welcome(request):
     return render_to_response(
             'pkg/welcome.html',
             context_instance=RequestContext(request),
             )
 
+@read_only
 def category(request, slug):
     if slug == 'my': # special pseudo-category containing my packages
         if request.user.is_authenticated():
-            packages = Package.objects.filter(author=request.user)
+            packages = _package_list(Package.objects.filter(author=request.user))
         else:
             # Unauthenticated users should not visit this site. However,
             # we'll just display an empty list.
@@ -37,7 +86,7 @@ def category(request, slug):
         category_name = 'my packages'
     else:
         category = get_object_or_404(Category, slug=slug)
-        packages = Package.objects.filter(category=category)
+        packages = _package_list(Package.objects.filter(category=category))
         category_name = category.name
     return render_to_response(
             'pkg/category.html',
@@ -48,9 +97,10 @@ def category(request, slug):
             context_instance=RequestContext(request),
             )
 
+@read_only
 def package(request, slug):
-    package = get_object_or_404(Package, slug=slug)
-    versions = Version.objects.filter(package=package)
+    package = _get_package(slug)
+    versions = _version_list(package)
     return render_to_response(
             'pkg/package.html',
             {
@@ -60,12 +110,10 @@ def package(request, slug):
             context_instance=RequestContext(request),
             )
 
+@read_only
 def version(request, slug, version_slug):
-    package = get_object_or_404(Package, slug=slug)
-    if version_slug is None: # display latest version
-        version = package.latest_version
-    else:
-        version = get_object_or_404(Version, package=package, slug=version_slug)
+    package = _get_package(slug)
+    version = _get_version(package, version_slug)
     variants = Variant.objects.filter(version=version)
     authorized_variants = package.get_authorized_variants(request.user)
     variants_dict = dict((variant.slug, False) for variant in variants)
@@ -76,19 +124,17 @@ def version(request, slug, version_slug):
             {
                 'package': package,
                 'version': version,
-                'versions': Version.objects.filter(package=package),
+                'versions': _version_list(package),
                 'variants': variants_dict,
                 'authorized': request.user.is_authenticated(),
             },
             context_instance=RequestContext(request),
             )
 
+@read_only
 def variant(request, slug, version_slug, variant_slug):
-    package = get_object_or_404(Package, slug=slug)
-    if version_slug is None: # display latest version
-        version = package.latest_version
-    else:
-        version = get_object_or_404(Version, package=package, slug=version_slug)
+    package = _get_package(slug)
+    version = _get_version(package, version_slug)
     variant = get_object_or_404(Variant, version=version, slug=variant_slug)
     return render_to_response(
             'pkg/variant.html',
@@ -102,36 +148,96 @@ def variant(request, slug, version_slug, variant_slug):
 
 @login_required
 def api_token(request):
+    token = None
+    if request.method == 'POST' and 'revoke' in request.POST:
+        if request.POST['revoke'].isdigit():
+            ApiToken.objects.filter(user=request.user, id=request.POST['revoke']).delete()
+        return redirect('nirvana.pkg.views.api_token')
+    elif request.method == 'POST':
+        form = NewApiTokenForm(request.POST)
+        if form.is_valid():
+            expires = None
+            if form.cleaned_data['expires_days']:
+                expires = timedelta(days=form.cleaned_data['expires_days'])
+            # the token is only shown this once.
+            api_token, token = create_token(request.user, form.cleaned_data['name'],
+                    form.cleaned_data['scopes'], expires)
+            form = NewApiTokenForm()
+    else:
+        form = NewApiTokenForm()
+    legacy_token = None
+    if getattr(settings, 'API_LEGACY_TOKENS', True):
+        legacy_token = get_api_token(request.user)
     return render_to_response(
             'pkg/api_token.html',
             {
-                'api_token': get_api_token(request.user),
+                'api_token': legacy_token,
+                'new_token': token,
+                'tokens': ApiToken.objects.filter(user=request.user).order_by('created'),
+                'form': form,
             },
             context_instance=RequestContext(request),
             )
 
 def _get_file_variant(slug, version_slug, variant_slug, fname):
-    package = get_object_or_404(Package, slug=slug)
-    if version_slug is None: # display latest version
-        version = package.latest_version
-    else:
-        version = get_object_or_404(Version, package=package, slug=version_slug)
+    package = _get_package(slug)
+    version = _get_version(package, version_slug)
     variant = get_object_or_404(Variant, version=version, slug=variant_slug)
     if fname != package.slug:
         raise Http404()
     return variant
 
+FILE_MIMETYPES = {
+    'usefile': 'text/plain; charset=utf-8',
+    'checksums': 'text/plain; charset=utf-8',
+    'checksums_signature': 'application/pgp-signature',
+}
+
+def _file_response(request, variant, field, latest):
+    # The latest version may change to a version whose variants are older
+    # than the client's copy, so `latest` urls are only validated by ETag.
+    if latest:
+        last_modified = None
+    else:
+        last_modified = variant.modified
+    # the content is only loaded if the client's copy is outdated.
+    hash = variant.get_hash(field)
+    return conditional_response(request, lambda: blob_response(request, hash, FILE_MIMETYPES[field]),
+            hash, last_modified)
+
+@read_only
+@package_cached
 def usefile(request, slug, version_slug, variant_slug, usefile):
     variant = _get_file_variant(slug, version_slug, variant_slug, usefile)
-    return HttpResponse(variant.usefile, mimetype='text/plain')
+    return _file_response(request, variant, 'usefile', version_slug is None)
 
+@read_only
+@package_cached
 def checksums(request, slug, version_slug, variant_slug, checksums):
     variant = _get_file_variant(slug, version_slug, variant_slug, checksums)
-    return HttpResponse(variant.checksums, mimetype='text/plain')
+    return _file_response(request, variant, 'checksums', version_slug is None)
 
+@read_only
+@package_cached
 def checksums_signature(request, slug, version_slug, variant_slug, checksums_signature):
     variant = _get_file_variant(slug, version_slug, variant_slug, checksums_signature)
-    return HttpResponse(variant.checksums_signature, mimetype='text/plain')
+    if variant.signature_pending:
+        response = HttpResponse('The checksums have not been signed yet.', mimetype='text/plain', status=503)
+        response['Retry-After'] = '5'
+        return response
+    return _file_response(request, variant, 'checksums_signature', version_slug is None)
+
+def _save_unique(obj, message):
+    """
+        Save *obj*, whose slug is unique within its parent. A duplicate is
+        only detected by the database, so there is no race between
+        checking and saving.
+    """
+    try:
+        obj.save()
+    except IntegrityError:
+        transaction.rollback_unless_managed()
+        raise Http404(message) # TODO: nicer error.
 
 @login_required
 def package_new(request):
@@ -208,12 +314,17 @@ def package_edit_managers(request, slug):
         raise Http404()
     else:
         if request.method == 'POST':
-            formset = ManagerPermissionFormSet(request.POST, queryset=ManagerPermission.objects.filter(package=package))
+            permissions = ManagerPermission.objects.filter(package=package)
+            formset = ManagerPermissionFormSet(request.POST, queryset=permissions)
             if formset.is_valid():
+                # users that might lose a permission.
+                user_ids = set(permissions.values_list('user', flat=True))
                 # get object, save package
                 for instance in formset.save(commit=False):
                     instance.package = package
                     instance.save()
+                    user_ids.add(instance.user_id)
+                invalidate_managed_variants(user_ids)
                 # TODO: check version slug
                 return redirect('nirvana.pkg.views.package', slug=package.slug)
         else:
@@ -239,14 +350,12 @@ def version_new(request, slug):
         if request.method == 'POST':
             form = NewVersionForm(request.POST)
             if form.is_valid():
-                if Version.objects.filter(slug=form.cleaned_data['slug'], package=package):
-                    raise Http404("A version like this already exists.") # TODO: nicer error.
                 # get object, save package
                 version = form.save(commit=False)
                 version.package = package
                 if version.latest:
                     version.make_latest()
-                version.save()
+                _save_unique(version, "A version like this already exists.")
                 # TODO: check version slug
                 return redirect('nirvana.pkg.views.version', slug=package.slug, version_slug=version.slug)
         else:
@@ -262,11 +371,8 @@ def version_new(request, slug):
 
 @login_required
 def version_edit(request, slug, version_slug):
-    package = get_object_or_404(Package, slug=slug)
-    if version_slug is None: # display latest version
-        version = package.latest_version
-    else:
-        version = get_object_or_404(Version, package=package, slug=version_slug)
+    package = _get_package(slug)
+    version = _get_version(package, version_slug)
     if request.user != package.author:
         # oh oh! hacker! let's confuse him with a 404.
         raise Http404()
@@ -274,12 +380,10 @@ def version_edit(request, slug, version_slug):
         if request.method == 'POST':
             form = EditVersionForm(request.POST, instance=version)
             if form.is_valid():
-                if (version.slug != form.cleaned_data['slug'] and Version.objects.filter(slug=form.cleaned_data['slug'], package=package)):
-                    raise Http404("A version like this already exists.") # TODO: nicer error.
                 version = form.save(commit=False)
                 if version.latest:
                     version.make_latest()
-                version.save()
+                _save_unique(version, "A version like this already exists.")
                 # TODO: check version slug
                 return redirect('nirvana.pkg.views.version', slug=package.slug, version_slug=version.slug)
         else:
@@ -295,21 +399,19 @@ def version_edit(request, slug, version_slug):
 
 @login_required
 def variant_new(request, slug, version_slug):
-    package = get_object_or_404(Package, slug=slug)
-    version = get_object_or_404(Version, slug=version_slug, package=package)
+    package = _get_package(slug)
+    version = _get_version(package, version_slug)
     if request.method == 'POST':
         form = NewVariantForm(request.POST)
         # required for validation!
         form.package = package
         form.request = request
         if form.is_valid():
-            if Variant.objects.filter(slug=form.cleaned_data['slug'], version=version):
-                raise Http404("A variant like this already exists.") # TODO: nicer error.
             # get object, save package
             variant = form.save(commit=False)
             variant.version = version
             variant.set_signature()
-            variant.save()
+            _save_unique(variant, "A variant like this already exists.")
             # TODO: check usefile.
             # TODO: check version slug
             return redirect('nirvana.pkg.views.variant',
@@ -327,8 +429,8 @@ def variant_new(request, slug, version_slug):
 
 @login_required
 def variant_edit(request, slug, version_slug, variant_slug):
-    package = get_object_or_404(Package, slug=slug)
-    version = get_object_or_404(Version, slug=version_slug, package=package)
+    package = _get_package(slug)
+    version = _get_version(package, version_slug)
     variant = get_object_or_404(Variant, slug=variant_slug, version=version)
     if not package.is_authorized_for_variant(request.user, variant.slug):
         raise Http404('You are not authorized to edit this variant.')
@@ -364,16 +466,45 @@ def _get_type(request, choices):
         raise Http404("Unknown type: %s" % t)
     return t
 
+def _get_int(request, key, default=None):
+    value = request.GET.get(key)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise Exception("Invalid %s: %s" % (key, value))
+    if value < 0:
+        raise Exception("Invalid %s: %s" % (key, value))
+    return value
+
 # API
 
+@read_only
 @json_view
 def api_search(request):
     pattern = request.GET['pattern']
     if not pattern.strip():
         raise Exception('No pattern given >:o')
-    packages = Package.search(pattern)
-    return dict((p.slug, p.name) for p in packages)
-
+    limit = get_limit(request)
+    cursor = request.GET.get('cursor')
+    if cursor:
+        try:
+            offset = int(decode_cursor(cursor))
+        except ValueError:
+            raise Exception('Invalid cursor: %s' % cursor)
+    else:
+        offset = _get_int(request, 'offset', 0)
+    total, results = search(pattern, limit is not None and limit + 1 or None, offset)
+    page = Page(results, limit, lambda result: offset + limit,
+            lambda (p, score): {'slug': p.slug, 'name': p.name, 'score': score},
+            paginated=limit is not None or cursor is not None)
+    if request.GET.get('rank'):
+        return listing_result(request, Listing(page, {'total': total}, 'results', lambda row: row))
+    return listing_result(request, Listing(page))
+
+@read_only
+@categories_cached
 @json_view
 def api_categories(request):
     type = _get_type(request, ('contents', 'details'))
@@ -383,70 +514,87 @@ def api_categories(request):
         categories = [category.slug for category in Category.objects.all()]
         return {'categories': categories}
 
+@read_only
+@categories_cached
 @json_view
 def api_category(request, slug):
     category = get_object_or_404(Category, slug=slug)
-    packages = Package.objects.filter(category=category)
+    page = paginate(request, Package.objects.filter(category=category))
     type = _get_type(request, ('contents', 'details'))
     if type == 'contents':
-        return dict((package.slug, package.name) for package in packages)
+        return listing_result(request, Listing(page))
     else:
-        return {
+        return listing_result(request, Listing(page, {
             'slug': category.slug,
             'name': category.name,
-            'packages': [p.slug for p in packages]
-        }
+        }, 'packages'))
 
+@read_only
+@package_cached
 @json_view
 def api_package(request, slug):
-    package = get_object_or_404(Package, slug=slug)
-    versions = Version.objects.filter(package=package)
+    package = _get_package(slug)
+    page = paginate(request, Version.objects.filter(package=package).order_by('version_key'), key='version_key')
     latest_version = package.latest_version
     if latest_version is not None:
         latest_version = latest_version.slug
     type = _get_type(request, ('contents', 'details'))
     if type == 'contents':
-        return dict((v.slug, v.name) for v in versions)
+        return listing_result(request, Listing(page))
     else:
-        return {
+        return listing_result(request, Listing(page, {
                 'slug': package.slug,
                 'name': package.name,
                 'author': package.author.username,
                 'homepage': package.homepage,
                 'latest_version': latest_version,
-                'category': package.category.slug,
-                'versions': [v.slug for v in versions]
-        }
+                'category': package.category_id,
+        }, 'versions'))
+
+@read_only
+@package_cached
+@json_view
+def api_package_resolve(request, slug):
+    constraint = request.GET.get('constraint', '*')
+    q = constraint_filter(constraint, bool(request.GET.get('prereleases')))
+    versions = list(Version.objects.filter(q, package=slug).order_by('-version_key') \
+            .values_list('slug', flat=True))
+    if not versions and not Package.objects.filter(slug=slug).exists():
+        raise Http404('No such package: %s' % slug)
+    return {
+        'constraint': constraint,
+        'version': versions and versions[0] or None,
+        'versions': versions,
+    }
 
+@read_only
+@package_cached
 @json_view
 def api_version(request, slug, version_slug):
-    package = get_object_or_404(Package, slug=slug)
+    package = _get_package(slug)
+    version = _get_version(package, version_slug)
     if version_slug is None:
-        version = package.latest_version
         version_slug = 'latest'
-    else:
-        version = get_object_or_404(Version, package=package, slug=version_slug)
-    variants = Variant.objects.filter(version=version)
+    page = paginate(request, Variant.objects.filter(version=version))
     type = _get_type(request, ('contents', 'details'))
     if type == 'contents':
-        return dict((v.slug, v.name) for v in variants)
+        return listing_result(request, Listing(page))
     else:
-        return {
+        return listing_result(request, Listing(page, {
                 'slug': version.slug,
                 'name': version.name,
-                'package': version.package.slug,
+                'package': package.slug,
                 'latest': version.latest,
-                'variants': [v.slug for v in variants]
-            }
+            }, 'variants'))
 
+@read_only
+@package_cached
 @json_view
 def api_variant(request, slug, version_slug, variant_slug):
-    package = get_object_or_404(Package, slug=slug)
+    package = _get_package(slug)
+    version = _get_version(package, version_slug)
     if version_slug is None:
-        version = package.latest_version
         version_slug = 'latest'
-    else:
-        version = get_object_or_404(Version, package=package, slug=version_slug)
     variant = get_object_or_404(Variant, version=version, slug=variant_slug)
     return {
             'slug': variant.slug,
@@ -461,8 +609,164 @@ def api_variant(request, slug, version_slug, variant_slug):
             'checksums_signature': urlresolvers.reverse('nirvana.pkg.views.checksums_signature',
                 kwargs={'slug': slug, 'version_slug': version_slug, 'variant_slug': variant.slug, 'checksums_signature': slug},
             ),
+            'signature_pending': variant.signature_pending,
         }
 
+@read_only
+@json_view
+def api_dependencies(request, slug, version_slug, variant_slug):
+    package = _get_package(slug)
+    version = _get_version(package, version_slug)
+    variant = get_object_or_404(Variant.objects.select_related('version'), version=version, slug=variant_slug)
+    return get_dependencies(variant, bool(request.GET.get('prereleases')))
+
+@read_only
+@json_view
+def api_checksum(request, hash):
+    files = []
+    for checksum in find_files(hash):
+        version = checksum.variant.version
+        files.append({
+            'package': version.package_id,
+            'version': version.slug,
+            'variant': checksum.variant.slug,
+            'filename': checksum.filename,
+            'algorithm': checksum.algorithm,
+        })
+    return {'files': files}
+
+def _parse_resolve_items(request):
+    """
+        Return a list of (package slug, version slug, variant slug) triples
+        passed as ``variant`` parameters. A version slug of ``latest``
+        is returned as None.
+    """
+    if request.method == 'POST':
+        data = request.POST
+    else:
+        data = request.GET
+    items = []
+    for item in data.getlist('variant'):
+        try:
+            slug, version_slug, variant_slug = item.split('/')
+        except ValueError:
+            raise Exception('Invalid variant: %s' % item)
+        if version_slug == 'latest':
+            version_slug = None
+        items.append((slug, version_slug, variant_slug))
+    return items
+
+@read_only
+@csrf_exempt
+@json_view
+def api_resolve(request):
+    items = _parse_resolve_items(request)
+    if not items:
+        raise Exception('No variants given >:o')
+    # fetch all versions we need in one query ...
+    q = Q(latest=True)
+    version_slugs = [version_slug for slug, version_slug, variant_slug in items if version_slug is not None]
+    if version_slugs:
+        q = q | Q(slug__in=version_slugs)
+    versions = {}
+    for version in Version.objects.filter(q, package__slug__in=[item[0] for item in items]):
+        versions[(version.package_id, version.slug)] = version
+        if version.latest:
+            versions[(version.package_id, None)] = version
+    # ... and all variants in another one ...
+    variants = {}
+    for variant in Variant.objects.filter(version__in=versions.values(),
+            slug__in=[item[2] for item in items]):
+        variants[(variant.version_id, variant.slug)] = variant
+    # ... and their contents in a third one.
+    contents = get_contents(set(variant.get_hash(field)
+            for variant in variants.itervalues() for field in CONTENT_FIELDS))
+    results = []
+    for slug, version_slug, variant_slug in items:
+        result = {
+            'package': slug,
+            'version': version_slug or 'latest',
+            'variant': variant_slug,
+        }
+        version = versions.get((slug, version_slug))
+        variant = None
+        if version is not None:
+            variant = variants.get((version.id, variant_slug))
+        if variant is None:
+            result['error'] = 'Not found.'
+        elif [field for field in CONTENT_FIELDS if variant.get_hash(field) not in contents]:
+            result['error'] = 'The contents of this variant are missing.'
+        else:
+            result.update({
+                'version': version.slug,
+                'usefile': contents[variant.get_hash('usefile')],
+                'checksums': contents[variant.get_hash('checksums')],
+                'checksums_signature': contents[variant.get_hash('checksums_signature')],
+            })
+        results.append(result)
+    return {'variants': results}
+
+@read_only
+def api_snapshot(request):
+    since = request.GET.get('since')
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            raise Http404('Invalid sequence: %s' % since)
+    try:
+        snapshot = get_snapshot(since)
+    except BlobNotFound, e:
+        return HttpResponse(unicode(e), status=503, mimetype='text/plain; charset=utf-8')
+    response = HttpResponse(snapshot, mimetype='application/x-gzip')
+    response['Content-Disposition'] = 'attachment; filename=nirvana-snapshot.json.gz'
+    return response
+
+def api_manifest(request):
+    # built by `manage.py build_manifest`, never while serving a request.
+    manifest = get_latest_manifest()
+    if manifest is None:
+        raise Http404('No manifest has been built yet.')
+    response = conditional_response(request,
+            lambda: blob_response(request, manifest.content_hash, 'application/json'), manifest.content_hash)
+    response['X-Manifest-Signature'] = urlresolvers.reverse('nirvana.pkg.views.api_manifest_signature',
+            kwargs={'hash': manifest.content_hash})
+    return response
+
+def api_manifest_signature(request, hash):
+    # older manifests are kept for a while, so clients that just fetched
+    # the previous one can still verify it.
+    hashes = Manifest.objects.filter(content_hash=hash).values_list('signature_hash', flat=True)[:1]
+    if not hashes:
+        raise Http404('No manifest %s' % hash)
+    return conditional_response(request,
+            lambda: blob_response(request, hashes[0], 'application/pgp-signature'), hashes[0])
+
+@read_only
+def api_blob(request, hash):
+    get_content = lambda: blob_response(request, hash, 'text/plain; charset=utf-8')
+    try:
+        response = conditional_response(request, get_content, hash)
+    except BlobNotFound:
+        # the blob may be newer than the replica.
+        with primary():
+            try:
+                response = conditional_response(request, get_content, hash)
+            except BlobNotFound:
+                raise Http404('No blob %s' % hash)
+    # blobs never change.
+    response['Cache-Control'] = 'public, max-age=31536000'
+    return response
+
+@json_view
+def api_cache_stats(request):
+    return cache_stats.as_dict()
+
+@staff_member_required
+@json_view
+def api_request_stats(request):
+    return {'endpoints': get_histograms()}
+
 @csrf_exempt
 @json_view
 def api_submit(request):
@@ -478,33 +782,119 @@ def api_submit(request):
     checksums = request.POST.get('checksums', '')
     variant_name = request.POST.get('name', '')
     # first, see if the api token is correct.
-    user = get_object_or_404(User, username=username)
-    if get_api_token(user) != api_token:
-        raise Exception("The api token is incorrect.")
+    user = authenticate_token(username, api_token, 'submit')
     # get & validate.
     dct = parse_usefile(usefile)
     validate_usefile(dct)
+    checksums = normalize_checksums(checksums)
     # do we have such a package and such a version?
     package = get_object_or_404(Package, slug=slug)
     version = get_object_or_404(Version, package=package, slug=dct['Version'])
     if not package.is_authorized_for_variant(user, dct['Variant'], True):
         raise Exception("You are not allowed to add this variant to this package.")
-    if Variant.objects.filter(slug=dct['Variant'], version=version):
-        raise Exception("A variant like this already exists.")
     # yeah, we have. create a new version.
     variant = Variant(
                     slug=dct['Variant'],
                     name=variant_name,
                     version=version,
-                    usefile=usefile,
                     checksums=checksums
                     )
+    variant.set_usefile(usefile, dct)
     variant.set_signature()
-    variant.save()
+    try:
+        variant.save()
+    except IntegrityError:
+        transaction.rollback_unless_managed()
+        raise Exception("A variant like this already exists.")
     return {'path':
         urlresolvers.reverse('nirvana.pkg.views.variant',
             kwargs={'slug': package.slug, 'version_slug': dct['Version'], 'variant_slug': dct['Variant']})}
 
+def _check_batch_item(item, versions, authorized, existing):
+    """
+        Validate one item of a batch submission and return a new unsaved
+        variant. *versions* maps version slugs to versions, *authorized*
+        is a callable checking a variant slug, *existing* is a set of
+        (version id, variant slug) tuples that are already taken.
+    """
+    if not isinstance(item, dict) or 'usefile' not in item:
+        raise Exception('usefile not found in the data!')
+    usefile = item['usefile']
+    dct = parse_usefile(usefile)
+    validate_usefile(dct)
+    checksums = normalize_checksums(item.get('checksums', ''))
+    version = versions.get(dct['Version'])
+    if version is None:
+        raise Exception("There is no version %s." % dct['Version'])
+    if not authorized(dct['Variant']):
+        raise Exception("You are not allowed to add this variant to this package.")
+    if (version.id, dct['Variant']) in existing:
+        raise Exception("A variant like this already exists.")
+    existing.add((version.id, dct['Variant']))
+    variant = Variant(
+        slug=dct['Variant'],
+        name=item.get('name', ''),
+        version=version,
+        checksums=checksums,
+        )
+    variant.set_usefile(usefile, dct)
+    return variant
+
+@csrf_exempt
+@json_view
+@transaction.commit_on_success
+def api_submit_batch(request):
+    def _get(key):
+        if key in request.POST:
+            return request.POST[key]
+        else:
+            raise Exception('%s not found in the data!' % key)
+    username = _get('user')
+    slug = _get('slug')
+    api_token = _get('token')
+    try:
+        items = simplejson.loads(_get('variants'))
+    except ValueError:
+        raise Exception('variants is not valid JSON.')
+    if not isinstance(items, list):
+        raise Exception('variants has to be a JSON array.')
+    skip_invalid = request.POST.get('skip_invalid', '') not in ('', '0', 'false')
+    # first, see if the api token is correct.
+    user = authenticate_token(username, api_token, 'submit')
+    package = get_object_or_404(Package, slug=slug)
+    # fetch everything we need to validate the items at once.
+    versions = dict((v.slug, v) for v in Version.objects.filter(package=package))
+    existing = set(Variant.objects.filter(version__package=package).values_list('version', 'slug'))
+    authorized = package.get_authorization(user, True)
+    results = []
+    variants = []
+    failed = False
+    for item in items:
+        try:
+            variant = _check_batch_item(item, versions, authorized, existing)
+        except Exception, e:
+            failed = True
+            results.append({'__result': 'error', '__text': unicode(e)})
+        else:
+            variants.append(variant)
+            results.append({'__result': 'ok', 'path':
+                urlresolvers.reverse('nirvana.pkg.views.variant',
+                    kwargs={'slug': package.slug, 'version_slug': variant.version.slug, 'variant_slug': variant.slug})})
+    if failed and not skip_invalid:
+        for result in results:
+            if result['__result'] == 'ok':
+                result.update({'__result': 'skipped'})
+                del result['path']
+        return {'__result': 'error', '__text': 'The batch contains invalid variants.', 'variants': results}
+    for variant in variants:
+        variant.set_signature()
+    try:
+        Variant.objects.insert_many(variants)
+    except IntegrityError:
+        # added in the meantime, the whole batch is rolled back.
+        raise Exception("A variant like this already exists.")
+    return {'variants': results}
+
 @csrf_exempt
 @json_view
 def api_authorized(request):
@@ -520,9 +910,7 @@ def api_authorized(request):
     version_slug = _get('version')
     variant_slug = _get('variant')
 
-    user = get_object_or_404(User, username=username)
-    if get_api_token(user) != api_token:
-        raise Exception("The api token is incorrect.")
+    user = authenticate_token(username, api_token, 'check')
 
     package = get_object_or_404(Package, slug=package_slug)
     version = get_object_or_404(Version, package=package, slug=version_slug)
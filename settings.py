@@ -4,12 +4,17 @@ from server_settings import *
 
 MANAGERS = ADMINS
 
-DATABASE_ENGINE = 'sqlite3'           # 'postgresql_psycopg2', 'postgresql', 'mysql', 'sqlite3' or 'oracle'.
-#DATABASE_NAME = 'nirvana.sqlite'             # Or path to database file if using sqlite3. # see server_settings
-DATABASE_USER = ''             # Not used with sqlite3.
-DATABASE_PASSWORD = ''         # Not used with sqlite3.
-DATABASE_HOST = ''             # Set to empty string for localhost. Not used with sqlite3.
-DATABASE_PORT = ''             # Set to empty string for default. Not used with sqlite3.
+# server_settings may define DATABASES instead of DATABASE_NAME, e.g. with
+# read replicas, see `nirvana.pkg.databases`.
+if 'DATABASES' not in globals():
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': DATABASE_NAME,
+        },
+    }
+
+DATABASE_ROUTERS = ['nirvana.pkg.databases.ReplicaRouter']
 
 # Local time zone for this installation. Choices can be found here:
 # http://en.wikipedia.org/wiki/List_of_tz_zones_by_name
@@ -46,10 +51,12 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'nirvana.pkg.instrumentation.InstrumentationMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'nirvana.pkg.databases.ReplicaMiddleware',
 )
 
 ROOT_URLCONF = 'nirvana.urls'
@@ -1,10 +1,42 @@
 from django.conf.urls.defaults import *
 
+from nirvana.pkg.dispatch import SegmentDispatcher, route_packages, route_api_packages
+
 # Uncomment the next two lines to enable the admin:
 from django.contrib import admin
 admin.autodiscover()
 
+# the download and api urls of packages are resolved by `nirvana.pkg.dispatch`;
+# these patterns are only used for reversing them.
+package_urlpatterns = patterns('',
+    (r'^(?P<slug>[-\w]+)/$', 'nirvana.pkg.views.package'),
+    (r'^(?P<slug>[-\w]+)/latest/$', 'nirvana.pkg.views.version', {'version_slug': None}),
+    (r'^(?P<slug>[-\w]+)/(?P<version_slug>[-\w.]+)/$', 'nirvana.pkg.views.version'),
+    (r'^(?P<slug>[-\w]+)/latest/(?P<variant_slug>[-\w.]+)/$', 'nirvana.pkg.views.variant', {'version_slug': None}),
+    (r'^(?P<slug>[-\w]+)/(?P<version_slug>[-\w.]+)/(?P<variant_slug>[-\w.]+)/$', 'nirvana.pkg.views.variant'),
+    (r'^(?P<slug>[-\w]+)/latest/(?P<variant_slug>[-\w.]+)/(?P<usefile>[-\w]+)\.use$', 'nirvana.pkg.views.usefile', {'version_slug': None}),
+    (r'^(?P<slug>[-\w]+)/(?P<version_slug>[-\w.]+)/(?P<variant_slug>[-\w.]+)/(?P<usefile>[-\w]+)\.use$', 'nirvana.pkg.views.usefile'),
+    (r'^(?P<slug>[-\w]+)/latest/(?P<variant_slug>[-\w.]+)/(?P<checksums>[-\w]+)\.checksums$', 'nirvana.pkg.views.checksums', {'version_slug': None}),
+    (r'^(?P<slug>[-\w]+)/(?P<version_slug>[-\w.]+)/(?P<variant_slug>[-\w.]+)/(?P<checksums>[-\w]+)\.checksums$', 'nirvana.pkg.views.checksums'),
+    (r'^(?P<slug>[-\w]+)/latest/(?P<variant_slug>[-\w.]+)/(?P<checksums_signature>[-\w]+)\.checksums\.sig$', 'nirvana.pkg.views.checksums_signature', {'version_slug': None}),
+    (r'^(?P<slug>[-\w]+)/(?P<version_slug>[-\w.]+)/(?P<variant_slug>[-\w.]+)/(?P<checksums_signature>[-\w]+)\.checksums\.sig$', 'nirvana.pkg.views.checksums_signature'),
+)
+
+api_package_urlpatterns = patterns('',
+    (r'^(?P<slug>[-\w]+)/$', 'nirvana.pkg.views.api_package'),
+    (r'^(?P<slug>[-\w]+)/latest/$', 'nirvana.pkg.views.api_version', {'version_slug': None}),
+    (r'^(?P<slug>[-\w]+)/resolve/$', 'nirvana.pkg.views.api_package_resolve'),
+    (r'^(?P<slug>[-\w]+)/(?P<version_slug>[-\w.]+)/$', 'nirvana.pkg.views.api_version'),
+    (r'^(?P<slug>[-\w]+)/latest/(?P<variant_slug>[-\w.]+)/$', 'nirvana.pkg.views.api_variant', {'version_slug': None}),
+    (r'^(?P<slug>[-\w]+)/(?P<version_slug>[-\w.]+)/(?P<variant_slug>[-\w.]+)/$', 'nirvana.pkg.views.api_variant'),
+    (r'^(?P<slug>[-\w]+)/latest/(?P<variant_slug>[-\w.]+)/dependencies/$', 'nirvana.pkg.views.api_dependencies', {'version_slug': None}),
+    (r'^(?P<slug>[-\w]+)/(?P<version_slug>[-\w.]+)/(?P<variant_slug>[-\w.]+)/dependencies/$', 'nirvana.pkg.views.api_dependencies'),
+)
+
 urlpatterns = patterns('',
+    # most requests go there, so they come first.
+    SegmentDispatcher('packages/', route_packages, 'nirvana.pkg.views', package_urlpatterns),
+    SegmentDispatcher('api/packages/', route_api_packages, 'nirvana.pkg.views', api_package_urlpatterns),
     # Uncomment the next line to enable the admin:
     (r'^$', 'nirvana.pkg.views.welcome'),
     (r'^admin/', include(admin.site.urls)),
@@ -26,23 +58,6 @@ urlpatterns = patterns('',
     (r'^package/(?P<slug>[-\w]+)/latest/edit/$', 'nirvana.pkg.views.version_edit', {'version_slug': None}),
     (r'^package/(?P<slug>[-\w]+)/(?P<version_slug>[-\w.]+)/edit/$', 'nirvana.pkg.views.version_edit'), # TODO: fix the version regex
 
-    (r'^packages/(?P<slug>[-\w]+)/$', 'nirvana.pkg.views.package'),
-
-    (r'^packages/(?P<slug>[-\w]+)/latest/$', 'nirvana.pkg.views.version', {'version_slug': None}),
-    (r'^packages/(?P<slug>[-\w]+)/(?P<version_slug>[-\w.]+)/$', 'nirvana.pkg.views.version'), # TODO: fix the version regex
-
-    (r'^packages/(?P<slug>[-\w]+)/latest/(?P<variant_slug>[-\w]+)/$', 'nirvana.pkg.views.variant', {'version_slug': None}),
-    (r'^packages/(?P<slug>[-\w]+)/(?P<version_slug>[-\w.]+)/(?P<variant_slug>[-\w.]+)/$', 'nirvana.pkg.views.variant'), # TODO: fix the version regex
-
-    (r'^packages/(?P<slug>[-\w]+)/latest/(?P<variant_slug>[-\w]+)/(?P<usefile>[-\w.]+)\.use$', 'nirvana.pkg.views.usefile', {'version_slug': None}),
-    (r'^packages/(?P<slug>[-\w]+)/(?P<version_slug>[-\w.]+)/(?P<variant_slug>[-\w.]+)/(?P<usefile>[-\w.]+)\.use$', 'nirvana.pkg.views.usefile'), # TODO: fix the version regex
-    (r'^packages/(?P<slug>[-\w]+)/latest/(?P<variant_slug>[-\w]+)/(?P<checksums>[-\w.]+)\.checksums$', 'nirvana.pkg.views.checksums', {'version_slug': None}),
-    (r'^packages/(?P<slug>[-\w]+)/(?P<version_slug>[-\w.]+)/(?P<variant_slug>[-\w.]+)/(?P<checksums>[-\w.]+)\.checksums$', 'nirvana.pkg.views.checksums'), # TODO: fix the version regex
-    (r'^packages/(?P<slug>[-\w]+)/latest/(?P<variant_slug>[-\w]+)/(?P<checksums_signature>[-\w.]+)\.checksums\.sig$', 'nirvana.pkg.views.checksums_signature', {'version_slug': None}),
-    (r'^packages/(?P<slug>[-\w]+)/(?P<version_slug>[-\w.]+)/(?P<variant_slug>[-\w.]+)/(?P<checksums_signature>[-\w.]+)\.checksums\.sig$', 'nirvana.pkg.views.checksums_signature'), # TODO: fix the version regex
-
-
-
     (r'^accounts/', include('registration.urls')),
 
     (r'^site_media/(?P<path>.*)$', 'django.views.static.serve', {'document_root': '/home/fred/dev/ooc/nirvana/media'}), # TODO: only for development
@@ -50,12 +65,16 @@ urlpatterns = patterns('',
     # api
     (r'^api/authorized/$', 'nirvana.pkg.views.api_authorized'),
     (r'^api/submit/$', 'nirvana.pkg.views.api_submit'),
+    (r'^api/submit/batch/$', 'nirvana.pkg.views.api_submit_batch'),
     (r'^api/categories/$', 'nirvana.pkg.views.api_categories'),
     (r'^api/search/$', 'nirvana.pkg.views.api_search'),
+    (r'^api/resolve/$', 'nirvana.pkg.views.api_resolve'),
+    (r'^api/snapshot/$', 'nirvana.pkg.views.api_snapshot'),
+    (r'^api/manifest/$', 'nirvana.pkg.views.api_manifest'),
+    (r'^api/manifest/(?P<hash>[0-9a-f]{40})\.sig$', 'nirvana.pkg.views.api_manifest_signature'),
+    (r'^api/blobs/(?P<hash>[0-9a-f]{40})/$', 'nirvana.pkg.views.api_blob'),
+    (r'^api/checksums/(?P<hash>[0-9a-fA-F]{32,64})/$', 'nirvana.pkg.views.api_checksum'),
+    (r'^api/cache/$', 'nirvana.pkg.views.api_cache_stats'),
+    (r'^api/stats/$', 'nirvana.pkg.views.api_request_stats'),
     (r'^api/category/(?P<slug>[-\w]+)/$', 'nirvana.pkg.views.api_category'),
-    (r'^api/packages/(?P<slug>[-\w]+)/$', 'nirvana.pkg.views.api_package'),
-    (r'^api/packages/(?P<slug>[-\w]+)/latest/$', 'nirvana.pkg.views.api_version', {'version_slug': None}),
-    (r'^api/packages/(?P<slug>[-\w]+)/(?P<version_slug>[-\w.]+)/$', 'nirvana.pkg.views.api_version'),
-    (r'^api/packages/(?P<slug>[-\w]+)/latest/(?P<variant_slug>[-\w.]+)/$', 'nirvana.pkg.views.api_variant', {'version_slug': None}),
-    (r'^api/packages/(?P<slug>[-\w]+)/(?P<version_slug>[-\w.]+)/(?P<variant_slug>[-\w.]+)/$', 'nirvana.pkg.views.api_variant'),
 )